@@ -1,29 +1,43 @@
 import argparse
+from multiprocessing import Pool
 import numpy as np
 from os import path, listdir
 import pandas as pd
-from sqlalchemy import create_engine
+from compact_dtypes import compact_table, concat_tables
+from ingestion_manifest import ingest_files
+from parallel_file_reader import quarantining_map, read_files_or_quarantine
+from sqlite_bulk_load import table_schemas
 
 # This script creates or replaces a table in the database at the supplied
 # path that contains the set of stops for each of five Downtown DASH routes. The
 # source Excel files are hand-crafted and assumed to be perfect.
 
 
-def read_route_stop_data(dir_path):
-  route_stop_data = []
+def read_route_stop_file(file_path):
+  # pandas treats strings as objects
+  df = pd.read_excel(file_path, dtype={
+    'route_id': np.uint32, 'route_name': object, 'stop_id': np.uint32,
+    'stop_name': object, 'latitude': np.float64, 'longitude': np.float64,
+    'heading': object, 'sequence': np.uint8, 'is_terminal': np.bool_})
 
-  for file_name in listdir(dir_path):
-    # we assume that all files exist at the root
-    file_path = path.join(dir_path, file_name)
+  return compact_table(df)
 
-    # pandas treats strings as objects
-    df = pd.read_excel(file_path, dtype={
-      'route_id': np.uint32, 'route_name': object, 'stop_id': np.uint32,
-      'stop_name': object, 'latitude': np.float64, 'longitude': np.float64,
-      'heading': object, 'sequence': np.uint8, 'is_terminal': np.bool_})
-    route_stop_data.append(df)
 
-  route_stop_data = pd.concat(
+def read_route_stop_data(dir_path, process_count=None,
+                         quarantine_path='quarantined_route_stop_files.tsv'):
+  """Read the route stop spreadsheets in dir_path over a pool of process_count
+  workers (one per cpu by default), adding those that cannot be read to the
+  quarantine list at quarantine_path"""
+  # we assume that all files exist at the root
+  route_stop_data = read_files_or_quarantine(
+    [path.join(dir_path, file_name) for file_name in listdir(dir_path)],
+    read_route_stop_file, quarantine_path, process_count)
+
+  if len(route_stop_data) == 0:
+    raise ValueError('no route stop spreadsheets in {} could be read'.format(
+      dir_path))
+
+  route_stop_data = concat_tables(
     route_stop_data, ignore_index=True, verify_integrity=True)
 
   route_stop_data.set_index(
@@ -39,20 +53,21 @@ if __name__ == "__main__":
   parser.add_argument('--route_stop_table_name', default='route_stop')
   parser.add_argument('--data_root_dir', default='route_stops')
   parser.add_argument('--if_exists', default='append')
+  parser.add_argument('--manifest_table_name', default='ingested_file')
+  # by default, the pool will contain one worker per cpu
+  parser.add_argument('--process_count', type=int, default=None)
+  # spreadsheets that cannot be read are listed here and loaded once fixed
+  parser.add_argument(
+    '--quarantine_path', default='quarantined_route_stop_files.tsv')
 
   args = parser.parse_args()
 
-  db_path = path.join('sqlite:///', args.db_path)
-
-  db = create_engine(db_path)
-
-  route_stop_data = read_route_stop_data(args.data_root_dir)
-
-  # print(route_stop_data.head(2))
-  # print(route_stop_data.dtypes)
-
-  # poor performance has been observed when adding more than one million records
-  # at a time
-  route_stop_data.to_sql(
-    args.route_stop_table_name, db, if_exists=args.if_exists,
-    chunksize=1000000, index=False)
+  # only files that are new or changed since they were last loaded are read,
+  # each by a pool worker
+  with Pool(processes=args.process_count) as pool:
+    ingest_files(
+      args.db_path, args.route_stop_table_name, table_schemas['route_stop'],
+      [path.join(args.data_root_dir, file_name)
+       for file_name in listdir(args.data_root_dir)], read_route_stop_file,
+      if_exists=args.if_exists, manifest_table_name=args.manifest_table_name,
+      map_function=quarantining_map(args.quarantine_path, pool.imap))
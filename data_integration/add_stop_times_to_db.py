@@ -1,9 +1,16 @@
 import argparse
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 from os import path, walk
 import pandas as pd
-from sqlalchemy import create_engine
+from shutil import rmtree
+from tempfile import mkdtemp
 from add_route_stops_to_db import read_route_stop_data
+from compact_dtypes import compact_table
+from ingestion_manifest import ingest_files
+from sqlite_bulk_load import table_schemas
+from table_export import export_table
 
 # This script creates or replaces a table in the database at the supplied
 # path that contains the set of stops for each of five Downtown DASH routes
@@ -22,78 +29,239 @@ def find_duplicates(df, index_col='stop_time_id', duplicate_col='route_id'):
 def preprocess_bus_number(elem):
   return elem.split()[-1]
 
-# TODO: convert print statements to log statements
-def read_stop_time_data(data_root_dir):
-  stop_time_data = []
+# the order in which stop times are stored and searched
+sort_column_names = ['route_id', 'vehicle_id', 'arrived_at', 'departed_at']
+
+
+def find_stop_time_files(data_root_dir):
+  """Return the path of the StopTimes export in each directory under
+  data_root_dir that contains files"""
+  file_paths = []
 
   for dir, subdirs, files in walk(data_root_dir):
     # we assume that files only exist at the nodes
     if len(files) > 0:
       # we assume that only one driver schedule file exists in the current dir
-      file_name_indices = [
-        file.find('_StopTimes_') >= 0 for file in files]
+      file_names = [file for file in files if file.find('_StopTimes_') >= 0]
+
+      if len(file_names) > 0:
+        file_paths.append(path.join(dir, file_names[0]))
+      else:
+        print('StopTimes file not found in {}'.format(dir))
+
+  return file_paths
+
 
-      try:
-        file_name_index = file_name_indices.index(True)
+# the columns of StopTimes exports that are read and their types. Timestamps
+# are read as text and parsed separately
+stop_time_columns = [0, 1, 2, 4, 5, 6, 7, 8, 9, 12]
 
-        file_name = files[file_name_index]
+stop_time_dtypes = {
+  'stop_id': object, 'route_id': np.uint32, 'vehicle_id': np.uint16,
+  'arrived_at': object, 'arrival_latitude': np.float64,
+  'arrival_longitude': np.float64, 'departed_at': object,
+  'departure_latitude': np.float64, 'departure_longitude': np.float64,
+  'stop_time_id': np.uint64}
 
-        file_path = path.join(dir, file_name)
 
-        df = pd.read_csv(
-          file_path, sep='\t', usecols=[0, 1, 2, 4, 5, 6, 7, 8, 9, 12],
-          parse_dates=['arrived_at', 'departed_at'], dtype={
-            'stop_id': object, 'route_id': np.uint32, 'vehicle_id': np.uint16,
-            'arrived_at': object, 'arrival_latitude': np.float64,
-            'arrival_longitude': np.float64, 'departed_at': object,
-            'departure_latitude': np.float64, 'departure_longitude': np.float64,
-            'stop_time_id': np.uint64})
+# the format of arrived_at and departed_at in StopTimes exports. A timestamp
+# with fractional seconds also matches it, while one in any other format
+# fails the load
+stop_time_timestamp_format = '%Y-%m-%d %H:%M:%S'
 
-        # convert null stop_ids to a zero value
-        df['stop_id'] = np.array(
-          df['stop_id'].values, dtype=np.float32).astype(np.uint32)
 
-        # print(df.head(2))
-        # print(df.dtypes)
+# the errors raised by a StopTimes export that is missing, truncated or not a
+# tab-separated file, which is skipped. Any other error, e.g. a value that
+# does not fit its column, fails the load rather than dropping the file
+unreadable_file_errors = (
+  OSError, UnicodeDecodeError, pd.errors.EmptyDataError,
+  pd.errors.ParserError)
 
-        stop_time_data.append(df)
-      #TODO: discover and handle distinct exceptions rather than catch all
-      except Exception as e:
-        print(e)
-        continue
 
-  stop_time_data = pd.concat(
-    stop_time_data, ignore_index=True, verify_integrity=True)
+def clean_stop_time_data(df, timestamp_format=stop_time_timestamp_format):
+  """Parse the timestamps of StopTimes records with the given format, or if
+  it is None, with the format of the first timestamp of each column, then
+  narrow their ids and drop records without a key or a stop id"""
+  for column_name in ['arrived_at', 'departed_at']:
+    df[column_name] = pd.to_datetime(
+      df[column_name], format=timestamp_format,
+      infer_datetime_format=timestamp_format is None)
 
-  # count the unique stop_tim_id and compare with the number of records to
-  # identify duplicates (and do it per route in case duplicates occur across
-  # routes but not within a single route - which is okay) we learn that indeed
-  # the stop ids are unique within a given route
-  # ...we don't call this anymore having observed that no duplicates exist (for now)
-  # find_duplicates(stop_time_data)
+  # convert null stop_ids to a zero value. stop_ids are parsed as integers
+  # rather than through float32, which cannot represent every id above 2^24
+  # exactly
+  df['stop_id'] = pd.to_numeric(
+    df['stop_id'], errors='coerce').fillna(0).astype(np.uint32)
 
-  # drop duplicates if found
-  stop_time_data.drop_duplicates(inplace=True)
+  # narrow ids so that the records held in memory are compact
+  df = compact_table(df)
 
   # we temporarily also drop records with missing values to prove our concept.
   # Key attributes that require values include 1) __, 2) route_id,
   # 3) vehicle_id, 4) arrived_at, 5) departed_at, and 6) stop_time_id. For now,
   # we exclude the stop_id because many relevant records have missing stop_ids.
   # TODO: Infer missing values where possible using warning and route data
-  key_column_names = ['route_id', 'vehicle_id', 'arrived_at', 'departed_at']
+  df = df.dropna(subset=sort_column_names)
 
-  stop_time_data.dropna(subset=key_column_names, inplace=True)
+  return df[df['stop_id'] != 0]
 
-  stop_time_data.drop(stop_time_data.query('stop_id == 0').index, inplace=True)
 
-  # we make no assumption about the order in which source files are input
-  stop_time_data.sort_values(
-    ['route_id', 'vehicle_id', 'arrived_at', 'departed_at'], inplace=True)
+# TODO: convert print statements to log statements
+def read_stop_time_chunks(file_path, chunk_size,
+                          timestamp_format=stop_time_timestamp_format):
+  """Yield the cleaned records of a StopTimes export chunk_size records at a
+  time, in the order of the file"""
+  for chunk in pd.read_csv(
+      file_path, sep='\t', usecols=stop_time_columns, dtype=stop_time_dtypes,
+      chunksize=chunk_size):
+    yield clean_stop_time_data(chunk, timestamp_format)
+
+
+def sort_keys(data):
+  """Return the keys by which stop times are sorted as a tuple of int64
+  arrays that compare in the same order"""
+  return (
+    data['route_id'].values.astype(np.int64) << 16
+    | data['vehicle_id'].values.astype(np.int64),
+    data['arrived_at'].values.view(np.int64),
+    data['departed_at'].values.view(np.int64))
+
+
+# a SpilledStopTimes holds the records of a single StopTimes export as sorted
+# runs of at most chunk_size records, each saved as one .npy file per column
+# in a temporary directory. Iterating over it merges the runs in sorted order,
+# reading them through memory maps, and collapses repeated terminal stop
+# records, yielding data frames of about chunk_size records. Since only a
+# window of each run is read at a time, the memory used by a file does not
+# depend on its size. The spill files are removed once the iteration ends.
+class SpilledStopTimes:
+  def __init__(self, spill_dir, column_names, run_lengths, chunk_size,
+               route_stop_data):
+    self.spill_dir = spill_dir
+    self.column_names = column_names
+    self.run_lengths = run_lengths
+    self.chunk_size = chunk_size
+    self.route_stop_data = route_stop_data
+
+  def run_path(self, run_index, column_name):
+    return path.join(self.spill_dir, '{}_{}.npy'.format(run_index, column_name))
+
+  def merge_runs(self):
+    """Yield the records of all runs in sorted order"""
+    runs = [{column_name: np.load(self.run_path(run_index, column_name),
+                                  mmap_mode='r')
+             for column_name in self.column_names}
+            for run_index in range(len(self.run_lengths))]
+    run_lengths = np.array(self.run_lengths, dtype=np.int64)
+    positions = np.zeros(len(runs), dtype=np.int64)
+
+    # read a window of each run at a time so that about chunk_size records
+    # are held in memory at once, but no fewer than 1024 records of each run,
+    # since each window only advances the merge to the least last key of all
+    # windows
+    window_size = max(self.chunk_size // max(len(runs), 1), 1024)
+
+    while (positions < run_lengths).any():
+      window_ends = np.minimum(positions + window_size, run_lengths)
+
+      windows = [pd.DataFrame({
+        column_name: np.asarray(run[column_name][start:end])
+        for column_name in self.column_names})
+        for run, start, end in zip(runs, positions, window_ends)]
+
+      window_keys = [sort_keys(window) for window in windows]
+
+      # every record up to the least of the last keys of the windows of
+      # runs with more records to read precedes all records not yet read
+      bounds = [tuple(int(key[-1]) for key in keys)
+                for keys, end, run_length in zip(
+                  window_keys, window_ends, run_lengths) if end < run_length]
+      bound = min(bounds) if len(bounds) > 0 else None
+
+      merged_windows = []
+
+      for run_index, (window, keys) in enumerate(zip(windows, window_keys)):
+        if bound is None:
+          record_count = window.shape[0]
+        else:
+          pairs, arrivals, departures = keys
+          record_count = np.count_nonzero((pairs < bound[0]) | (
+            (pairs == bound[0]) & ((arrivals < bound[1]) | (
+              (arrivals == bound[1]) & (departures <= bound[2])))))
+
+        merged_windows.append(window.iloc[:record_count])
+        positions[run_index] += record_count
+
+      yield pd.concat(merged_windows, ignore_index=True).sort_values(
+        sort_column_names, kind='mergesort')
+
+  def __iter__(self):
+    terminal_stop_ids = self.route_stop_data.loc[
+      self.route_stop_data['sequence'] == 1, 'stop_id'].unique()
+
+    try:
+      # the trailing terminal stop records of each merged block may continue
+      # in the next, so they are held back and collapsed with it
+      held_records = None
+
+      for block in self.merge_runs():
+        if held_records is not None:
+          block = pd.concat([held_records, block], ignore_index=True)
+
+        is_terminal = block['stop_id'].isin(terminal_stop_ids).values
+        non_terminal_positions = np.flatnonzero(~is_terminal)
+        held_start = non_terminal_positions[-1] + 1 \
+          if non_terminal_positions.shape[0] > 0 else 0
+
+        held_records = block.iloc[held_start:]
+
+        if held_start > 0:
+          yield prune_stop_time_data(
+            block.iloc[:held_start], self.route_stop_data)
+
+      if held_records is not None and held_records.shape[0] > 0:
+        yield prune_stop_time_data(held_records, self.route_stop_data)
+    finally:
+      rmtree(self.spill_dir, ignore_errors=True)
+
+
+def spill_stop_time_file(file_path, route_stop_data, chunk_size,
+                         spill_root_dir=None,
+                         timestamp_format=stop_time_timestamp_format):
+  """Read a StopTimes export chunk_size records at a time in a pool worker,
+  sort each chunk and spill it to a new temporary directory in
+  spill_root_dir (by default, the system's temporary directory). Return the
+  spilled records as a SpilledStopTimes, or None if the file cannot be
+  read."""
+  spill_dir = mkdtemp(prefix='bus_ped_stop_time_', dir=spill_root_dir)
+  spilled_stop_times = SpilledStopTimes(
+    spill_dir, list(stop_time_dtypes), [], chunk_size, route_stop_data)
+
+  try:
+    for run_index, chunk in enumerate(read_stop_time_chunks(
+        file_path, chunk_size, timestamp_format)):
+      chunk = chunk.sort_values(sort_column_names)
+
+      for column_name in spilled_stop_times.column_names:
+        np.save(spilled_stop_times.run_path(run_index, column_name),
+                chunk[column_name].values, allow_pickle=False)
+
+      spilled_stop_times.run_lengths.append(chunk.shape[0])
+  except unreadable_file_errors as e:
+    print('skipping {}, which cannot be read: {}'.format(file_path, e))
+    rmtree(spill_dir, ignore_errors=True)
+    return None
+  except BaseException:
+    rmtree(spill_dir, ignore_errors=True)
+    raise
+
+  print('spilled {} stop times from {} in {} sorted runs'.format(
+    sum(spilled_stop_times.run_lengths), file_path,
+    len(spilled_stop_times.run_lengths)))
+
+  return spilled_stop_times
+
 
-  # reset indices after removing some records
-  stop_time_data.set_index(pd.RangeIndex(stop_time_data.shape[0]), inplace=True)
-  print(stop_time_data.describe())
-  return stop_time_data
 # we must identify terminal stop records and collapse sequences of records of a
 # single terminal into a single record. We extract the set of terminal stops
 # from the 'route_stop' table in the existing database
@@ -103,147 +271,78 @@ def read_stop_time_data(data_root_dir):
 
 
 def prune_stop_time_data(stop_time_data, route_stop_data):
-  terminal_stop_data = route_stop_data.loc[
-    route_stop_data.loc[:, 'sequence'] == 1]
-
-  terminal_stop_time_data = []
+  """Collapse each run of consecutive records of a vehicle on a route at the
+  same terminal stop into a single record that arrives with the first record
+  of the run and departs with the last. Runs are found for all records at
+  once from the differences between the positions and stop ids of
+  consecutive terminal records, so stop_time_data must be sorted by route,
+  vehicle, arrival and departure, as merged by SpilledStopTimes."""
+  terminal_stop_ids = route_stop_data.loc[
+    route_stop_data.loc[:, 'sequence'] == 1, 'stop_id'].unique()
 
   # TODO handle discontinuity at 12AM.
   # do any records have timestamps between 2130 and 0030?
-  for stop_id in terminal_stop_data['stop_id']:
-    terminal_stop_time_data.append(
-      stop_time_data[stop_time_data['stop_id'] == stop_id])
-
-  terminal_stop_time_data = pd.concat(terminal_stop_time_data)
-
-  print('terminal_stop_time_data:\n{}'.format(terminal_stop_time_data.describe()))
-
-  print('stop_time_data pre-drop:\n{}'.format(stop_time_data.describe()))
-
-  # replace original terminal stop records with corrected records
-  # TODO: explain why only 40k records are dropped instad of 70k
-
-  stop_time_data = stop_time_data.drop(terminal_stop_time_data.index)
-
-  print('stop_time_data post-drop:\n{}'.format(stop_time_data.describe()))
-
-  # unidentified_stop_time_data = stop_time_data.loc[
-  #   pd.isnull(stop_time_data.loc[:, 'stop_id'])]
-  #
-  # print('unidentified_stop_time_data:\n{}'.format(unidentified_stop_time_data.describe()))
-  #
-  # # TODO: account for runs that begin at a stop other than the terminal
-  #
-  # combined_stop_time_data = pd.concat(
-  #   [terminal_stop_time_data, unidentified_stop_time_data])
-
-  # order by index so that we can find contiguous sequences
-  terminal_stop_time_data.sort_index(inplace=True)
-
-  # print('combined_stop_time_data:\n{}'.format(combined_stop_time_data.describe()))
-
-  # construct valid terminal stop records
-  #TODO: split the compute across a pool of threads, perhaps per time unit
-  collapsed_terminal_stop_time_data = []
+  is_terminal = stop_time_data['stop_id'].isin(terminal_stop_ids).values
+  terminal_positions = np.flatnonzero(is_terminal)
 
-  count = 1
-  seq_len = 1
+  # there are no runs of terminal records to collapse
+  if terminal_positions.shape[0] == 0:
+    return stop_time_data
 
-  head_record = terminal_stop_time_data.iloc[0]
-  head_index = terminal_stop_time_data.index[0]
+  terminal_stop_time_data = stop_time_data.iloc[terminal_positions]
 
-  # ensure head_record is never a BLANK
-  while head_record.loc['stop_id'].squeeze() == 0 \
-      and count < terminal_stop_time_data.shape[0]:
-    head_record = terminal_stop_time_data.iloc[count]
-
-    count += 1
-
-  tail_record = head_record
-  tail_index = head_index
-
-  while count < terminal_stop_time_data.shape[0]:
-    current_record = terminal_stop_time_data.iloc[count]
-
-    # TODO: infer stop_ids from records with null stop ids (but skip them for now)
-    while current_record.loc['stop_id'].squeeze() == 0 \
-        and count < terminal_stop_time_data.shape[0] - 1:
-      seq_len += 1
-
-      count += 1
-
-      current_record = terminal_stop_time_data.iloc[count]
-
-    current_index = terminal_stop_time_data.index[count]
-
-    if current_index == head_index + seq_len \
-        and current_record.loc['stop_id'].squeeze() == \
-        head_record.loc['stop_id'].squeeze():
-      tail_record = current_record
-
-      tail_index = current_index
-
-      seq_len += 1
-    else:
-      if head_index == tail_index:
-        # no use in performing unnecessary computation
-        collapsed_terminal_stop_time_data.append(head_record)
-      else:
-        result_record = pd.Series(head_record)
-
-        result_record.loc[
-          ['departed_at', 'departure_latitude', 'departure_longitude']
-        ] = tail_record.loc[
-          ['departed_at', 'departure_latitude', 'departure_longitude']]
-
-        collapsed_terminal_stop_time_data.append(result_record)
-
-      head_record = current_record
-      head_index = current_index
-
-      tail_record = current_record
-      tail_index = current_index
+  print('terminal_stop_time_data:\n{}'.format(terminal_stop_time_data.describe()))
 
-      seq_len = 1
+  # a run starts at each terminal record that does not directly follow a
+  # record of the same terminal stop, route and vehicle
+  is_run_start = np.zeros(terminal_positions.shape[0], dtype=np.bool_)
+  is_run_start[:1] = True
 
-    count += 1
+  for column_name in ['stop_id', 'route_id', 'vehicle_id']:
+    values = terminal_stop_time_data[column_name].values
+    is_run_start[1:] |= values[1:] != values[:-1]
 
-  print('count: {}'.format(count))
+  is_run_start[1:] |= np.diff(terminal_positions) != 1
 
-  collapsed_terminal_stop_time_data = pd.DataFrame(
-    collapsed_terminal_stop_time_data)
+  run_starts = np.flatnonzero(is_run_start)
+  run_ends = np.append(run_starts[1:], terminal_positions.shape[0])
 
-  print('collapsed_terminal_stop_time_data:\n{}'.format(
-    collapsed_terminal_stop_time_data.describe()))
+  # construct valid terminal stop records from the head record of each run,
+  # with the departure of its tail record
+  collapsed_terminal_stop_time_data = \
+    terminal_stop_time_data.iloc[run_starts].copy()
 
-  # reset indices after removing some records
-  # stop_time_data.set_index(pd.RangeIndex(stop_time_data.shape[0]), inplace=True)
+  departure_column_names = [
+    'departed_at', 'departure_latitude', 'departure_longitude']
 
-  # print('stop_time_data pre-append:\n{}'.format(stop_time_data.describe()))
+  for column_name in departure_column_names:
+    collapsed_terminal_stop_time_data[column_name] = \
+      terminal_stop_time_data[column_name].values[run_ends - 1]
 
-  stop_time_data = stop_time_data.append(
-    collapsed_terminal_stop_time_data, ignore_index=True)
+  print('collapsed {} terminal stop records into {}'.format(
+    terminal_positions.shape[0], run_starts.shape[0]))
 
-  print('stop_time_data post-append:\n{}'.format(stop_time_data.describe()))
+  # replace original terminal stop records with collapsed records and place
+  # the collapsed records into their original positions
+  stop_time_data = pd.concat([
+    stop_time_data[~is_terminal], collapsed_terminal_stop_time_data])
 
-  # place the collapsed records just appended into their original positions
   stop_time_data.sort_values(
     ['route_id', 'vehicle_id', 'arrived_at', 'departed_at'], inplace=True)
 
   # reset indices (even though they will not make their way into the db)
   stop_time_data.set_index(pd.RangeIndex(stop_time_data.shape[0]), inplace=True)
 
+  print('stop_time_data post-collapse:\n{}'.format(stop_time_data.describe()))
+
   return stop_time_data
 
 
 def output_to_excel(data_root_dir, stop_time_data):
-  # write outpur to Excel for inspection
-  excel_writer = pd.ExcelWriter(
-    path.join(data_root_dir, 'processed_stop_times.xlsx'))
-
-  stop_time_data.to_excel(excel_writer, 'StopTimes', index=False)
-
-  excel_writer.save()
+  # write output to Excel for inspection, over as many sheets as needed
+  return export_table(
+    stop_time_data, path.join(data_root_dir, 'processed_stop_times.xlsx'),
+    sheet_name='StopTimes')
 
 
 if __name__ == "__main__":
@@ -258,22 +357,46 @@ if __name__ == "__main__":
   parser.add_argument(
     '--root_route_stop_data_dir', default='route_stops')
   parser.add_argument('--if_exists', default='append')
+  # by default, the pool will contain one worker per cpu
+  parser.add_argument('--process_count', type=int, default=None)
+  parser.add_argument('--manifest_table_name', default='ingested_file')
+  # each export is read and sorted chunk_size records at a time, with sorted
+  # chunks spilled to a temporary directory in --spill_dir (by default, the
+  # system's temporary directory) and merged as they are written, so that
+  # the memory used does not depend on the size or number of exports
+  parser.add_argument('--chunk_size', type=int, default=250000)
+  parser.add_argument('--spill_dir', default=None)
+  # the strptime format of arrived_at and departed_at. With
+  # --infer_timestamp_format, the format is instead inferred from the first
+  # timestamp of each chunk, so the chunks of an export whose day and month
+  # are ambiguous may be parsed differently
+  parser.add_argument(
+    '--timestamp_format', default=stop_time_timestamp_format)
+  parser.add_argument('--infer_timestamp_format', action='store_true')
 
   args = parser.parse_args()
 
-  db_path = 'sqlite:///' + args.db_path
-
-  db = create_engine(db_path)
-
-  stop_time_data = read_stop_time_data(args.root_stop_time_data_dir)
+  if args.infer_timestamp_format:
+    args.timestamp_format = None
 
   # read route stops to get terminal stop ids
-  route_stop_data = read_route_stop_data(args.root_route_stop_data_dir)
-
-  # stop_time_data = prune_stop_time_data(stop_time_data, route_stop_data)
-
-  # poor performance has been observed when adding more than one million records
-  # at a time
-  stop_time_data.to_sql(
-    args.stop_event_table_name, db, if_exists=args.if_exists, chunksize=1000000,
-    index=False)
+  route_stop_data = read_route_stop_data(
+    args.root_route_stop_data_dir, args.process_count)
+
+  # only files that are new or changed since they were last loaded are read,
+  # each by a pool worker that sorts and spills it. The spilled records are
+  # merged, the repeated records of buses that wait at a terminal are
+  # collapsed, and the results are written as they are merged. Stop times
+  # exported more than once share a (route_id, stop_time_id), the primary key
+  # of the table, and are stored once. The data product generator looks up
+  # stop times by route, vehicle and time using an index on the table rather
+  # than relying on the order in which records are written
+  with Pool(processes=args.process_count) as pool:
+    ingest_files(
+      args.db_path, args.stop_event_table_name, table_schemas['stop_time'],
+      find_stop_time_files(args.root_stop_time_data_dir),
+      partial(spill_stop_time_file, route_stop_data=route_stop_data,
+              chunk_size=args.chunk_size, spill_root_dir=args.spill_dir,
+              timestamp_format=args.timestamp_format),
+      if_exists=args.if_exists, manifest_table_name=args.manifest_table_name,
+      map_function=pool.imap)
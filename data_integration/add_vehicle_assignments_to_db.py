@@ -14,59 +14,58 @@ import argparse
 import numpy as np
 from os import path, walk
 import pandas as pd
-from sqlalchemy import create_engine
+from compact_dtypes import compact_table
+from ingestion_manifest import ingest_files
+from sqlite_bulk_load import table_schemas
 
 
-def read_vehicle_assignment_data(data_root_dir):
-  vehicle_assignment_data = []
-
-  num = 0
+def find_vehicle_assignment_files(data_root_dir):
+  """Return the path of the VehiclesThatRanRoute export in each directory
+  under data_root_dir that contains files"""
+  file_paths = []
 
   for dir, subdirs, files in walk(data_root_dir):
     # we assume that files only exist at the nodes
     if len(files) > 0:
       # we assume that only one driver schedule file exists in the current dir
-      try:
-        file_name_indices = [
-          file.find('_VehiclesThatRanRoute_') >= 0 for file in files]
-
-        file_name_index = file_name_indices.index(True)
-        file_name = files[file_name_index]
-        file_path = path.join(dir, file_name)
-
-        # forget using np.unicode_ for strings since pandas treats them as objects
-        # we can specify the data type since none of the values are null
-        df = pd.read_table(
-          file_path, usecols=[0, 1, 2, 3, 5, 6, 11, 12, 13, 14],
-          header=None, skiprows=[0], parse_dates=['start_time', 'end_time'],
-          names=['vehicle_assignment_id', 'vehicle_id', 'route_id', 'driver_id',
-                 'start_time', 'end_time', 'bus_number', 'first_name',
-                 'last_name', 'badge_number'],
-          dtype={'vehicle_assignment_id': object, 'vehicle_id': object,
-                 'route_id': object, 'driver_id': object,
-                 'start_time': object, 'end_time': object,
-                 'bus_number': object, 'first_name': object,
-                 'last_name': object, 'badge_number': object})
-
-        print(df.head(2))
-        print(df.dtypes)
-
-        vehicle_assignment_data.append(df)
-
-        num += 1
-      except Exception as e:
+      file_names = [
+        file for file in files if file.find('_VehiclesThatRanRoute_') >= 0]
+
+      if len(file_names) > 0:
+        file_paths.append(path.join(dir, file_names[0]))
+      else:
         print('Driver schedule file not found in {}'.format(dir))
-        print(e)
-        continue
 
-  vehicle_assignment_data = pd.concat(
-    vehicle_assignment_data, ignore_index=True)
+  return file_paths
+
+
+def read_vehicle_assignment_file(file_path):
+  """Parse and clean a single VehiclesThatRanRoute export, or return None if
+  it cannot be read"""
+  try:
+    # forget using np.unicode_ for strings since pandas treats them as objects
+    # we can specify the data type since none of the values are null
+    df = pd.read_table(
+      file_path, usecols=[0, 1, 2, 3, 5, 6, 11, 12, 13, 14],
+      header=None, skiprows=[0], parse_dates=['start_time', 'end_time'],
+      names=['vehicle_assignment_id', 'vehicle_id', 'route_id', 'driver_id',
+             'start_time', 'end_time', 'bus_number', 'first_name',
+             'last_name', 'badge_number'],
+      dtype={'vehicle_assignment_id': object, 'vehicle_id': object,
+             'route_id': object, 'driver_id': object,
+             'start_time': object, 'end_time': object,
+             'bus_number': object, 'first_name': object,
+             'last_name': object, 'badge_number': object})
+  except Exception as e:
+    print('Driver schedule file {} could not be read'.format(file_path))
+    print(e)
+    return None
+
+  print(df.head(2))
+  print(df.dtypes)
 
-  print('concatenated {} vehicle assignmens from {} files'.format(
-    vehicle_assignment_data.shape[0], num))
-  # records of runs that span two days may appear once for each day depending on
-  # how the Excel exports were preformed, and should be dropped
-  vehicle_assignment_data.drop_duplicates(inplace=True)
+  # drop records that are repeated within the export
+  df.drop_duplicates(inplace=True)
 
   # we temporarily also drop records with missing values to prove our concept.
   # Key attributes that require values include 1) vehicle_assessment_id,
@@ -76,38 +75,25 @@ def read_vehicle_assignment_data(data_root_dir):
   key_column_names = ['vehicle_assignment_id', 'vehicle_id', 'bus_number',
                       'driver_id', 'start_time', 'end_time']
 
-  vehicle_assignment_data.dropna(subset=key_column_names, inplace=True)
+  df.dropna(subset=key_column_names, inplace=True)
 
   # TODO: verify that overlaps occur only between two different drivers
-  vehicle_assignment_data.drop(
-    vehicle_assignment_data.query('start_time > end_time').index, inplace=True)
+  df.drop(df.query('start_time > end_time').index, inplace=True)
 
-  vehicle_assignment_data.drop(vehicle_assignment_data.query(
+  df.drop(df.query(
       '\'Test\' in bus_number or \'Test\' in first_name or \'Test\' in '
       'last_name').index, inplace=True)
 
-  vehicle_assignment_data.loc[:, 'vehicle_assignment_id'] = vehicle_assignment_data.loc[:, 'vehicle_assignment_id'].astype(
-    np.uint64)
-  vehicle_assignment_data.loc[:, 'vehicle_id'] = vehicle_assignment_data.loc[:, 'vehicle_id'].astype(np.uint32)
-  vehicle_assignment_data.loc[:, 'route_id'] = vehicle_assignment_data.loc[:, 'route_id'].astype(np.uint32)
-  vehicle_assignment_data.loc[:, 'driver_id'] = vehicle_assignment_data.loc[:, 'driver_id'].astype(np.uint32)
-  vehicle_assignment_data.loc[:, 'bus_number'] = vehicle_assignment_data.loc[:, 'bus_number'].astype(np.uint32)
-  vehicle_assignment_data.loc[:, 'badge_number'] = vehicle_assignment_data.loc[:, 'badge_number'].astype(np.uint32)
+  # convert ids to the narrowest integer types that hold them and driver names
+  # to categoricals, now that test records are gone
+  df = compact_table(df)
 
   # we make no assumption about the order in which source xlsx files are input
-  vehicle_assignment_data.sort_values(['start_time', 'end_time'], inplace=True)
-
-  # after removing duplicate records, vehicle_assignment_ids will be unique and
-  # can be used as the primary key of the vehicle_assignment table. Because we
-  # don't yet know how this results in a SQLite PK, just reset the indices for now
-  # vehicle_assignment_data.set_index('vehicle_assignment_id', inplace=True)
-  vehicle_assignment_data.set_index(
-    pd.RangeIndex(vehicle_assignment_data.shape[0]), inplace=True)
+  df.sort_values(['start_time', 'end_time'], inplace=True)
 
-  print(vehicle_assignment_data.describe())
-  print(df.dtypes)
+  df.set_index(pd.RangeIndex(df.shape[0]), inplace=True)
 
-  return vehicle_assignment_data
+  return df
 
 
 if __name__ == "__main__":
@@ -118,17 +104,18 @@ if __name__ == "__main__":
                       default='vehicle_assignment')
   parser.add_argument('--data_root_dir', default='data_sources')
   parser.add_argument('--if_exists', default='append')
+  parser.add_argument('--manifest_table_name', default='ingested_file')
 
   args = parser.parse_args()
 
-  db_path = path.join('sqlite:///', args.db_path)
-
-  db = create_engine(db_path)
-
-  vehicle_assignment_data = read_vehicle_assignment_data(args.data_root_dir)
-
-  # poor performance has been observed when adding more than one million records
-  # at a time
-  vehicle_assignment_data.to_sql(
-    args.vehicle_assignment_table_name, db, if_exists=args.if_exists,
-    chunksize=1000000, index=False)
+  # only files that are new or changed since they were last loaded are read.
+  # Runs that appear in the exports of two days share a vehicle_assignment_id,
+  # the primary key of the table, and are stored once. The data product
+  # generator looks up driver assignments by route and time using an index
+  # that is built once the records are loaded
+  ingest_files(
+    args.db_path, args.vehicle_assignment_table_name,
+    table_schemas['vehicle_assignment'],
+    find_vehicle_assignment_files(args.data_root_dir),
+    read_vehicle_assignment_file, if_exists=args.if_exists,
+    manifest_table_name=args.manifest_table_name)
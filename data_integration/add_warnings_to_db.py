@@ -11,115 +11,112 @@
 # read vehicle_assignment_id values into an array, count the unique array
 # entries and compare for equality with the array length.
 import argparse
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 from os import path, listdir
 import pandas as pd
-from sqlalchemy import create_engine
+from compact_dtypes import compact_table, warning_names
+from conversion_cache import read_converted_file
+from ingestion_manifest import ingest_files
+from parallel_file_reader import quarantining_map
+from sqlite_bulk_load import table_schemas
+from table_export import export_table
 
 
 def write_warning_data_to_excel(data, file_name='unassigned_warnings'):
-  from math import ceil
+  """Export warnings to file_name.xlsx, one sheet per 1,048,575 records"""
+  return export_table(data, file_name + '.xlsx', sheet_name='warnings')
 
-  excel_writer = pd.ExcelWriter(file_name + '.xlsx')
 
-  chunk_size = pow(2, 20) - 1
+# the columns read from each layout of Ituran warning spreadsheet, keyed by
+# whether warning names carry a StatusTimeOpen suffix. Both skip the Ituran
+# header (first 7 rows)
+warning_column_names = [
+  'loc_time', 'bus_number', 'address', 'warning_name', 'latitude', 'longitude']
 
-  idx_limit = data.shape[0]
+warning_columns_to_use = {
+  # loc_time (0), Vehicle Name (1), Address (3), warning_name (4),
+  # Latitude (5) and Longitude (6)
+  False: [0, 1, 3, 4, 5, 6],
+  # loc_time (0), Vehicle Name (2), Address (7), warning_name (9),
+  # Latitude (11) and Longitude (12)
+  True: [0, 2, 7, 9, 11, 12]}
 
-  for i in range(int(ceil(idx_limit / chunk_size))):
-    chunk = data.iloc[i * chunk_size:max((i + 1) * chunk_size, idx_limit)]
 
-    print('{}_th chunk_data:\n{}\n{}\n'.format(i, chunk.describe(), chunk.head()))
+def clean_warning_data(df, status_time_open=False):
+  """Return the cleaned records of those read from an Ituran warning
+  spreadsheet. If status_time_open is True, the StatusTimeOpen suffix of
+  warning names is removed and warnings of types other than those in
+  warning_names are dropped; otherwise warnings at 'Last known:' addresses
+  are dropped."""
+  is_kept = df['loc_time'].notnull() & df['bus_number'].notnull()
 
-    chunk.to_excel(excel_writer, 'warnings_{}'.format(i), index=False)
+  if not status_time_open:
+    is_kept &= ~df['address'].str.contains(
+      'Last known:', regex=False, na=False)
 
-  excel_writer.save()
+  df = df[is_kept].copy()
 
+  if status_time_open:
+    df['warning_name'] = df['warning_name'].str.split(
+      ' - StatusTimeOpen:', n=1).str[0]
 
-def preprocess_bus_number(elem):
-  return elem.split()[-1]
+  # bus numbers are the last word of vehicle names
+  df['bus_number'] = df['bus_number'].astype(str).str.extract(
+    r'(\S+)\s*$', expand=False)
 
+  df = df.astype({'latitude': np.float64, 'longitude': np.float64})
 
-def read_warning_data(data_dir):
-  #assume that the warnings folder only has warning spreadsheet files as children
-  warning_data = []
+  # names that are not among the given categories become missing values, so
+  # warnings of unknown types are dropped with those missing a name
+  df = compact_table(df, categories={
+    'warning_name': warning_names} if status_time_open else None)
 
-  rows_to_skip = [0, 1, 2, 3, 4, 5, 6, 7]
-  cols_to_use = [0, 1, 3, 4, 5, 6]
-  dtypes = {0: object, 1: object, 3: object, 4: object, 5: object, 6: object}
+  df.dropna(subset=['warning_name'], inplace=True)
 
-  for file_name in listdir(data_dir):
-    try:
-      file_path = path.join(data_dir, file_name)
+  return df
 
-      # only read columns loc_time (0), Vehicle Name (2), Address (7),
-      # warning_name (9), Latitude (11), Longitude (12), and skip the Ituran header
-      # (first 7 rows)
-      df = pd.read_excel(
-        file_path, skiprows=rows_to_skip, usecols=cols_to_use,
-        names=['loc_time', 'bus_number', 'address', 'warning_name', 'latitude',
-               'longitude'], header=None, parse_dates=[0], dtype=dtypes)
-      # print(df.describe())
-      # print(df.head().loc[:, 'warning_name'])
-      df.drop(df.query('address.str.contains(\'Last known:\')',
-                       engine='python').index, inplace=True)
 
-      df.loc[:, 'bus_number'] = df.loc[:, 'bus_number'].apply(
-        preprocess_bus_number).astype(np.uint32)
-      # print(df.head().loc[:, 'warning_name'])
+def read_warning_file(file_path, status_time_open=False):
+  """Parse and clean a single Ituran warning spreadsheet, with StatusTimeOpen
+  warning names if status_time_open is True"""
+  df = pd.read_excel(
+    file_path, skiprows=[0, 1, 2, 3, 4, 5, 6, 7],
+    usecols=warning_columns_to_use[status_time_open],
+    names=warning_column_names, header=None, parse_dates=[0],
+    dtype={column_name: object for column_name in warning_column_names[1:]})
 
-      df.loc[:, 'latitude'] = df.loc[:, 'latitude'].astype(np.float64)
-      # print(df.head().loc[:, 'warning_name'])
+  df = clean_warning_data(df, status_time_open)
 
-      df.loc[:, 'longitude'] = df.loc[:, 'longitude'].astype(np.float64)
-      # print(df.head().loc[:, 'warning_name'])
+  print(df.head(2))
+  print(df.dtypes)
 
-      df.dropna(subset=['warning_name', 'loc_time'], inplace=True)
-      # print(df.describe())
-      # print(df.head().loc[:, 'warning_name'])
-
-      print(df.head(2))
-      print(df.dtypes)
-
-      warning_data.append(df)
-    except Exception as e:
-      print(e)
-      print(file_name)
-      exit()
-
-  warning_data = pd.concat(
-    warning_data, ignore_index=True, verify_integrity=True)
+  # drop duplicates if found
+  df.drop_duplicates(inplace=True)
 
-  print('init warning_data:\n{}'.format(warning_data.describe()))
+  # we make no assumption about the order of records within a file
+  df.sort_values(['loc_time', 'bus_number'], inplace=True)
 
-  # count the unique stop_tim_id and compare with the number of records to
-  # identify duplicates (and do it per route in case duplicates occur across
-  # routes but not within a single route - which is okay) we learn that indeed
-  # the stop ids are unique within a given route
-  # find_duplicates(warning_data)
+  df.set_index(pd.RangeIndex(df.shape[0]), inplace=True)
 
-  # drop duplicates if found
-  warning_data.drop_duplicates(inplace=True)
+  return df
 
-  print('de-duplicated warning_data:\n{}'.format(warning_data.describe()))
-  print('\n{}'.format(warning_data.head()))
 
-  # we temporarily also drop records with missing values to prove our concept.
-  # Key attributes that require values include 1) __, 2) route_id,
-  # 3) vehicle_id, 4) arrived_at, 5) departed_at, and 6) stop_time_id. For now,
-  # we exclude the stop_id because many relevant records have missing stop_ids.
-  # TODO: Infer missing values where possible using warning and route data
-  # key_column_names = ['route_id', 'vehicle_id', 'arrived_at', 'departed_at']
-  #
-  # warning_data.dropna(subset=key_column_names, inplace=True)
+def warning_file_reader(cache_dir=None, status_time_open=False):
+  """Return a function that reads a warning spreadsheet as read_warning_file
+  does, from the cache in cache_dir if given"""
+  read_file = partial(read_warning_file, status_time_open=status_time_open)
 
-  # we make no assumption about the order in which source files are input
-  warning_data.sort_values(['loc_time', 'bus_number'], inplace=True)
+  if cache_dir is None:
+    return read_file
 
-  # reset indices after sorting records
-  warning_data.set_index(pd.RangeIndex(warning_data.shape[0]), inplace=True)
+  # spreadsheets with StatusTimeOpen warning names are cleaned differently, so
+  # their records are cached separately
+  if status_time_open:
+    cache_dir = path.join(cache_dir, 'status_time_open')
 
-  return warning_data
+  return partial(read_converted_file, read_file=read_file, cache_dir=cache_dir)
 
 
 if __name__ == "__main__":
@@ -129,13 +126,29 @@ if __name__ == "__main__":
   parser.add_argument('--warning_table_name', default='warning')
   parser.add_argument('--warning_data_dir', default='warnings')
   parser.add_argument('--if_exists', default='append')
+  parser.add_argument('--manifest_table_name', default='ingested_file')
+  # the cleaned columns of each spreadsheet are cached here so that a
+  # spreadsheet is parsed again only if it changes (see conversion_cache.py)
+  parser.add_argument('--cache_dir', default='converted_warnings')
+  # read spreadsheets whose warning names have a StatusTimeOpen suffix
+  parser.add_argument('--status_time_open', action='store_true')
+  # by default, the pool will contain one worker per cpu
+  parser.add_argument('--process_count', type=int, default=None)
+  # spreadsheets that cannot be read are listed here and loaded once fixed
+  parser.add_argument(
+    '--quarantine_path', default='quarantined_warning_files.tsv')
 
   args = parser.parse_args()
 
-  db = create_engine('sqlite:///' + args.db_path)
-
-  warning_data = read_warning_data(args.warning_data_dir)
-  # poor performance has been observed when adding more than one million records
-  # at a time
-  warning_data.to_sql(args.warning_table_name, db, if_exists=args.if_exists,
-                      chunksize=1000000, index=False)
\ No newline at end of file
+  # only files that are new or changed since they were last loaded are read,
+  # each by a pool worker, and the records previously loaded from a changed
+  # file are replaced. The data product generator looks up warnings by bus and
+  # time using an index that is built once the records are loaded
+  with Pool(processes=args.process_count) as pool:
+    ingest_files(
+      args.db_path, args.warning_table_name, table_schemas['warning'],
+      [path.join(args.warning_data_dir, file_name)
+       for file_name in listdir(args.warning_data_dir)],
+      warning_file_reader(args.cache_dir, args.status_time_open),
+      if_exists=args.if_exists, manifest_table_name=args.manifest_table_name,
+      map_function=quarantining_map(args.quarantine_path, pool.imap))
@@ -0,0 +1,412 @@
+import argparse
+from datetime import datetime
+from functools import partial
+from importlib.util import find_spec
+import json
+from multiprocessing import cpu_count, Pool, Process, Queue
+import numpy as np
+from os import listdir, makedirs, path, remove
+import pandas as pd
+import platform
+import resource
+from shutil import rmtree
+from sqlalchemy import create_engine
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+from add_route_stops_to_db import read_route_stop_file
+from add_stop_times_to_db import find_stop_time_files, spill_stop_time_file
+from add_vehicle_assignments_to_db import find_vehicle_assignment_files, \
+  read_vehicle_assignment_file
+from add_warnings_to_db import read_warning_file
+from compact_dtypes import compact_table
+from generate_data_product_from_db import assign_warnings_to_trips, \
+  concatenate_trip_tables, construct_hotspot_data_product, \
+  construct_longitudinal_data_product, construct_trip_list, StopTimeIndex
+from generate_synthetic_data import generate_synthetic_tables, \
+  write_synthetic_tables
+from ingestion_manifest import ingest_files
+from sqlite_bulk_load import table_schemas
+
+# This script measures the data product pipeline end to end on synthetic data
+# from generate_synthetic_data.py at each of several sizes, given as numbers
+# of days of service, and writes the results to a JSON file so that runs on
+# different revisions or machines can be compared.
+#
+# For each size, the following phases are timed in order:
+#   export_sources: writing the synthetic tables as the exports that the
+#     add_*_to_db.py loaders read, one export of each kind per day
+#   ingest_route_stop, ingest_stop_time, ingest_vehicle_assignment and
+#     ingest_warning: loading each kind of export into a new database with the
+#     reader of its loader through ingestion_manifest.ingest_files(), over a
+#     pool of workers where the loader uses one
+#   read: reading the loaded tables back into data frames
+#   construct_trip_list: identifying the trips of every driver assignment in
+#     the current process, including sorting the stop times
+#   assign_warnings_to_trips: identifying trips and assigning warnings to them
+#     over a pool of workers, as generate_data_product_from_db.py does
+#   longitudinal_data_product and hotspot_data_product: building each product
+#     from the assigned trips
+#
+# Each size runs in its own process so that peak resident set sizes are not
+# carried over from one size to the next. Since the peak of a process only
+# grows, the peak recorded for a phase is the peak of all phases up to and
+# including it. Pool workers are measured separately as the peak of the
+# largest worker.
+#
+# Route stops and warnings are exported as Excel spreadsheets, which cannot be
+# written without openpyxl. If it is not installed, these two tables are
+# written to the database directly in a write_route_stop_and_warning phase in
+# place of their ingest phases.
+
+# the columns of each kind of export in the order in which the loaders read
+# them, with None for columns that they skip
+stop_time_export_columns = [
+  'stop_id', 'route_id', 'vehicle_id', None, 'arrived_at', 'arrival_latitude',
+  'arrival_longitude', 'departed_at', 'departure_latitude',
+  'departure_longitude', None, None, 'stop_time_id']
+
+vehicle_assignment_export_columns = [
+  'vehicle_assignment_id', 'vehicle_id', 'route_id', 'driver_id', None,
+  'start_time', 'end_time', None, None, None, None, 'bus_number',
+  'first_name', 'last_name', 'badge_number']
+
+warning_export_columns = [
+  'loc_time', 'bus_number', None, 'address', 'warning_name', 'latitude',
+  'longitude']
+
+# the number of rows of the Ituran header of warning spreadsheets
+warning_header_row_count = 8
+
+
+def peak_rss_mib(who):
+  """Return the peak resident set size of the current process
+  (resource.RUSAGE_SELF) or of its largest terminated child
+  (resource.RUSAGE_CHILDREN) in MiB"""
+  peak_rss = resource.getrusage(who).ru_maxrss
+
+  # ru_maxrss is reported in bytes on macOS and in KiB elsewhere
+  if sys.platform == 'darwin':
+    peak_rss /= 1024
+
+  return peak_rss / 1024
+
+
+class PhaseTimer:
+  """Collect the duration, throughput and peak memory use of each phase of a
+  benchmark run"""
+  def __init__(self):
+    self.phases = []
+
+  def time(self, phase_name, function, record_count=None):
+    """Call function, then record its duration along with the number of
+    records it processed, which is either given or computed from its result by
+    record_count, and return its result"""
+    start_time = perf_counter()
+    result = function()
+    seconds = perf_counter() - start_time
+
+    if callable(record_count):
+      record_count = record_count(result)
+
+    self.phases.append({
+      'phase': phase_name,
+      'seconds': seconds,
+      'records': record_count,
+      'records_per_second':
+        record_count / seconds if record_count is not None and seconds > 0
+        else None,
+      'peak_rss_mib': peak_rss_mib(resource.RUSAGE_SELF),
+      'peak_worker_rss_mib': peak_rss_mib(resource.RUSAGE_CHILDREN)})
+
+    print('{} took {:.3f}s for {} records'.format(
+      phase_name, seconds, record_count))
+
+    return result
+
+
+def construct_all_trip_lists(route_stop_df, stop_time_df, vehicle_assignment_df):
+  """Identify the trips of every driver assignment serially, without assigning
+  warnings, and return them in a TripTable"""
+  stop_time_index = StopTimeIndex(stop_time_df)
+
+  route_stops = {
+    route_id: route_stops.sort_values(['heading', 'sequence']).set_index(
+      pd.RangeIndex(route_stops.shape[0]))
+    for route_id, route_stops in route_stop_df.groupby('route_id')}
+
+  trip_tables = []
+
+  for start_time, end_time, bus_number, route_id, driver_id, vehicle_id, \
+      vehicle_assignment_id in zip(
+        vehicle_assignment_df['start_time'], vehicle_assignment_df['end_time'],
+        vehicle_assignment_df['bus_number'], vehicle_assignment_df['route_id'],
+        vehicle_assignment_df['driver_id'], vehicle_assignment_df['vehicle_id'],
+        vehicle_assignment_df['vehicle_assignment_id']):
+    if route_id in route_stops:
+      trip_tables.append(construct_trip_list(
+        route_stops[route_id], stop_time_index, stop_time_index.find_rows(
+          route_id, vehicle_id, start_time, end_time), driver_id, bus_number,
+        vehicle_assignment_id))
+
+  return concatenate_trip_tables(trip_tables)
+
+
+def export_layout(data, column_names):
+  """Return the given columns of data in order, with an empty column in place
+  of each None"""
+  return pd.DataFrame({
+    'unused_{}'.format(column_index) if column_name is None else column_name:
+      '' if column_name is None else data[column_name].values
+    for column_index, column_name in enumerate(column_names)})
+
+
+def daily_exports(data, time_column_name):
+  """Yield the date and records of each day of the given records"""
+  days = data[time_column_name].dt.strftime('%Y-%m-%d').values
+
+  for day in np.unique(days):
+    yield day, data[days == day]
+
+
+def write_source_exports(source_dir, tables, excel_sources):
+  """Write the tables returned by generate_synthetic_tables() to source_dir as
+  the exports read by the add_*_to_db.py loaders: a StopTimes and a
+  VehiclesThatRanRoute export per day, in directories of their own, and if
+  excel_sources is True, a route stop spreadsheet and a warning spreadsheet
+  per day. Return the number of records written."""
+  record_count = 0
+
+  for day, data in daily_exports(tables['stop_time'], 'arrived_at'):
+    day_dir = path.join(source_dir, 'stop_times', day)
+    makedirs(day_dir)
+
+    export_layout(data, stop_time_export_columns).to_csv(
+      path.join(day_dir, 'DASH_StopTimes_{}.txt'.format(day)), sep='\t',
+      index=False)
+
+    record_count += data.shape[0]
+
+  for day, data in daily_exports(tables['vehicle_assignment'], 'start_time'):
+    day_dir = path.join(source_dir, 'vehicle_assignments', day)
+    makedirs(day_dir)
+
+    export_layout(data, vehicle_assignment_export_columns).to_csv(
+      path.join(day_dir, 'DASH_VehiclesThatRanRoute_{}.txt'.format(day)),
+      sep='\t', index=False)
+
+    record_count += data.shape[0]
+
+  if excel_sources:
+    makedirs(path.join(source_dir, 'route_stops'))
+
+    tables['route_stop'].to_excel(
+      path.join(source_dir, 'route_stops', 'route_stops.xlsx'), index=False)
+
+    record_count += tables['route_stop'].shape[0]
+
+    makedirs(path.join(source_dir, 'warnings'))
+
+    # warning spreadsheets name buses as vehicles, below the Ituran header
+    warning_data = tables['warning'].assign(
+      bus_number='DASH ' + tables['warning']['bus_number'].astype(str))
+
+    for day, data in daily_exports(warning_data, 'loc_time'):
+      with pd.ExcelWriter(path.join(
+          source_dir, 'warnings', 'warnings_{}.xlsx'.format(day))) as writer:
+        pd.DataFrame([['Ituran warning report']]).to_excel(
+          writer, header=False, index=False)
+        export_layout(data, warning_export_columns).to_excel(
+          writer, startrow=warning_header_row_count, header=False,
+          index=False)
+
+      record_count += data.shape[0]
+
+  return record_count
+
+
+def ingest_sources(db_path, table_name, file_paths, read_file, process_count):
+  """Load the given exports into the given table with read_file over a pool
+  of process_count workers, as the loader of the table does"""
+  with Pool(processes=process_count) as pool:
+    return ingest_files(db_path, table_name, table_schemas[table_name],
+                        file_paths, read_file, map_function=pool.imap)
+
+
+def run_benchmark(db_path, generator_arguments, process_count, batch_size,
+                  chunk_size):
+  """Generate synthetic data with the given arguments, run each phase of the
+  pipeline on it using a database at db_path, and return the results"""
+  timer = PhaseTimer()
+
+  tables = timer.time(
+    'generate', lambda: generate_synthetic_tables(**generator_arguments),
+    lambda tables: sum(data.shape[0] for data in tables.values()))
+
+  source_record_counts = {
+    table_name: data.shape[0] for table_name, data in tables.items()}
+
+  excel_sources = find_spec('openpyxl') is not None
+  source_dir = mkdtemp(prefix='bus_ped_sources_', dir=path.dirname(db_path))
+
+  timer.time(
+    'export_sources', lambda: write_source_exports(
+      source_dir, tables, excel_sources), lambda record_count: record_count)
+
+  if not excel_sources:
+    timer.time('write_route_stop_and_warning', lambda: write_synthetic_tables(
+      db_path, {table_name: tables[table_name]
+                for table_name in ['route_stop', 'warning']}),
+      source_record_counts['route_stop'] + source_record_counts['warning'])
+
+  # the stop time loader collapses the records of buses that wait at a
+  # terminal using the route stops, which its script reads from the route
+  # stop spreadsheets
+  route_stop_data = tables['route_stop']
+
+  del tables
+
+  if excel_sources:
+    timer.time('ingest_route_stop', lambda: ingest_sources(
+      db_path, 'route_stop', [
+        path.join(source_dir, 'route_stops', file_name)
+        for file_name in listdir(path.join(source_dir, 'route_stops'))],
+      read_route_stop_file, process_count), source_record_counts['route_stop'])
+
+  timer.time('ingest_stop_time', lambda: ingest_sources(
+    db_path, 'stop_time', find_stop_time_files(
+      path.join(source_dir, 'stop_times')),
+    partial(spill_stop_time_file, route_stop_data=route_stop_data,
+            chunk_size=chunk_size), process_count),
+    source_record_counts['stop_time'])
+
+  timer.time('ingest_vehicle_assignment', lambda: ingest_files(
+    db_path, 'vehicle_assignment', table_schemas['vehicle_assignment'],
+    find_vehicle_assignment_files(path.join(source_dir, 'vehicle_assignments')),
+    read_vehicle_assignment_file), source_record_counts['vehicle_assignment'])
+
+  if excel_sources:
+    timer.time('ingest_warning', lambda: ingest_sources(
+      db_path, 'warning', [
+        path.join(source_dir, 'warnings', file_name)
+        for file_name in listdir(path.join(source_dir, 'warnings'))],
+      read_warning_file, process_count), source_record_counts['warning'])
+
+  rmtree(source_dir)
+
+  db = create_engine('sqlite:///' + db_path)
+
+  route_stop_df, stop_time_df, vehicle_assignment_df, warning_df = timer.time(
+    'read', lambda: [
+      compact_table(pd.read_sql_table(table_name, db)) for table_name in [
+        'route_stop', 'stop_time', 'vehicle_assignment', 'warning']],
+    lambda tables: sum(data.shape[0] for data in tables))
+
+  db.dispose()
+
+  # the loaders drop and collapse some of the source records
+  record_counts = {
+    'route_stop': route_stop_df.shape[0], 'stop_time': stop_time_df.shape[0],
+    'vehicle_assignment': vehicle_assignment_df.shape[0],
+    'warning': warning_df.shape[0]}
+
+  trip_table = timer.time(
+    'construct_trip_list', lambda: construct_all_trip_lists(
+      route_stop_df, stop_time_df, vehicle_assignment_df),
+    record_counts['stop_time'])
+
+  record_counts['trip'] = len(trip_table)
+
+  del trip_table
+
+  trip_table = timer.time(
+    'assign_warnings_to_trips', lambda: assign_warnings_to_trips(
+      route_stop_df, stop_time_df, vehicle_assignment_df, warning_df,
+      process_count=process_count, batch_size=batch_size),
+    record_counts['stop_time'] + record_counts['warning'])
+
+  record_counts['assigned_warning'] = trip_table.warning_indices.shape[0]
+
+  timer.time('longitudinal_data_product',
+             lambda: construct_longitudinal_data_product(trip_table, warning_df),
+             lambda data: data.shape[0])
+
+  timer.time('hotspot_data_product',
+             lambda: construct_hotspot_data_product(trip_table, warning_df),
+             lambda data: data.shape[0])
+
+  return {'parameters': generator_arguments,
+          'source_records': source_record_counts, 'records': record_counts,
+          'excel_sources': excel_sources, 'phases': timer.phases}
+
+
+def run_benchmark_process(result_queue, *args):
+  result_queue.put(run_benchmark(*args))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--results_path', default='benchmark_results.json')
+  # the directory in which to create the database of each size, by default a
+  # new temporary directory
+  parser.add_argument('--work_dir', default=None)
+  parser.add_argument('--day_counts', type=int, nargs='+', default=[1, 7, 28])
+  parser.add_argument('--route_count', type=int, default=5)
+  parser.add_argument('--bus_count', type=int, default=10)
+  parser.add_argument('--warnings_per_trip', type=float, default=5.0)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--process_count', type=int, default=None)
+  parser.add_argument('--batch_size', type=int, default=64)
+  # the number of records of each StopTimes export that the loader sorts and
+  # spills at a time
+  parser.add_argument('--chunk_size', type=int, default=250000)
+
+  args = parser.parse_args()
+
+  if args.work_dir is None:
+    args.work_dir = mkdtemp(prefix='bus_ped_benchmark_')
+
+  runs = []
+
+  for day_count in args.day_counts:
+    generator_arguments = {
+      'route_count': args.route_count, 'bus_count': args.bus_count,
+      'day_count': day_count, 'warnings_per_trip': args.warnings_per_trip,
+      'seed': args.seed}
+
+    db_path = path.join(args.work_dir, 'benchmark_{}_days.sqlite'.format(
+      day_count))
+
+    if path.exists(db_path):
+      remove(db_path)
+
+    print('benchmarking {}'.format(generator_arguments))
+
+    result_queue = Queue()
+
+    benchmark_process = Process(target=run_benchmark_process, args=(
+      result_queue, db_path, generator_arguments, args.process_count,
+      args.batch_size, args.chunk_size))
+    benchmark_process.start()
+
+    runs.append(result_queue.get())
+
+    benchmark_process.join()
+
+    remove(db_path)
+
+  with open(args.results_path, 'w') as results_file:
+    json.dump({
+      'created_at': datetime.now().isoformat(),
+      'python_version': platform.python_version(),
+      'numpy_version': np.__version__,
+      'pandas_version': pd.__version__,
+      'platform': platform.platform(),
+      'cpu_count': cpu_count(),
+      'process_count': args.process_count,
+      'batch_size': args.batch_size,
+      'chunk_size': args.chunk_size,
+      'runs': runs}, results_file, indent=2)
+
+  print('wrote results of {} runs to {}'.format(len(runs), args.results_path))
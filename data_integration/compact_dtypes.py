@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+# This module defines the in-memory schema shared by the ingestion scripts and
+# the data product generator, so that every table is held in the same compact
+# form whichever script reads or builds it:
+#   ids are held in the narrowest unsigned integer type that fits the values
+#     observed in the DASH sources (e.g. route_id <= 9960, vehicle_id <= 4386),
+#     and a value that does not fit raises a ValueError rather than wrapping.
+#     Record ids (stop_time_id and vehicle_assignment_id) are assigned by the
+#     source systems without a known bound, so they keep the uint64 type of
+#     the original loaders
+#   names, headings and addresses are held as pandas categoricals, i.e. as
+#     small integer codes into a single array of distinct names
+#   timestamps are held as datetime64[ns]
+#
+# Tables are still stored in SQLite with text names, since the R scripts that
+# consume the data products select them by name.
+
+column_dtypes = {
+  'route_id': np.uint16, 'vehicle_id': np.uint16, 'stop_id': np.uint32,
+  'driver_id': np.uint32, 'bus_number': np.uint32, 'badge_number': np.uint32,
+  'sequence': np.uint8, 'stop_time_id': np.uint64,
+  'vehicle_assignment_id': np.uint64, 'is_terminal': np.bool_,
+  'route_name': 'category', 'stop_name': 'category', 'heading': 'category',
+  'warning_name': 'category', 'address': 'category', 'first_name': 'category',
+  'last_name': 'category', 'arrived_at': 'datetime64[ns]',
+  'departed_at': 'datetime64[ns]', 'start_time': 'datetime64[ns]',
+  'end_time': 'datetime64[ns]', 'loc_time': 'datetime64[ns]'}
+
+# the warning types counted in the longitudinal data product
+warning_names = [
+  'ME - Pedestrian Collision Warning', 'ME - Pedestrian In Range Warning',
+  'PCW-LF', 'PCW-LR', 'PCW-RR', 'PDZ - Left Front', 'PDZ-LR', 'PDZ-R',
+  'Safety - Braking - Aggressive', 'Safety - Braking - Dangerous']
+
+# categories that are always given the same codes, in this order, ahead of any
+# other names observed in a column
+known_categories = {'heading': ['N', 'S'], 'warning_name': warning_names}
+
+
+def ordered_categories(column_name, names):
+  """Return the categories of the given column for the given distinct names:
+  its known categories followed by the remaining names in sorted order"""
+  known_names = known_categories.get(column_name, [])
+
+  return known_names + sorted(set(names).difference(known_names))
+
+
+def narrow_integers(values, dtype, column_name):
+  """Convert a column of integers, or of strings of digits, to the given
+  integer type, raising a ValueError if any value is missing or out of the
+  range of the type"""
+  values = pd.to_numeric(values)
+
+  if values.isnull().any():
+    raise ValueError('column {} has {} missing values'.format(
+      column_name, values.isnull().sum()))
+
+  dtype_info = np.iinfo(dtype)
+
+  if values.shape[0] > 0 and (
+      values.min() < dtype_info.min or values.max() > dtype_info.max):
+    raise ValueError('column {} has values in [{}, {}] outside the range of '
+                     '{}'.format(column_name, values.min(), values.max(),
+                                 np.dtype(dtype).name))
+
+  return values.astype(dtype)
+
+
+def compact_table(data, categories=None):
+  """Convert the columns of the given data frame that have a dtype in
+  column_dtypes to that dtype in place and return the data frame. Categorical
+  columns are given the categories in categories, keyed by column name, if
+  any (names not among them become missing values) and otherwise their
+  ordered_categories()."""
+  if categories is None:
+    categories = {}
+
+  for column_name in data.columns.intersection(list(column_dtypes)):
+    dtype = column_dtypes[column_name]
+    values = data[column_name]
+
+    if dtype == 'category':
+      if column_name in categories:
+        column_categories = categories[column_name]
+      elif isinstance(values.dtype, pd.CategoricalDtype):
+        column_categories = ordered_categories(
+          column_name, values.cat.categories)
+      else:
+        column_categories = ordered_categories(
+          column_name, values.dropna().unique())
+
+      if isinstance(values.dtype, pd.CategoricalDtype):
+        data[column_name] = values.cat.set_categories(column_categories)
+      else:
+        data[column_name] = pd.Categorical(
+          values, categories=column_categories)
+    elif dtype == 'datetime64[ns]':
+      if values.dtype != np.dtype(dtype):
+        data[column_name] = pd.to_datetime(values)
+    elif dtype == np.bool_:
+      data[column_name] = values.astype(np.bool_)
+    elif values.dtype != np.dtype(dtype):
+      data[column_name] = narrow_integers(values, dtype, column_name)
+
+  return data
+
+
+def concat_tables(tables, **kwargs):
+  """Concatenate data frames with pd.concat, keeping columns that are
+  categorical in every frame categorical by first giving them the same
+  categories, since pd.concat otherwise converts them to objects"""
+  for column_name in tables[0].columns:
+    if all(isinstance(table[column_name].dtype, pd.CategoricalDtype)
+           for table in tables):
+      column_categories = ordered_categories(column_name, np.concatenate([
+        table[column_name].cat.categories.values for table in tables]))
+
+      for table in tables:
+        table[column_name] = table[column_name].cat.set_categories(
+          column_categories)
+
+  return pd.concat(tables, **kwargs)
+
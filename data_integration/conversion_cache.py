@@ -0,0 +1,90 @@
+import hashlib
+from glob import glob
+import numpy as np
+from os import makedirs, path, remove, replace, stat
+import pandas as pd
+
+# This module caches the cleaned, typed records parsed from slow source files
+# such as the Ituran warning spreadsheets, so that each file is parsed only
+# once. The columns of the data frame read from a file are saved together in
+# an uncompressed .npz file named after the path, size and modification time
+# of the source file, which later runs load instead of parsing the file again
+# for as long as the file is unchanged. Categorical columns are saved as their
+# codes and categories, so the columns of a data frame to be cached must be
+# numeric, datetime64 or categorical, as they are after compact_table().
+#
+# Since the cached records are those returned by a particular reader, each
+# reader must be given its own cache directory.
+
+
+def cache_file_prefix(cache_dir, file_path):
+  file_path = path.abspath(file_path)
+
+  return path.join(cache_dir, '{}_{}'.format(
+    path.splitext(path.basename(file_path))[0],
+    hashlib.sha1(file_path.encode()).hexdigest()[:16]))
+
+
+def save_columns(cache_path, data):
+  arrays = {'columns': np.array(data.columns, dtype=str)}
+
+  for column_index, column_name in enumerate(data.columns):
+    values = data[column_name]
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+      arrays['{}_codes'.format(column_index)] = values.cat.codes.values
+      arrays['{}_categories'.format(column_index)] = np.array(
+        values.cat.categories, dtype=str)
+    elif values.dtype == object:
+      raise ValueError('column {} of type object cannot be cached'.format(
+        column_name))
+    else:
+      arrays['{}_values'.format(column_index)] = values.values
+
+  # write to a temporary file first so that an interrupted write does not
+  # leave a truncated conversion to be loaded by later runs
+  with open(cache_path + '.tmp', 'wb') as cache_file:
+    np.savez(cache_file, **arrays)
+
+  replace(cache_path + '.tmp', cache_path)
+
+
+def load_columns(cache_path):
+  with np.load(cache_path, allow_pickle=False) as arrays:
+    data = {}
+
+    for column_index, column_name in enumerate(arrays['columns']):
+      if '{}_codes'.format(column_index) in arrays:
+        data[column_name] = pd.Categorical.from_codes(
+          arrays['{}_codes'.format(column_index)],
+          categories=arrays['{}_categories'.format(column_index)].astype(
+            object))
+      else:
+        data[column_name] = arrays['{}_values'.format(column_index)]
+
+    return pd.DataFrame(data, columns=list(arrays['columns']))
+
+
+def read_converted_file(file_path, read_file, cache_dir):
+  """Return the records that read_file returns for the file at file_path,
+  from the cache in cache_dir if the file has not changed since it was
+  cached, and otherwise by calling read_file and caching its result"""
+  file_stat = stat(file_path)
+  prefix = cache_file_prefix(cache_dir, file_path)
+  cache_path = '{}_{}_{}.npz'.format(
+    prefix, file_stat.st_size, file_stat.st_mtime_ns)
+
+  if path.exists(cache_path):
+    return load_columns(cache_path)
+
+  data = read_file(file_path)
+
+  makedirs(cache_dir, exist_ok=True)
+
+  # remove conversions of previous versions of the file
+  for stale_cache_path in glob('{}_*.npz'.format(prefix)):
+    remove(stale_cache_path)
+
+  save_columns(cache_path, data)
+
+  return data
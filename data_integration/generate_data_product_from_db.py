@@ -3,9 +3,17 @@ from datetime import datetime
 import numpy as np
 import pandas as pd
 from sqlalchemy import create_engine
-from multiprocessing import Process, Queue
-from os import cpu_count, kill
-from signal import SIGKILL
+from multiprocessing import Pool
+from os import getpid, path, remove
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from zlib import crc32
+from compact_dtypes import column_dtypes, compact_table, ordered_categories, \
+  warning_names
+from pipeline_stats import PipelineStats, write_run_report
+from shared_arrays import SharedArrays
+from sqlite_bulk_load import bulk_load_transaction, create_indices, \
+  create_table, prepare_table, quote, table_exists, table_schemas, write_table
 
 # This script creates or replaces two tables in the database at the supplied
 # path that contain 'clean' subsets of LADOT DASH trip data, where a clean trip is
@@ -29,281 +37,446 @@ from signal import SIGKILL
 # are identified in construct_trip_list(), then corresponding warnings are
 # assigned to each trip based on a time range and a vehicle id in
 # assign_warnings_to_trips(), and finally either a hotspot or a longitudinal data
-# product is constructed given the trips and their warnings in
+# product is constructed given the table of trips and their warnings in
 # construct_hotspot_data_product() or construct_longitudinal_data_product()
 #
+# The time spent in each phase, the rows in and out of each, and the reasons
+# that trips are rejected are collected in a PipelineStats by the main process
+# and by each worker and written to a JSON run report and a pipeline_run table
+# (see pipeline_stats.py)
+#
 # TODO: log print statements
-# TODO: only db read stop events in the date range across driver schedules
 
-# define hostpot table column names and a custom data type fo organizing data
-# into records
+# define hostpot table column names. The columns of both data products have
+# the compact dtypes of compact_dtypes.py, with route names, headings and
+# warning names as categoricals
 hotspot_header = np.array([
   'route_name', 'route_id', 'heading', 'driver_id', 'vehicle_id', 'bus_number',
   'loc_time', 'warning_name', 'latitude', 'longitude'])
 
-hotspot_type = np.dtype([
-  (hotspot_header[0], np.unicode_, 6), (hotspot_header[1], np.uint32),
-  (hotspot_header[2], np.unicode_, 10), (hotspot_header[3], np.uint32),
-  (hotspot_header[4], np.uint32), (hotspot_header[5], np.uint32),
-  (hotspot_header[6], datetime), (hotspot_header[7], np.unicode_, 34),
-  (hotspot_header[8], np.float64), (hotspot_header[9], np.float64)])
-
-# define longitudinal table column names and a custom data type fo organizing
-# data into records
+# define longitudinal table column names, with one count column per counted
+# warning type
 longitudinal_header = np.array([
   'route_name', 'route_id', 'heading', 'driver_id', 'vehicle_id', 'bus_number',
-  'start_time', 'end_time', 'ME - Pedestrian Collision Warning',
-  'ME - Pedestrian In Range Warning', 'PCW-LF', 'PCW-LR', 'PCW-RR',
-  'PDZ - Left Front', 'PDZ-LR', 'PDZ-R', 'Safety - Braking - Aggressive',
-  'Safety - Braking - Dangerous'])
-
-longitudinal_type = np.dtype([
-  (longitudinal_header[0], np.unicode_, 6), (longitudinal_header[1], np.uint32),
-  (longitudinal_header[2], np.unicode_, 10),
-  (longitudinal_header[3], np.uint32),
-  (longitudinal_header[4], np.uint32), (longitudinal_header[5], np.uint32),
-  (longitudinal_header[6], datetime),
-  (longitudinal_header[7], datetime), (longitudinal_header[8], np.uint16),
-  (longitudinal_header[9], np.uint16), (longitudinal_header[10], np.uint16),
-  (longitudinal_header[11], np.uint16), (longitudinal_header[12], np.uint16),
-  (longitudinal_header[13], np.uint16), (longitudinal_header[14], np.uint16),
-  (longitudinal_header[15], np.uint16), (longitudinal_header[16], np.uint16),
-  (longitudinal_header[17], np.uint16)])
-
-# a separate collection of warning headers will be used to first create warning
-# count data before concatenating them with trip data to form longitudinal
-# records
+  'start_time', 'end_time'] + warning_names)
+
 warnings_header = longitudinal_header[8:]
 
-valid_trip_count = 0
-invalid_trip_count = 0
-pseudo_invalid_trip_count = 0
-trips_with_no_warnings = 0
-
-
-# a Run object is used to organize an individual trip's properties together with
-# a collection of warnings that may vary in length from trip to trip
-class Trip:
-  def __init__(self, route_name, route_id, heading, vehicle_id, start_time,
-               end_time, stop_count, driver_id=None, bus_number=None,
-               warnings=None):
-    self.route_name = route_name
-    self.route_id = route_id
-    self.heading = heading
-    self.vehicle_id = vehicle_id
-    self.start_time = start_time
-    self.end_time = end_time
-    self.driver_id = driver_id
-    self.bus_number = bus_number
-    self.warnings = warnings
-    self.stop_count = stop_count
-
-
-# numpy arrays of custom dtype expect elements to be tuples. Because
-# longitudinal records are created in batches, organization of data into a tuple
-# must be applied row-wise across the batch dimension
-def to_tuple(element):
-  return np.array(tuple(element), dtype=hotspot_type)
-
-
-def construct_trip_list(route_stops, stop_times):
+
+# a TripTable organizes the properties of a collection of trips as parallel
+# arrays with one element per trip. The warnings of trip i are the rows at
+# positions warning_indices[warning_offsets[i]:warning_offsets[i + 1]] of the
+# warning table, so that trips can be sent between processes and aggregated
+# without any per-trip python objects or data frames
+class TripTable:
+  def __init__(self, route_names, route_ids, headings, vehicle_ids, driver_ids,
+               bus_numbers, vehicle_assignment_ids, start_times, end_times,
+               stop_counts, warning_offsets, warning_indices):
+    self.route_names = np.asarray(route_names, dtype=object)
+    self.route_ids = np.asarray(
+      route_ids, dtype=column_dtypes['route_id'])
+    self.headings = np.asarray(headings, dtype='<U1')
+    self.vehicle_ids = np.asarray(
+      vehicle_ids, dtype=column_dtypes['vehicle_id'])
+    self.driver_ids = np.asarray(driver_ids, dtype=column_dtypes['driver_id'])
+    self.bus_numbers = np.asarray(
+      bus_numbers, dtype=column_dtypes['bus_number'])
+    self.vehicle_assignment_ids = np.asarray(
+      vehicle_assignment_ids, dtype=column_dtypes['vehicle_assignment_id'])
+    self.start_times = np.asarray(start_times, dtype='datetime64[ns]')
+    self.end_times = np.asarray(end_times, dtype='datetime64[ns]')
+    self.stop_counts = np.asarray(stop_counts, dtype=np.uint32)
+    self.warning_offsets = np.asarray(warning_offsets, dtype=np.int64)
+    self.warning_indices = np.asarray(warning_indices, dtype=np.int64)
+
+  def __len__(self):
+    return self.route_ids.shape[0]
+
+  def warning_counts(self):
+    return np.diff(self.warning_offsets)
+
+  def warning_trip_indices(self):
+    """Return the position of the trip to which each element of
+    warning_indices is assigned"""
+    return np.repeat(np.arange(len(self)), self.warning_counts())
+
+
+def concatenate_trip_tables(trip_tables):
+  """Combine trip tables into one, preserving the order of their trips"""
+  warning_offsets = [np.zeros(1, dtype=np.int64)]
+  warning_count = 0
+
+  for trip_table in trip_tables:
+    warning_offsets.append(trip_table.warning_offsets[1:] + warning_count)
+    warning_count += trip_table.warning_offsets[-1]
+
+  def concatenate(attribute_name, dtype):
+    return np.concatenate(
+      [np.empty(0, dtype=dtype)] + [getattr(trip_table, attribute_name)
+                                    for trip_table in trip_tables])
+
+  return TripTable(
+    concatenate('route_names', object),
+    concatenate('route_ids', column_dtypes['route_id']),
+    concatenate('headings', '<U1'),
+    concatenate('vehicle_ids', column_dtypes['vehicle_id']),
+    concatenate('driver_ids', column_dtypes['driver_id']),
+    concatenate('bus_numbers', column_dtypes['bus_number']),
+    concatenate('vehicle_assignment_ids',
+                column_dtypes['vehicle_assignment_id']),
+    concatenate('start_times', 'datetime64[ns]'),
+    concatenate('end_times', 'datetime64[ns]'),
+    concatenate('stop_counts', np.uint32), np.concatenate(warning_offsets),
+    concatenate('warning_indices', np.int64))
+
+
+# a StopTimeIndex sorts stop times once by route, vehicle, arrival and departure
+# so that the stop times of a given vehicle on a given route during a driver's
+# shift are a contiguous range that can be found by binary search rather than by
+# scanning the whole stop time table for each driver assignment
+class StopTimeIndex(SharedArrays):
+  shared_array_names = [
+    'route_ids', 'vehicle_ids', 'stop_ids', 'arrived_at', 'departed_at',
+    'max_departed_at']
+
+  def __init__(self, stop_time_df):
+    route_ids = stop_time_df['route_id'].values
+    vehicle_ids = stop_time_df['vehicle_id'].values
+    arrived_at = stop_time_df['arrived_at'].values.astype('datetime64[ns]')
+    departed_at = stop_time_df['departed_at'].values.astype('datetime64[ns]')
+
+    order = np.lexsort((departed_at, arrived_at, vehicle_ids, route_ids))
+
+    self.route_ids = route_ids[order]
+    self.vehicle_ids = vehicle_ids[order]
+    self.stop_ids = stop_time_df['stop_id'].values[order]
+    self.arrived_at = arrived_at[order]
+    self.departed_at = departed_at[order]
+
+    # the range of sorted positions occupied by each (route_id, vehicle_id)
+    # pair
+    group_starts = np.flatnonzero(np.concatenate(([True], (
+        self.route_ids[1:] != self.route_ids[:-1]) | (
+        self.vehicle_ids[1:] != self.vehicle_ids[:-1])))) \
+      if order.shape[0] > 0 else np.array([], dtype=np.int64)
+    group_ends = np.append(group_starts[1:], order.shape[0])
+
+    self.group_ranges = {
+      (self.route_ids[start], self.vehicle_ids[start]): (start, end)
+      for start, end in zip(group_starts, group_ends)}
+
+    # departures are not guaranteed to increase with arrivals, so the running
+    # maximum departure time within each group is used to bound searches
+    self.max_departed_at = np.empty_like(self.departed_at)
+
+    for start, end in zip(group_starts, group_ends):
+      self.max_departed_at[start:end] = np.maximum.accumulate(
+        self.departed_at[start:end])
+
+  def find_rows(self, route_id, vehicle_id, start_time, end_time):
+    """Return the positions of stop times of the given vehicle on the given
+    route that depart no earlier than start_time and arrive before end_time,
+    ordered by arrival then departure. Positions are returned as a slice when
+    they are contiguous, which is almost always the case."""
+    if (route_id, vehicle_id) not in self.group_ranges:
+      return slice(0, 0)
+
+    group_start, group_end = self.group_ranges[(route_id, vehicle_id)]
+
+    start_time = np.datetime64(start_time, 'ns')
+    end_time = np.datetime64(end_time, 'ns')
+
+    range_start = group_start + np.searchsorted(
+      self.max_departed_at[group_start:group_end], start_time, side='left')
+    range_end = group_start + np.searchsorted(
+      self.arrived_at[group_start:group_end], end_time, side='left')
+    range_end = max(range_start, range_end)
+
+    # a stop time that departs earlier than one that precedes it may still
+    # fall within the range but depart before start_time
+    departed_in_range = self.departed_at[range_start:range_end] >= start_time
+
+    if departed_in_range.all():
+      return slice(range_start, range_end)
+    else:
+      return range_start + np.flatnonzero(departed_in_range)
+
+
+# a WarningIndex sorts warnings once by bus number then time so that the
+# warnings that occur on a given bus during any number of trips can be found by
+# binary search rather than by scanning the whole warning table for each trip.
+# Only the columns needed for the search are kept, with the original position
+# of each sorted warning in order, so that the warning table itself need not
+# be sent to workers
+class WarningIndex(SharedArrays):
+  shared_array_names = ['order', 'bus_numbers', 'loc_times']
+
+  def __init__(self, warning_df):
+    bus_numbers = warning_df['bus_number'].values
+    loc_times = warning_df['loc_time'].values.astype('datetime64[ns]')
+
+    self.order = np.lexsort((loc_times, bus_numbers))
+    self.bus_numbers = bus_numbers[self.order]
+    self.loc_times = loc_times[self.order]
+
+    # the range of sorted positions occupied by each bus
+    self.unique_bus_numbers, self.bus_starts = np.unique(
+      self.bus_numbers, return_index=True)
+    self.bus_ends = np.append(self.bus_starts[1:], self.bus_numbers.shape[0])
+
+  def find_ranges(self, bus_numbers, start_times, end_times):
+    """Return the [start, end) positions among sorted warnings of the warnings
+    with the given bus number that occur in [start_time, end_time), for each
+    trip given as elements of three parallel arrays"""
+    bus_numbers = np.asarray(bus_numbers)
+    start_times = np.asarray(start_times, dtype='datetime64[ns]')
+    end_times = np.asarray(end_times, dtype='datetime64[ns]')
+
+    range_starts = np.zeros(bus_numbers.shape[0], dtype=np.int64)
+    range_ends = np.zeros(bus_numbers.shape[0], dtype=np.int64)
+
+    bus_indices = np.searchsorted(self.unique_bus_numbers, bus_numbers)
+
+    # trips on buses without warnings keep an empty range
+    has_warnings = bus_indices < self.unique_bus_numbers.shape[0]
+    has_warnings[has_warnings] = self.unique_bus_numbers[
+      bus_indices[has_warnings]] == bus_numbers[has_warnings]
+
+    for bus_index in np.unique(bus_indices[has_warnings]):
+      is_on_bus = has_warnings & (bus_indices == bus_index)
+      bus_start = self.bus_starts[bus_index]
+      bus_loc_times = self.loc_times[bus_start:self.bus_ends[bus_index]]
+
+      range_starts[is_on_bus] = bus_start + np.searchsorted(
+        bus_loc_times, start_times[is_on_bus], side='left')
+      range_ends[is_on_bus] = bus_start + np.searchsorted(
+        bus_loc_times, end_times[is_on_bus], side='left')
+
+    # a trip that ends before it starts has no warnings
+    range_ends = np.maximum(range_starts, range_ends)
+
+    return range_starts, range_ends
+
+  def take_ranges(self, range_starts, range_ends):
+    """Return offsets into, and the concatenation of, the positions in the
+    original warning data frame of the warnings within each given range"""
+    range_lengths = range_ends - range_starts
+    warning_offsets = np.concatenate(([0], np.cumsum(range_lengths)))
+
+    sorted_indices = np.arange(warning_offsets[-1]) + np.repeat(
+      range_starts - warning_offsets[:-1], range_lengths)
+
+    return warning_offsets, self.order[sorted_indices]
+
+
+def segment_trips(
+    stop_ids, terminal_stop_id, northbound_stop_ids, southbound_stop_ids,
+    stats=None):
+  """
+  Given the time-ordered stop ids visited by a single vehicle, split the
+  sequence into windows between consecutive visits to the terminal stop and
+  label each window as zero, one or two trips. Each window spans from one
+  terminal visit to the next inclusive, with the stops preceding the first
+  terminal visit and those following the last one treated as partial windows.
+
+  A window is ignored if it contains fewer than two stops, or if any of its
+  stops belongs to neither or both bounds. Otherwise, its interior stops
+  (excluding the two ends) must be all northbound, all southbound, or more
+  than two northbound stops followed by more than two southbound stops (or
+  vice versa), in which case the window is split at the last interior stop of
+  the first bound.
+
+  Return four arrays with one element per trip, in order of occurrence: the
+  trip heading ('N' or 'S'), the positions of the first and last stop of the
+  trip, and the number of interior stops on the trip's bound. If a
+  PipelineStats is given, count windows by the reason they are ignored or the
+  number of trips they contain.
+  """
+  if stats is None:
+    stats = PipelineStats()
+
+  stop_count = stop_ids.shape[0]
+
+  terminal_stop_indices = np.flatnonzero(stop_ids == terminal_stop_id)
+
+  if stop_count == 0 or terminal_stop_indices.shape[0] == 0:
+    stats.count('sequences_without_terminal_stop')
+    return np.array([], dtype='<U1'), np.array([], dtype=np.int64), \
+           np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+  window_bounds = np.concatenate(([0], terminal_stop_indices, [stop_count - 1]))
+  window_starts = window_bounds[:-1]
+  window_ends = window_bounds[1:]
+
+  are_northbound = np.isin(stop_ids, northbound_stop_ids)
+  are_southbound = np.isin(stop_ids, southbound_stop_ids)
+
+  # cumulative counts with a leading zero so that the number of stops of a
+  # given kind at positions [i, j) is counts[j] - counts[i]
+  def cumulative_count(flags):
+    return np.concatenate(([0], np.cumsum(flags, dtype=np.int64)))
+
+  northbound_counts = cumulative_count(are_northbound)
+  southbound_counts = cumulative_count(are_southbound)
+  ambiguous_counts = cumulative_count(are_northbound == are_southbound)
+
+  # ignore ranges that are less than 2 stops long as these are probably
+  # sequences of multiple records representing a single event, and those in
+  # which some stop cannot be attributed to exactly one bound
+  is_long_enough = window_ends - window_starts >= 1
+  is_valid = is_long_enough & (
+      ambiguous_counts[window_ends + 1] - ambiguous_counts[window_starts] == 0)
+
+  stats.count('windows', is_valid.shape[0])
+  stats.count('short_windows', np.count_nonzero(~is_long_enough))
+  stats.count('windows_with_unattributed_stops',
+              np.count_nonzero(is_long_enough & ~is_valid))
+
+  window_starts = window_starts[is_valid]
+  window_ends = window_ends[is_valid]
+
+  # ignore the end stops since the southbound terminal may precede an entire
+  # northbound trip or vice versa, making a bound appear not uniform
+  interior_starts = window_starts + 1
+
+  northbound_stop_counts = \
+    northbound_counts[window_ends] - northbound_counts[interior_starts]
+  southbound_stop_counts = \
+    southbound_counts[window_ends] - southbound_counts[interior_starts]
+
+  # a window contains a northbound trip followed by a southbound trip if its
+  # first northbound_stop_count interior stops are all northbound, and vice
+  # versa
+  is_round_trip = (northbound_stop_counts > 2) & (southbound_stop_counts > 2)
+
+  is_northbound_first = is_round_trip & (
+      northbound_counts[interior_starts + northbound_stop_counts]
+      - northbound_counts[interior_starts] == northbound_stop_counts)
+
+  is_southbound_first = is_round_trip & ~is_northbound_first & (
+      southbound_counts[interior_starts + southbound_stop_counts]
+      - southbound_counts[interior_starts] == southbound_stop_counts)
+
+  is_southbound_only = ~is_round_trip & (southbound_stop_counts >= 2) & (
+      northbound_stop_counts == 0)
+
+  is_northbound_only = ~is_round_trip & (southbound_stop_counts == 0) & (
+      northbound_stop_counts >= 2)
+
+  is_split = is_northbound_first | is_southbound_first
+  is_whole = is_northbound_only | is_southbound_only
+
+  stats.count('round_trip_windows', np.count_nonzero(is_split))
+  stats.count('one_way_windows', np.count_nonzero(is_whole))
+  stats.count('unrecognized_windows', np.count_nonzero(~is_split & ~is_whole))
+
+  # the position of the last interior stop of the first bound
+  split_indices = np.where(
+    is_northbound_first, window_starts + northbound_stop_counts,
+    window_starts + southbound_stop_counts)
+
+  first_headings = np.where(
+    is_northbound_first | is_northbound_only, 'N', 'S')
+  second_headings = np.where(is_northbound_first, 'S', 'N')
+
+  first_stop_counts = np.where(
+    is_northbound_first | is_northbound_only, northbound_stop_counts,
+    southbound_stop_counts)
+  second_stop_counts = np.where(
+    is_northbound_first, southbound_stop_counts, northbound_stop_counts)
+
+  first_ends = np.where(is_split, split_indices, window_ends)
+
+  # interleave first and second trips so that trips remain in order of
+  # occurrence, then keep only those that exist
+  has_first_trip = is_split | is_whole
+  has_trip = np.stack((has_first_trip, is_split), axis=1).ravel()
+
+  def interleave(first, second):
+    return np.stack((first, second), axis=1).ravel()[has_trip]
+
+  return interleave(first_headings, second_headings), \
+         interleave(window_starts, split_indices), \
+         interleave(first_ends, window_ends), \
+         interleave(first_stop_counts, second_stop_counts)
+
+
+def construct_trip_list(
+    route_stops, stop_time_index, stop_time_rows, driver_id, bus_number,
+    vehicle_assignment_id, stats=None):
   """
   Given a time-ordered sequence of stops a bus traveled to or past, and the
   arrival time for each stop, extract instances of round trips (between the
   departure from a terminal to the arrival at that same stop. Records for which
   consecutive terminal stops have an unreasonable number of intermediate stops
   (e.g. more than the total number of stops that constitute a route) will be
-  ignored.
+  ignored. The stop times are given as the positions stop_time_rows of a
+  StopTimeIndex. Return the trips as a TripTable without warnings. If a
+  PipelineStats is given, count the reasons that stop times are not split into
+  trips.
   """
-  # global valid_trip_count
-  # global invalid_trip_count
-  # global pseudo_invalid_trip_count
-  # global trips_with_no_warnings
-
-  global_trip_list = []
-  # print('stop_times: {}'.format(stop_times))
+  if stats is None:
+    stats = PipelineStats()
 
   terminal_stops = route_stops[route_stops.is_terminal == True]
 
-  if len(terminal_stops) > 0:
-    terminal_stop_id = terminal_stops['stop_id'].unique()[0]
-    # print('terminal_stop_id: {}'.format(terminal_stop_id))
-
-    # assume that the stop_times have been sorted by arrived_at then departed_at
-    terminal_stop_indices = stop_times[
-      stop_times.stop_id == terminal_stop_id].index.values
-    # print('terminal_stop_indices: {}'.format(terminal_stop_indices))
-
-    northbound_stop_ids = route_stops[
-      route_stops.heading == 'N']['stop_id'].values
-    northbound_stop_ids = northbound_stop_ids.astype(np.uint32)
-    # print('northbound_stop_ids: {}'.format(northbound_stop_ids))
-
-    southbound_stop_ids = route_stops[
-      route_stops.heading == 'S']['stop_id'].values
-    southbound_stop_ids = southbound_stop_ids.astype(np.uint32)
-
-    # print('southbound_stop_ids: {}'.format(southbound_stop_ids))
-
-    def is_northbound_fn(stop_id):
-      # print('n_stop_id: {}'.format(stop_id))
-      return True if stop_id in northbound_stop_ids else False
-
-    def is_southbound_fn(stop_id):
-      # print('s_stop_id: {}'.format(southbound_stop_ids))
-      return True if stop_id in southbound_stop_ids else False
-
-    if len(terminal_stop_indices) > 0:
-      for i in [-1] + list(range(len(terminal_stop_indices))):
-        # treat any stops preceding the first terminal as a partial trip
-        if i == -1:
-          try:
-            round_trip_stop_times = \
-              stop_times.loc[
-              stop_times.index.values[0]:terminal_stop_indices[0]]
-            # print('{} stop times found before first terminal'.format(
-            #   round_trip_stop_times.shape[0]))
-          except:
-            continue
-        # since the last trip may not end at the terminal, grab all stops after
-        # the last terminal. If the last trip truly did end at the terminal, the
-        # below code should branch out appropriately
-        elif i == len(terminal_stop_indices) - 1:
-          try:
-            round_trip_stop_times = \
-              stop_times.loc[
-              terminal_stop_indices[i]:stop_times.index.values[-1]]
-            # print('{} stop times found after last terminal'.format(
-            #   round_trip_stop_times.shape[0]))
-          except:
-            continue
-        else:
-          round_trip_stop_times = \
-            stop_times.loc[
-            terminal_stop_indices[i]:terminal_stop_indices[i + 1]]
-          # print('round_trip_stop_times_range: ({}, {})'.format(
-          #   terminal_stop_indices[i], terminal_stop_indices[i+1]))
-
-        local_trip_list = []
-        # ignore ranges that are less than 3 stops long as these are probably
-        # sequences of multiple records representing a single event
-        if 2 <= round_trip_stop_times.shape[0]:  # <= route_stops.shape[0] * 1:#
-          # confirm that the sequence of trips divides cleanly across the two bounds
-          are_northbound = round_trip_stop_times['stop_id'].apply(
-            is_northbound_fn)
-          # print('are_northbound: {}'.format(are_northbound.values))
-
-          are_southbound = round_trip_stop_times['stop_id'].apply(
-            is_southbound_fn)
-          # print('are_southbound: {}'.format(are_southbound.values))
-
-          are_equal = are_northbound == are_southbound
-          # print('are_equal: {}'.format(are_equal.values))
-
-          if not are_equal.any():
-            # ignore the 0th stop since the southbound terminal may precede an entire
-            # northbound trip or vice versa, making a bound appear not uniform
-            northbound_indices = are_northbound.iloc[1:-1][
-              are_northbound.iloc[1:-1] == True].index
-            # print('northbound_indices:\n{}'.format(northbound_indices))
-            southbound_indices = are_southbound.iloc[1:-1][
-              are_southbound.iloc[1:-1] == True].index
-            # print('southbound_indices:\n{}'.format(southbound_indices))
-            # assume argwhere will preserve the index ordering
-            if northbound_indices.shape[0] > 2 and southbound_indices.shape[
-              0] > 2:
-              route_id = round_trip_stop_times.iloc[0]['route_id']
-              route_name = route_stops.iloc[0]['route_name']
-              vehicle_id = round_trip_stop_times.iloc[0]['vehicle_id']
-
-              # valid_trip_count += 2
-              # in this round trip, the northbound trip precedes the southbound trip
-              # if northbound_indices[-1] < southbound_indices[0]:
-              if np.all(northbound_indices < southbound_indices[0]) \
-                  and np.all(northbound_indices[-1] < southbound_indices):
-                # the southbound trip
-                start_time = round_trip_stop_times.iloc[0]['departed_at']
-                # print('start_time: {}'.format(start_time))
-                end_time = round_trip_stop_times.loc[
-                  northbound_indices[-1]]['arrived_at']
-                # print('end_time: {}'.format(end_time))
-                local_trip_list.append(Trip(
-                  route_name, route_id, 'N', vehicle_id, start_time, end_time,
-                  northbound_indices.shape[0]))
-
-                start_time = round_trip_stop_times.loc[
-                  northbound_indices[-1]]['departed_at']
-                # print('start_time: {}'.format(start_time))
-                end_time = round_trip_stop_times.iloc[-1]['arrived_at']
-                # print('end_time: {}'.format(end_time))
-
-                local_trip_list.append(Trip(
-                  route_name, route_id, 'S', vehicle_id, start_time, end_time,
-                  southbound_indices.shape[0]))
-              elif np.all(northbound_indices[0] > southbound_indices) \
-                  and np.all(northbound_indices > southbound_indices[-1]):
-                start_time = round_trip_stop_times.iloc[0]['departed_at']
-                # print('start_time: {}'.format(start_time))
-                end_time = round_trip_stop_times.loc[
-                  southbound_indices[-1]]['arrived_at']
-                # print('end_time: {}'.format(end_time))
-
-                local_trip_list.append(Trip(
-                  route_name, route_id, 'S', vehicle_id, start_time, end_time,
-                  southbound_indices.shape[0]))
-
-                start_time = round_trip_stop_times.loc[
-                  southbound_indices[-1]]['departed_at']
-                # print('start_time: {}'.format(start_time))
-                end_time = round_trip_stop_times.iloc[-1]['arrived_at']
-                # print('end_time: {}'.format(end_time))
-
-                local_trip_list.append(Trip(
-                  route_name, route_id, 'N', vehicle_id, start_time, end_time,
-                  northbound_indices.shape[0]))
-            elif southbound_indices.shape[0] >= 2 \
-                and northbound_indices.shape[0] == 0:
-              # valid_trip_count += 1
-              route_id = round_trip_stop_times.iloc[0]['route_id']
-              route_name = route_stops.iloc[0]['route_name']
-              vehicle_id = round_trip_stop_times.iloc[0]['vehicle_id']
-
-              start_time = round_trip_stop_times.iloc[0]['departed_at']
-              # print('start_time: {}'.format(start_time))
-              end_time = round_trip_stop_times.iloc[-1]['arrived_at']
-              # print('end_time: {}'.format(end_time))
-
-              local_trip_list.append(Trip(
-                route_name, route_id, 'S', vehicle_id, start_time, end_time,
-                southbound_indices.shape[0]))
-            elif southbound_indices.shape[0] == 0 \
-                and northbound_indices.shape[0] >= 2:
-              # valid_trip_count += 1
-              route_id = round_trip_stop_times.iloc[0]['route_id']
-              route_name = route_stops.iloc[0]['route_name']
-              vehicle_id = round_trip_stop_times.iloc[0]['vehicle_id']
-
-              start_time = round_trip_stop_times.iloc[0]['departed_at']
-              # print('start_time: {}'.format(start_time))
-              end_time = round_trip_stop_times.iloc[-1]['arrived_at']
-              # print('end_time: {}'.format(end_time))
-
-              local_trip_list.append(Trip(
-                route_name, route_id, 'N', vehicle_id, start_time, end_time,
-                northbound_indices.shape[0]))
-              # else:
-              #   pseudo_invalid_trip_count += 1
-        global_trip_list.extend(local_trip_list)
-
-  return global_trip_list
+  stop_ids = stop_time_index.stop_ids[stop_time_rows]
 
+  if len(terminal_stops) == 0:
+    stats.count('assignments_on_routes_without_terminal')
+    return concatenate_trip_tables([])
 
-def process_driver_assignment(
-    index_queue, response_queue, driver_start_time, driver_end_time, bus_number,
-    route_id,
-    driver_id, vehicle_id, warnings):
-  i = index_queue.get()
+  if stop_ids.shape[0] == 0:
+    stats.count('assignments_without_stop_times')
+    return concatenate_trip_tables([])
+
+  terminal_stop_id = terminal_stops['stop_id'].unique()[0]
+
+  northbound_stop_ids = route_stops[
+    route_stops.heading == 'N']['stop_id'].values.astype(np.uint32)
 
+  southbound_stop_ids = route_stops[
+    route_stops.heading == 'S']['stop_id'].values.astype(np.uint32)
+
+  # the stop time index orders stop times by arrived_at then departed_at
+  headings, start_indices, end_indices, stop_counts = segment_trips(
+    stop_ids, terminal_stop_id, northbound_stop_ids, southbound_stop_ids,
+    stats)
+
+  # all stops given belong to a single route and vehicle
+  trip_count = headings.shape[0]
+  route_id = stop_time_index.route_ids[stop_time_rows][0]
+  route_name = route_stops['route_name'].values[0]
+  vehicle_id = stop_time_index.vehicle_ids[stop_time_rows][0]
+
+  return TripTable(
+    np.repeat(route_name, trip_count), np.repeat(route_id, trip_count),
+    headings, np.repeat(vehicle_id, trip_count),
+    np.repeat(driver_id, trip_count), np.repeat(bus_number, trip_count),
+    np.repeat(vehicle_assignment_id, trip_count),
+    stop_time_index.departed_at[stop_time_rows][start_indices],
+    stop_time_index.arrived_at[stop_time_rows][end_indices], stop_counts,
+    np.zeros(trip_count + 1, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+
+def init_worker(route_stop_data):
+  """Bind the route stops to a module global once per pool worker so that
+  they need not be serialized along with every driver assignment"""
+  global route_stop_df
+
+  route_stop_df = route_stop_data
+
+
+def trip_worker_pool(route_stop_df, process_count=None):
+  """Return a pool of process_count workers (one per cpu by default) for
+  assign_warnings_to_trips() that hold the given route stops"""
+  return Pool(processes=process_count, initializer=init_worker,
+              initargs=(route_stop_df,))
+
+
+def process_driver_assignment(
+    driver_start_time, driver_end_time, bus_number, route_id, driver_id,
+    vehicle_id, vehicle_assignment_id, stop_time_index, warning_index, stats):
   # here we assume that any bus on the given route for the given
   # driver during a given trip (of multiple trips) will not switch to
   # a different route and then switch back.
@@ -312,249 +485,580 @@ def process_driver_assignment(
   # the driver's trip start time but precede the route's initial stop,
   # warnings during that interval will be ignored and only those
   # occurring after the first stop departure will be included
-  driver_stop_times = stop_time_df.query(
-    'route_id == @route_id & '
-    'vehicle_id == @vehicle_id & '
-    'departed_at >= @driver_start_time & '
-    'arrived_at < @driver_end_time')
-
-  driver_stop_times = driver_stop_times.sort_values(
-    ['arrived_at', 'departed_at'])
-
-  driver_stop_times.set_index(
-    pd.RangeIndex(driver_stop_times.shape[0]), inplace=True)
-
-  # collect set of stops for the given route
-  route_stops = route_stop_df[route_stop_df['route_id'] == route_id]
-  route_stops = route_stops.sort_values(['heading', 'sequence'])
-  route_stops.set_index(pd.RangeIndex(route_stops.shape[0]), inplace=True)
-
-  route_trip_list = construct_trip_list(route_stops, driver_stop_times)
-  # print('found {} route trips'.format(len(route_trip_list)))
-
-  # assume that warning and stop_time records have seconds in their
-  # timestamp
-  for j in range(len(route_trip_list)):
-    trip = route_trip_list[j]
-    trip.driver_id = driver_id
-    trip.bus_number = bus_number
-
-    trip_warnings = warnings.query(
-      'bus_number == @trip.bus_number & '
-      'loc_time >= @trip.start_time & '
-      'loc_time < @trip.end_time')
-
-    if trip_warnings.shape[0] > 0:
-      trip.warnings = trip_warnings.assign(
-        **{'vehicle_id': np.tile(vehicle_id, trip_warnings.shape[0]),
-           'driver_id': np.tile(vehicle_id, trip_warnings.shape[0]),
-           'route_id': np.tile(route_id, trip_warnings.shape[0])})
-    else:
-      trip.warnings = pd.DataFrame(columns=np.concatenate(
-        (warnings.columns, np.array(['vehicle_id', 'driver_id', 'route_id']))))
-      # print('trip_warnings: {}'.format(trip_warnings))
+  with stats.phase('segment') as phase:
+    driver_stop_time_rows = stop_time_index.find_rows(
+      route_id, vehicle_id, driver_start_time, driver_end_time)
+
+    phase.rows_in += stop_time_index.stop_ids[driver_stop_time_rows].shape[0]
+
+    # collect set of stops for the given route
+    route_stops = route_stop_df[route_stop_df['route_id'] == route_id]
+    route_stops = route_stops.sort_values(['heading', 'sequence'])
+    route_stops.set_index(pd.RangeIndex(route_stops.shape[0]), inplace=True)
 
-  print('Process {} will return {} trips for bus_number: {}.'.format(
-    i, len(route_trip_list), bus_number))
+    route_trip_table = construct_trip_list(
+      route_stops, stop_time_index, driver_stop_time_rows, driver_id,
+      bus_number, vehicle_assignment_id, stats)
+    # print('found {} route trips'.format(len(route_trip_table)))
 
-  response_queue.put(route_trip_list)
-  response_queue.close()
-  index_queue.close()
+    phase.rows_out += len(route_trip_table)
+
+  with stats.phase('assign', rows_in=len(route_trip_table)) as phase:
+    # assume that warning and stop_time records have seconds in their
+    # timestamp
+    range_starts, range_ends = warning_index.find_ranges(
+      route_trip_table.bus_numbers, route_trip_table.start_times,
+      route_trip_table.end_times)
+
+    route_trip_table.warning_offsets, route_trip_table.warning_indices = \
+      warning_index.take_ranges(range_starts, range_ends)
+
+    phase.rows_out += route_trip_table.warning_indices.shape[0]
+
+  stats.count('trips', len(route_trip_table))
+  stats.count('trips_without_warnings', np.count_nonzero(
+    route_trip_table.warning_counts() == 0))
+
+  return route_trip_table
+
+
+def process_driver_assignment_batch(batch):
+  """Construct trips for each of a batch of driver assignments in a pool
+  worker, given with the stop time and warning indices that they are looked
+  up in, and return them together in a TripTable so that a single message is
+  sent back per batch rather than per assignment, along with the PipelineStats
+  of the batch"""
+  stop_time_index, warning_index, driver_assignment_batch = batch
+
+  batch_stats = PipelineStats()
+  batch_stats.count('batches')
+  batch_stats.count('driver_assignments', len(driver_assignment_batch))
+
+  batch_trip_table = concatenate_trip_tables([
+    process_driver_assignment(
+      *driver_assignment, stop_time_index=stop_time_index,
+      warning_index=warning_index, stats=batch_stats)
+    for driver_assignment in driver_assignment_batch])
+
+  print('Process {} will return {} trips for {} driver assignments.'.format(
+    getpid(), len(batch_trip_table), len(driver_assignment_batch)))
+
+  return batch_trip_table, batch_stats
 
 
 def assign_warnings_to_trips(
-    route_stop_df, stop_time_df, vehicle_assignment_df, warning_df):
+    route_stop_df, stop_time_df, vehicle_assignment_df, warning_df,
+    process_count=None, batch_size=64, stats=None, shared_array_dir=None,
+    pool=None):
   """
   Given four pandas data frames representing warning events, route stops,
-  stop events and driver schedules, construct a list of individual route trips,
-  assign warning events that occurred during each trip to that trip, then return
-  the complete list.
+  stop events and driver schedules, construct a table of individual route
+  trips, assign warning events that occurred during each trip to that trip,
+  then return the complete TripTable.
+
+  Driver assignments are distributed in batches of batch_size over a pool of
+  process_count long-lived workers (one per cpu by default), each of which
+  receives the route stops once when it starts. Trips are collected in the
+  order in which batches finish rather than the order of assignments.
+
+  The arrays of the stop time and warning indices are shared with workers as
+  memory-mapped files in a temporary directory created in shared_array_dir
+  (by default, the system's temporary directory), so that workers do not
+  each hold a copy of them regardless of the multiprocessing start method.
+  Each batch is sent with the indices, which are pickled as the paths of
+  their files.
+
+  A run that calls this once per partition of its driver assignments can
+  pass a pool returned by trip_worker_pool() for the route stops, so that its
+  workers are started once, along with the directory in which to write the
+  files of each partition's indices, which are removed once its trips are
+  returned.
+
+  If a PipelineStats is given, the index phase is recorded in it and the
+  statistics returned by workers are added to it.
   """
-  # global trips_with_no_warnings
-
-  global_trip_list = []
-  # print('vehicle_assignment_df:\n{}'.format(vehicle_assignment_df.describe()))
-  # stop_time_df.sort_values(['arrived_at', 'departed_at'], inplace=True)
-  # stop_time_df.set_index(pd.RangeIndex(stop_time_df.shape[0]), inplace=True)
-
-  relevant_route_ids = stop_time_df['route_id'].unique()
-  print('route ids among stop times: {}'.format(relevant_route_ids))
-  # since DASH A routes are not in teh DB yet...
-  available_route_ids = route_stop_df['route_id'].unique()
-  print('route ids among route stops: {}'.format(available_route_ids))
-
-  for route_id in relevant_route_ids:
-    if route_id in available_route_ids:
-      # collect all driver assignments for the given route for all time
-      vehicles_that_ran_route = vehicle_assignment_df[
-        vehicle_assignment_df['route_id'] == route_id]
-      # print('relevant_vehicle_assignments:\n{}'.format(relevant_vehicle_assignments))
-
-      # identify unique set of vehicle ids for all time
-      unique_vehicle_ids = vehicles_that_ran_route['vehicle_id'].unique()
-      # print('unique_vehicle_ids:\n{}  '.format(unique_vehicle_ids))
-
-      for vehicle_id in unique_vehicle_ids:
-        relevant_vehicle_assignments = vehicles_that_ran_route[
-          vehicles_that_ran_route['vehicle_id'] == vehicle_id]
-
-        relevant_driver_ids = relevant_vehicle_assignments['driver_id'].unique()
-
-        for driver_id in relevant_driver_ids:
-          driver_assignments = relevant_vehicle_assignments[
-            relevant_vehicle_assignments['driver_id'] == driver_id]
-
-          if driver_assignments.shape[0] > 0:
-            print('Processing {} driver_assignments for driver_id: {}, '
-                  'vehicle_id: {}, route_id: {}'.format(
-              driver_assignments.shape[0] + 1, driver_id, vehicle_id, route_id))
-
-            process_count = cpu_count()
-
-            round_count = np.floor_divide(
-              driver_assignments.shape[0], process_count)
-
-            for j in range(round_count + 1):
-              processes = {}
-              index_queues = {}
-              response_queues = {}
-
-              for i in range(process_count) if j < round_count else range(
-                      driver_assignments.shape[0] - round_count * process_count):
-                index_queue = Queue(maxsize=1)
-                index_queue.put(j * process_count + i)
-                index_queues[i] = index_queue
-
-                response_queue = Queue(maxsize=1)
-                response_queues[i] = response_queue
-
-                process = Process(target=process_driver_assignment, args=(
-                  index_queue, response_queue,
-                  driver_assignments.iloc[j * process_count + i].start_time,
-                  driver_assignments.iloc[j * process_count + i].end_time,
-                  driver_assignments.iloc[j * process_count + i].bus_number,
-                  route_id, driver_id, vehicle_id, warning_df))
-
-                process.start()
-                processes[i] = process
-
-              for i in range(process_count) if j < round_count else range(
-                      driver_assignments.shape[0] - round_count * process_count):
-                global_trip_list.extend(response_queues[i].get())
-
-                try:
-                  processes[i].join(timeout=180)
-                  processes[i].terminate()
-                except:
-                  print('killing process {}'.format(processes[i].pid))
-                  kill(processes[i].pid, SIGKILL)
-
-                response_queues[i].close()
-                index_queues[i].close()
-    else:
-      print('missing definition for route with id {}'.format(route_id))
-
-  # print('valid_trip_count: {}'.format(valid_trip_count))
-  # print('invalid_trip_count: {}'.format(invalid_trip_count))
-  # print('pseudo_invalid_trip_count: {}'.format(pseudo_invalid_trip_count))
-  # print('trips_with_no_warnings: {}'.format(trips_with_no_warnings))
+  if stats is None:
+    stats = PipelineStats()
+
+  if pool is None:
+    with trip_worker_pool(route_stop_df, process_count) as pool, \
+        TemporaryDirectory(prefix='bus_ped_', dir=shared_array_dir) as \
+        shared_array_dir:
+      return assign_warnings_to_trips(
+        route_stop_df, stop_time_df, vehicle_assignment_df, warning_df,
+        batch_size=batch_size, stats=stats, shared_array_dir=shared_array_dir,
+        pool=pool)
+
+  with stats.phase('index', rows_in=vehicle_assignment_df.shape[0]
+                   + stop_time_df.shape[0] + warning_df.shape[0]) as phase:
+    # print('vehicle_assignment_df:\n{}'.format(vehicle_assignment_df.describe()))
+    # stop_time_df.sort_values(['arrived_at', 'departed_at'], inplace=True)
+    # stop_time_df.set_index(pd.RangeIndex(stop_time_df.shape[0]), inplace=True)
+
+    relevant_route_ids = stop_time_df['route_id'].unique()
+    print('route ids among stop times: {}'.format(relevant_route_ids))
+    # since DASH A routes are not in teh DB yet...
+    available_route_ids = route_stop_df['route_id'].unique()
+    print('route ids among route stops: {}'.format(available_route_ids))
+
+    driver_assignment_list = []
+
+    for route_id in relevant_route_ids:
+      if route_id in available_route_ids:
+        # collect all driver assignments for the given route for all time
+        vehicles_that_ran_route = vehicle_assignment_df[
+          vehicle_assignment_df['route_id'] == route_id]
+        # print('relevant_vehicle_assignments:\n{}'.format(relevant_vehicle_assignments))
+
+        # identify unique set of vehicle ids for all time
+        unique_vehicle_ids = vehicles_that_ran_route['vehicle_id'].unique()
+        # print('unique_vehicle_ids:\n{}  '.format(unique_vehicle_ids))
+
+        for vehicle_id in unique_vehicle_ids:
+          relevant_vehicle_assignments = vehicles_that_ran_route[
+            vehicles_that_ran_route['vehicle_id'] == vehicle_id]
+
+          relevant_driver_ids = \
+            relevant_vehicle_assignments['driver_id'].unique()
+
+          for driver_id in relevant_driver_ids:
+            driver_assignments = relevant_vehicle_assignments[
+              relevant_vehicle_assignments['driver_id'] == driver_id]
+
+            if driver_assignments.shape[0] > 0:
+              print('Queueing {} driver_assignments for driver_id: {}, '
+                    'vehicle_id: {}, route_id: {}'.format(
+                driver_assignments.shape[0], driver_id, vehicle_id, route_id))
+
+              driver_assignment_list.extend(zip(
+                driver_assignments['start_time'],
+                driver_assignments['end_time'],
+                driver_assignments['bus_number'],
+                np.repeat(route_id, driver_assignments.shape[0]),
+                np.repeat(driver_id, driver_assignments.shape[0]),
+                np.repeat(vehicle_id, driver_assignments.shape[0]),
+                driver_assignments['vehicle_assignment_id']))
+      else:
+        print('missing definition for route with id {}'.format(route_id))
+        stats.count('routes_without_definition')
+
+    # sort stop times and warnings once for all trips and publish the sorted
+    # arrays for workers to map
+    stop_time_index = StopTimeIndex(stop_time_df)
+    stop_time_index.share_arrays(shared_array_dir)
+
+    warning_index = WarningIndex(warning_df)
+    warning_index.share_arrays(shared_array_dir)
+
+    phase.rows_out += len(driver_assignment_list)
+
+  driver_assignment_batches = [
+    (stop_time_index, warning_index, driver_assignment_list[i:i + batch_size])
+    for i in range(0, len(driver_assignment_list), batch_size)]
+
+  print('Processing {} driver_assignments in {} batches'.format(
+    len(driver_assignment_list), len(driver_assignment_batches)))
+
+  trip_tables = []
+
+  shared_array_paths = list(stop_time_index.shared_array_paths.values()) \
+    + list(warning_index.shared_array_paths.values())
+
+  try:
+    for batch_trip_table, batch_stats in pool.imap_unordered(
+        process_driver_assignment_batch, driver_assignment_batches):
+      trip_tables.append(batch_trip_table)
+      stats.add_worker(batch_stats)
+  finally:
+    # unmap the shared arrays before their files are removed
+    del stop_time_index, warning_index, driver_assignment_batches
+
+    for shared_array_path in shared_array_paths:
+      remove(shared_array_path)
+
+  print('pipeline counters: {}'.format(stats.counters))
   # TODO: handle unassigned warnings
-  return global_trip_list
+  return concatenate_trip_tables(trip_tables)
+
+
+def trip_name_categoricals(trip_table, categories):
+  """Return the route names and headings of the trips in a TripTable as pandas
+  categoricals with the route_name and heading categories in categories, if
+  any, and otherwise their ordered_categories()"""
+  return [pd.Categorical(values, categories=categories[column_name]
+                         if column_name in categories
+                         else ordered_categories(column_name, set(values)))
+          for column_name, values in [
+            ('route_name', trip_table.route_names),
+            ('heading', trip_table.headings.astype(object))]]
+
+
+def construct_longitudinal_data_product(
+    trip_table, warning_df, categories=None):
+  """Given a TripTable with warnings assigned, and the warning data frame into
+  which its warning indices point, create longitudinal records and return them
+  as a pandas data frame. Warnings of all trips are counted together by
+  encoding each warning name as its position in warnings_header and binning
+  (trip, warning) pairs. Warnings with names not in warnings_header are not
+  counted. Route names and headings are categoricals with the categories in
+  categories, keyed by column name, if any."""
+  if categories is None:
+    categories = {}
+
+  trip_count = len(trip_table)
+  warning_type_count = warnings_header.shape[0]
+
+  trip_indices = trip_table.warning_trip_indices()
+
+  # recode the categories of the warning names as positions in
+  # warnings_header rather than recoding every assigned warning, with an
+  # extra trailing code of -1 onto which missing names (code -1) fall
+  warning_names = pd.Categorical(warning_df['warning_name'])
+
+  header_codes = np.append(pd.Categorical(
+    warning_names.categories, categories=warnings_header).codes, -1)
+
+  warning_codes = header_codes[
+    warning_names.codes[trip_table.warning_indices]]
+  is_known = warning_codes >= 0
+
+  warning_data = np.bincount(
+    trip_indices[is_known] * warning_type_count + warning_codes[is_known],
+    minlength=trip_count * warning_type_count).reshape(
+    (trip_count, warning_type_count)).astype(np.uint16)
+
+  route_names, headings = trip_name_categoricals(trip_table, categories)
+
+  output_data = pd.DataFrame({
+    'route_name': route_names,
+    'route_id': trip_table.route_ids,
+    'heading': headings,
+    'driver_id': trip_table.driver_ids,
+    'vehicle_id': trip_table.vehicle_ids,
+    'bus_number': trip_table.bus_numbers,
+    'start_time': trip_table.start_times,
+    'end_time': trip_table.end_times}, columns=longitudinal_header[:8])
+
+  for j in range(warning_type_count):
+    output_data[warnings_header[j]] = warning_data[:, j]
+
+  # identify the driver assignment from which each trip was derived so that
+  # the records of an assignment can be replaced when it is reprocessed
+  output_data['vehicle_assignment_id'] = trip_table.vehicle_assignment_ids
 
+  # print('output_data: {}'.format(output_data.describe()))
 
-def construct_longitudinal_data_product(trip_list):
-  """Given a list of Trip objects with warnings assigned, create longitudinal
-  records and return them as a numpy array """
-  output_data = np.ndarray((len(trip_list),), dtype=longitudinal_type)
+  return output_data
+
+
+def construct_hotspot_data_product(trip_table, warning_df, categories=None):
+  """Given a TripTable with warnings assigned, and the warning data frame into
+  which its warning indices point, create one hotspot record per trip warning
+  and return them as a pandas data frame. Output columns are allocated once
+  for all warnings and filled by repeating trip attributes over each trip's
+  warnings and taking warning attributes from warning_df. Route names,
+  headings and warning names are categoricals, of which only the codes are
+  repeated, with the categories in categories, keyed by column name, if
+  any."""
+  if categories is None:
+    categories = {}
+
+  warning_count = trip_table.warning_indices.shape[0]
 
-  # trip being aggregated
-  for i in range(len(trip_list)):
-    trip = trip_list[i]
+  trip_indices = trip_table.warning_trip_indices()
 
-    trip_data = np.array([[
-      trip.route_name, trip.route_id, trip.heading, trip.driver_id,
-      trip.vehicle_id,
-      trip.bus_number, trip.start_time, trip.end_time]])
+  route_names, headings = trip_name_categoricals(trip_table, categories)
 
-    unique_warnings, counts = np.unique(
-      trip.warnings.loc[:, 'warning_name'].values, return_counts=True)
-    print('unique_warnings:\n{},\ncount:\n{}'.format(unique_warnings, counts))
-    warning_data = np.zeros((1, warnings_header.shape[0]))
-    print('warning_data:\n{}'.format(warning_data))
+  trip_data = {
+    'route_name': route_names,
+    'route_id': trip_table.route_ids,
+    'heading': headings,
+    'driver_id': trip_table.driver_ids,
+    'vehicle_id': trip_table.vehicle_ids,
+    'bus_number': trip_table.bus_numbers,
+    'vehicle_assignment_id': trip_table.vehicle_assignment_ids}
 
-    for j in range(unique_warnings.shape[0]):
-      index = np.nonzero(warnings_header == unique_warnings[j])
+  warning_data = {
+    'loc_time': warning_df['loc_time'].values.astype(
+      'datetime64[ns]', copy=False),
+    'warning_name': pd.Categorical(
+      warning_df['warning_name'], categories=categories.get('warning_name')),
+    'latitude': warning_df['latitude'].values.astype(np.float64, copy=False),
+    'longitude': warning_df['longitude'].values.astype(
+      np.float64, copy=False)}
 
-      if len(index) > 0:
-        assert len(index) == 1
-        warning_data[0, index] = counts[j]
+  output_data = {}
 
-    trip_data = np.squeeze(np.concatenate((trip_data, warning_data), axis=1))
-    print('trip_data:\n{}'.format(trip_data))
+  def take(column_data, indices):
+    if isinstance(column_data, pd.Categorical):
+      codes = np.empty(warning_count, dtype=column_data.codes.dtype)
+      np.take(column_data.codes, indices, out=codes)
+      return pd.Categorical.from_codes(codes, dtype=column_data.dtype)
 
-    output_data[i] = tuple(trip_data)
+    values = np.empty(warning_count, dtype=column_data.dtype)
+    np.take(column_data, indices, out=values)
+    return values
 
-  output_data = pd.DataFrame(output_data)
+  for column_name, column_data in trip_data.items():
+    output_data[column_name] = take(column_data, trip_indices)
+
+  for column_name, column_data in warning_data.items():
+    output_data[column_name] = take(column_data, trip_table.warning_indices)
+
+  output_data = pd.DataFrame(output_data, columns=np.append(
+    hotspot_header, 'vehicle_assignment_id'))
 
   # print('output_data: {}'.format(output_data.describe()))
 
   return output_data
 
 
-def construct_hotspot_data_product(trip_list):
-  output_data = np.ndarray(
-    (sum([trip.warnings.shape[0] for trip in trip_list]),), dtype=hotspot_type)
+def identify_unassigned_warnings(trip_table, warning_df):
+  """use the warning indices assigned to trips to identify warnings in
+  warning_df that are not assigned to any trip, and those that are assigned to
+  more than one trip, by counting the assignments of each warning in a single
+  pass"""
+  assignment_counts = np.bincount(
+    trip_table.warning_indices, minlength=warning_df.shape[0])
 
-  index = 0
+  unassigned_warnings = warning_df[assignment_counts == 0]
+  multiply_assigned_warnings = warning_df[assignment_counts > 1]
 
-  for trip in trip_list:
-    if trip.warnings.shape[0] > 0:
-      warning_data = trip.warnings.loc[:, ['loc_time', 'warning_name',
-                                           'latitude', 'longitude']].values
+  print('found {} unassigned and {} multiply assigned warnings among {}'.format(
+    unassigned_warnings.shape[0], multiply_assigned_warnings.shape[0],
+    warning_df.shape[0]))
 
-      trip_data = np.tile([
-        trip.route_name, trip.route_id, trip.heading, trip.driver_id,
-        trip.vehicle_id, trip.bus_number], (warning_data.shape[0], 1))
+  return unassigned_warnings, multiply_assigned_warnings
 
-      output_data[index:index + warning_data.shape[0]] = np.apply_along_axis(
-        to_tuple, 1, np.concatenate((trip_data, warning_data), axis=1))
 
-      index += warning_data.shape[0]
+def format_datetime(timestamp):
+  """Format a timestamp as pandas stores it in SQLite so that it can be compared
+  with stored timestamps as text"""
+  return pd.Timestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')
 
-  output_data = pd.DataFrame(output_data)
 
-  # print('output_data: {}'.format(output_data.describe()))
+def format_id_list(ids):
+  return ', '.join(str(int(i)) for i in ids)
 
-  return output_data
+
+# the columns of source tables that are needed to construct trips
+stop_time_columns = [
+  'route_id', 'vehicle_id', 'stop_id', 'arrived_at', 'departed_at']
+
+vehicle_assignment_columns = [
+  'vehicle_assignment_id', 'vehicle_id', 'route_id', 'driver_id',
+  'start_time', 'end_time', 'bus_number']
+
+# in streaming mode, warnings are identified by their rowid so that unassigned
+# warnings can be found in the warning table once all partitions are done
+streamed_warning_columns = [
+  'rowid as warning_rowid', 'loc_time', 'bus_number', 'warning_name',
+  'latitude', 'longitude']
 
 
-# also identify duplicates when a record is dropped for the second time
-def identify_unassigned_warnings(trip_list, warning_df):
-  """use the indices of warning data frames assigned to trips to identify
-  warnings in warning_df that are not assigned to any trip, """
-  w = warning_df.copy()
-  print('initial w len: {}'.format(w.shape[0]))
+def read_table(db, table_name, parse_dates, conditions, params, columns=None):
+  """Read the given columns (by default, all columns) of the records of the
+  given table that satisfy all of the given SQL conditions, with each ? in a
+  condition bound to the next of params"""
+  return pd.read_sql(
+    'select {} from {} where {}'.format(
+      '*' if columns is None else ', '.join(columns), table_name,
+      ' and '.join(conditions)),
+    db, params=params, parse_dates=parse_dates)
 
-  for trip in trip_list:
-    try:
-      w = w.drop(trip.warnings.index)
-    except ValueError as ve:
-      print('1. {}'.format(ve))
-      try:
-        w = w.drop(list(set(
-          warning_df.index.values).intersection(trip.warnings.index.values)))
-      except Exception as e:
-        print('2. {}'.format(e))
-        # pass
 
-  print('initial w len: {}'.format(w.shape[0]))
+def parse_shard(shard):
+  """Parse a shard given as K/N, meaning the Kth of N shards, where 0 <= K < N"""
+  try:
+    shard_index, shard_count = [int(i) for i in shard.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+      'expected a shard of the form K/N but got {}'.format(shard))
 
-  for i in range(0, w.shape[0], 10000):
-    print(w.iloc[i])
+  if not 0 <= shard_index < shard_count:
+    raise argparse.ArgumentTypeError(
+      'expected 0 <= K < N but got {}'.format(shard))
 
-  print('final w len: {}'.format(w.shape[0]))
+  return shard_index, shard_count
 
-  return w
+
+def select_shard(vehicle_assignment_df, shard_index, shard_count):
+  """Return the driver assignments whose (route_id, vehicle_id) pair belongs to
+  the given shard. Pairs are assigned to shards by a hash of their values, so a
+  given pair belongs to the same shard in every run regardless of which other
+  pairs are present. Since trips never cross routes or vehicles, shards can be
+  processed independently."""
+  pairs = vehicle_assignment_df[['route_id', 'vehicle_id']].drop_duplicates()
+
+  pair_shard_indices = np.array([crc32('{}:{}'.format(
+    int(route_id), int(vehicle_id)).encode()) % shard_count
+    for route_id, vehicle_id in pairs.values], dtype=np.int64)
+
+  is_in_shard = pd.MultiIndex.from_frame(
+    vehicle_assignment_df[['route_id', 'vehicle_id']]).isin(
+    pd.MultiIndex.from_frame(pairs[pair_shard_indices == shard_index]))
+
+  return vehicle_assignment_df[is_in_shard]
+
+
+def read_vehicle_assignments(
+    db, table_name, route_ids, start=None, end=None,
+    processed_assignment_table_name=None, vehicle_ids=None):
+  """Read the driver assignments on the given routes (and optionally, of the
+  given vehicles) that start within [start, end), excluding those recorded as
+  processed in the given table"""
+  conditions = ['route_id in ({})'.format(format_id_list(route_ids))]
+  params = []
+
+  if vehicle_ids is not None:
+    conditions.append('vehicle_id in ({})'.format(format_id_list(vehicle_ids)))
+
+  if start is not None:
+    conditions.append('start_time >= ?')
+    params.append(format_datetime(start))
+
+  if end is not None:
+    conditions.append('start_time < ?')
+    params.append(format_datetime(end))
+
+  if processed_assignment_table_name is not None:
+    conditions.append(
+      'vehicle_assignment_id not in (select vehicle_assignment_id from {})'
+        .format(processed_assignment_table_name))
+
+  return read_table(db, table_name, ['start_time', 'end_time'], conditions,
+                    params, vehicle_assignment_columns)
+
+
+def read_partitions(db, table_name, route_ids, by_vehicle=False, start=None,
+                    end=None):
+  """Return the partitions into which driver assignments on the given routes
+  that start within [start, end) are divided in streaming mode, either one per
+  route or one per (route_id, vehicle_id) pair, as a list of pairs of route
+  id and vehicle id lists (with None for all vehicles)"""
+  if not by_vehicle:
+    return [([route_id], None) for route_id in route_ids]
+
+  conditions = ['route_id in ({})'.format(format_id_list(route_ids))]
+  params = []
+
+  if start is not None:
+    conditions.append('start_time >= ?')
+    params.append(format_datetime(start))
+
+  if end is not None:
+    conditions.append('start_time < ?')
+    params.append(format_datetime(end))
+
+  pairs = pd.read_sql(
+    'select distinct route_id, vehicle_id from {} where {} '
+    'order by route_id, vehicle_id'.format(table_name, ' and '.join(conditions)),
+    db, params=params)
+
+  return [([route_id], [vehicle_id]) for route_id, vehicle_id in pairs.values]
+
+
+def read_name_categories(db, route_stop_df, warning_table_name):
+  """Return the categories of the route_name, heading and warning_name columns
+  of a run, keyed by column name, from the route stops and from the distinct
+  warning names of the warning table"""
+  warning_name_df = pd.read_sql(
+    'select distinct warning_name from {} where warning_name is not null'
+      .format(warning_table_name), db)
+
+  return {
+    'route_name': list(route_stop_df['route_name'].cat.categories),
+    'heading': list(route_stop_df['heading'].cat.categories),
+    'warning_name': ordered_categories(
+      'warning_name', warning_name_df['warning_name'])}
+
+
+def read_assignment_span(
+    db, stop_event_table_name, warning_table_name, vehicle_assignment_df,
+    warning_columns=None):
+  """Read the stop times and warnings within the span of the given driver
+  assignments on their routes, vehicles and buses, with the given warning
+  columns (by default, all columns)"""
+  first_start_time = vehicle_assignment_df['start_time'].min()
+  last_end_time = vehicle_assignment_df['end_time'].max()
+
+  # stop times are bounded by arrival so that the stop time index can be
+  # used, assuming that no bus remains at a stop for more than a day
+  stop_time_df = read_table(
+    db, stop_event_table_name, ['arrived_at', 'departed_at'], [
+      'route_id in ({})'.format(
+        format_id_list(vehicle_assignment_df['route_id'].unique())),
+      'vehicle_id in ({})'.format(
+        format_id_list(vehicle_assignment_df['vehicle_id'].unique())),
+      'arrived_at >= ?', 'arrived_at < ?', 'departed_at >= ?'], [
+      format_datetime(first_start_time - pd.Timedelta(days=1)),
+      format_datetime(last_end_time), format_datetime(first_start_time)],
+    stop_time_columns)
+
+  warning_df = read_table(
+    db, warning_table_name, ['loc_time'],
+    *assignment_span_warning_conditions(vehicle_assignment_df),
+    columns=warning_columns)
+
+  return stop_time_df, warning_df
+
+
+def assignment_span_warning_conditions(vehicle_assignment_df):
+  """Return the SQL conditions and their params that select the warnings of
+  the buses of the given driver assignments within the span of those
+  assignments"""
+  return [
+    'bus_number in ({})'.format(
+      format_id_list(vehicle_assignment_df['bus_number'].unique())),
+    'loc_time >= ?', 'loc_time < ?'], [
+    format_datetime(vehicle_assignment_df['start_time'].min()),
+    format_datetime(vehicle_assignment_df['end_time'].max())]
+
+
+def replace_assignment_records(
+    connection, table_name, data, schema, vehicle_assignment_ids):
+  """Delete the records of the given driver assignments from the given table,
+  if it exists, then append the given records"""
+  if table_exists(connection, table_name):
+    connection.execute('delete from {} where vehicle_assignment_id in ({})'.format(
+      table_name, format_id_list(vehicle_assignment_ids)))
+
+  write_table(connection, table_name, data, schema, if_exists='append')
+
+
+def write_unassigned_warnings(
+    connection, warning_table_name, table_name, assigned_warning_rowids,
+    conditions=(), params=(), if_exists='append'):
+  """Copy the warnings that satisfy all of the given SQL conditions and whose
+  rowids are not among the given rowids of assigned warnings from the warning
+  table to the given table within SQLite, so that the warning table need not
+  be read into memory. Return the number of warnings copied."""
+  schema = table_schemas['unassigned_warning']
+  column_names = ', '.join(
+    quote(column_name) for column_name, _ in schema['columns'])
+
+  prepare_table(connection, table_name, schema, if_exists)
+
+  connection.execute(
+    'create temp table assigned_warning (warning_rowid integer primary key)')
+  connection.executemany(
+    'insert or ignore into assigned_warning values (?)',
+    ((int(rowid),) for rowid in assigned_warning_rowids))
+
+  unassigned_warning_count = connection.execute(
+    'insert into {} ({}) select {} from {} where {}'.format(
+      quote(table_name), column_names, column_names,
+      quote(warning_table_name), ' and '.join(
+        ['rowid not in (select warning_rowid from assigned_warning)']
+        + list(conditions))), params).rowcount
+
+  connection.execute('drop table temp.assigned_warning')
+
+  create_indices(connection, table_name, schema)
+
+  print('wrote {} records to {}'.format(unassigned_warning_count, table_name))
+
+  return unassigned_warning_count
 
 
 if __name__ == '__main__':
@@ -570,84 +1074,346 @@ if __name__ == '__main__':
                       default='hotspot_data_product')
   parser.add_argument('--longitudinal_record_table_name',
                       default='longitudinal_data_product')
+  parser.add_argument('--unassigned_warning_table_name',
+                      default='unassigned_warning')
   parser.add_argument('--if_exists', default='append')
+  # by default, the pool will contain one worker per cpu
+  parser.add_argument('--process_count', type=int, default=None)
+  parser.add_argument('--batch_size', type=int, default=64)
+  # the directory in which to create the temporary directory of arrays shared
+  # with workers, preferably on a memory-backed file system such as /dev/shm
+  parser.add_argument('--shared_array_dir', default=None)
+  # optionally restrict processing to driver assignments that start within
+  # [start, end), e.g. --start 2018-02-01 --end 2018-03-01
+  parser.add_argument('--start', default=None)
+  parser.add_argument('--end', default=None)
+  # process only driver assignments not yet recorded in the processed
+  # assignment table and replace any existing records of those assignments
+  # (--if_exists is ignored)
+  parser.add_argument('--incremental', action='store_true')
+  parser.add_argument('--processed_assignment_table_name',
+                      default='processed_vehicle_assignment')
+
+  # optionally restrict processing to the given route ids and/or to the Kth of
+  # N deterministic shards of (route_id, vehicle_id) pairs, writing partial
+  # data products to --partial_db_path (by default, a database named after
+  # --db_path and the partition)
+  parser.add_argument('--routes', type=int, nargs='+', default=None)
+  parser.add_argument('--shard', type=parse_shard, default=None)
+  parser.add_argument('--partial_db_path', default=None)
+
+  # optionally process driver assignments one route (or one vehicle on a
+  # route) at a time, reading only the stop times and warnings of that
+  # partition and appending its data products before moving on, so that
+  # memory use depends on the size of the largest partition rather than on
+  # the whole history
+  parser.add_argument('--streaming', action='store_true')
+  parser.add_argument('--partition_by', choices=['route', 'vehicle'],
+                      default='route')
+
+  # the JSON run report is written to --run_report_path (by default, a file
+  # named after --db_path and the start time of the run) and summarized in
+  # the --run_table_name table of the database to which products are written
+  parser.add_argument('--run_report_path', default=None)
+  parser.add_argument('--run_table_name', default='pipeline_run')
 
   args = parser.parse_args()
 
+  if args.incremental and (args.routes is not None or args.shard is not None):
+    parser.error('--incremental cannot be combined with --routes or --shard')
+
+  started_at = datetime.now()
+
+  if args.run_report_path is None:
+    args.run_report_path = '{}_run_{}.json'.format(
+      path.splitext(args.db_path)[0], started_at.strftime('%Y%m%d_%H%M%S'))
+
+  stats = PipelineStats()
+
+  load_start_time = perf_counter()
+
   db_path = 'sqlite:///' + args.db_path
 
   db = create_engine(db_path)
 
-  route_stop_df = pd.read_sql_table(args.route_stop_table_name, db)
+  route_stop_df = compact_table(
+    pd.read_sql_table(args.route_stop_table_name, db))
   # print('route_stop_df:\n{}'.format(route_stop_df.describe()))
 
-  # Allow for a subset of data to be processed based on a date range
-  # start_datetime_str = '02/01/2018 00:00:00'
-  # start_datetime = datetime.strptime(
-  #   start_datetime_str, '%m/%d/%Y %H:%M:%S').strftime('%m-%d-%Y %H:%M:%S')
-  start_datetime = None  # '2018-02-01 00:00:00'
-  # end_datetime_str = '02/28/2018 23:59:59'
-  # end_datetime = datetime.strptime(
-  #   end_datetime_str, '%m/%d/%Y %H:%M:%S').strftime('%m-%d-%Y %H:%M:%S')
-  end_datetime = None  # '2018-02-28 23:59:59'
-
-  if start_datetime is not None and end_datetime is not None:
-    stop_time_df = pd.read_sql(
-      'select * from {} where arrived_at >= datetime(\'{}\') and arrived_at <= '
-      'datetime(\'{}\')'.format(args.stop_event_table_name, start_datetime,
-                                end_datetime), con=db)
+  # every table read by this run holds route names, headings and warning names
+  # with the same categories, so that the tables of all partitions can be
+  # combined without recoding them
+  name_categories = read_name_categories(
+    db, route_stop_df, args.warning_table_name)
+
+  route_ids = route_stop_df['route_id'].unique()
+
+  if args.routes is not None:
+    route_ids = np.intersect1d(route_ids, args.routes)
+
+  # A run restricted to a subset of routes or to a shard of (route_id,
+  # vehicle_id) pairs writes its partial data products to a separate database
+  # so that the outputs of several such runs can be combined with
+  # merge_data_product_shards.py
+  is_partial = args.routes is not None or args.shard is not None
+
+  if is_partial and args.partial_db_path is None:
+    args.partial_db_path = '{}_{}.sqlite'.format(
+      path.splitext(args.db_path)[0],
+      'shard_{}_of_{}'.format(*args.shard) if args.shard is not None
+      else 'routes_{}'.format('_'.join(str(i) for i in args.routes)))
+
+  output_db_path = args.partial_db_path if is_partial else args.db_path
+
+  # In incremental mode, driver assignments recorded as processed by a previous
+  # run are skipped and the assignments processed by this run are recorded in
+  # the same transaction in which their records are written
+  if args.incremental:
+    with bulk_load_transaction(args.db_path) as connection:
+      create_table(connection, args.processed_assignment_table_name,
+                   table_schemas['processed_vehicle_assignment'])
+
+  # Allow for a subset of data to be processed based on a date range. Driver
+  # assignments that start within [start, end) are selected, along with the
+  # stop times and warnings that fall within the span of those assignments,
+  # so that assignments that cross the end of the range are not truncated
+  is_subset = args.start is not None or args.end is not None or \
+              args.incremental or is_partial or args.streaming
+
+  # in streaming mode, each route or (route_id, vehicle_id) pair is processed
+  # in turn. Otherwise, all routes are processed together.
+  if args.streaming:
+    partitions = read_partitions(
+      db, args.driver_schedule_table_name, route_ids,
+      args.partition_by == 'vehicle', args.start, args.end)
   else:
-    stop_time_df = pd.read_sql_table(args.stop_event_table_name, db)
-  print('stop_time_df:\n{}'.format(stop_time_df.describe()))
-
-  if start_datetime is not None and end_datetime is not None:
-    vehicle_assignment_df = pd.read_sql(
-      'select * from {} where arrived_at >= datetime(\'%s\',\'{}\') and arrived_at <= '
-      'datetime(\'%s\',\'{}\')'.format(args.stop_event_table_name,
-                                       start_datetime,
-                                       end_datetime), con=db)
-  else:
-    vehicle_assignment_df = pd.read_sql_table(
-      args.driver_schedule_table_name, db)
-  print('vehicle_assignment_df:\n{}'.format(vehicle_assignment_df.describe()))
-
-  if start_datetime is not None and end_datetime is not None:
-    warning_df = pd.read_sql(
-      'select * from {} where arrived_at >= \'{}\' and arrived_at <= '
-      '\'{}\''.format(args.stop_event_table_name, start_datetime,
-                      end_datetime), con=db)
-  else:
-    warning_df = pd.read_sql_table(args.warning_table_name, db)
-  print('warning_df:\n{}'.format(warning_df.describe()))
-
-  # extend warning df to include columns that uniquely identify trips so that
-  # warnings assigned to multiple runs can be discovered.
-  # warning_ext = pd.DataFrame(
-  #   data=np.zeros((warning_df.shape[0], 3), dtype=np.uint32),
-  #   columns=['vehicle_id', 'driver_id', 'route_id'], index=warning_df.index)
-  #
-  # warning_df = pd.concat([warning_df, warning_ext], axis=1)
-
-  print('warning_df head:\n{}'.format(warning_df.head(2)))
-
-  trip_list = assign_warnings_to_trips(
-    route_stop_df, stop_time_df, vehicle_assignment_df, warning_df)
-  print('found {} total trips'.format(len(trip_list)))
-
-  # unassigned_warning_data = identify_unassigned_warnings(trip_list, warning_df)
-  # unassigned_warning_data.to_sql(
-  #   'unassigned_warning', db, if_exists=args.if_exists, chunksize=1000000,
-  #   index=False)
-  # print(unassigned_warning_data.describe())
-
-  longitudinal_data = construct_longitudinal_data_product(trip_list)
-  longitudinal_data.to_sql(
-    args.longitudinal_record_table_name, db, if_exists=args.if_exists,
-    chunksize=1000000, index=False)
-  print(longitudinal_data.describe())
-
-  hotspot_data = construct_hotspot_data_product(trip_list)
-  hotspot_data.to_sql(
-    args.hotspot_record_table_name, db, if_exists=args.if_exists,
-    chunksize=1000000, index=False)
-  print(hotspot_data.describe())
+    partitions = [(route_ids, None)]
+
+  stats.add_phase('load', perf_counter() - load_start_time,
+                  rows_out=route_stop_df.shape[0])
+
+  stats.count('partitions', len(partitions))
+
+  # partial data products replace those of a previous run of the same
+  # partition, and the products of each streamed partition after the first
+  # are appended to those of the partitions before it
+  if_exists = 'replace' if is_partial else args.if_exists
+
+  assignment_count = 0
+
+  # the rowids of warnings assigned to trips and the spans of the buses of
+  # driver assignments, so that unassigned warnings can be identified in
+  # streaming mode
+  assigned_warning_rowids = []
+  streamed_assignment_spans = []
+
+  # the workers are started once and reused by every partition, which
+  # publishes the arrays of its indices to them in a single directory
+  pool = trip_worker_pool(route_stop_df, args.process_count)
+  shared_array_dir = TemporaryDirectory(
+    prefix='bus_ped_', dir=args.shared_array_dir)
+
+  for partition_route_ids, partition_vehicle_ids in partitions:
+    load_start_time = perf_counter()
+
+    if is_subset:
+      vehicle_assignment_df = read_vehicle_assignments(
+        db, args.driver_schedule_table_name, partition_route_ids, args.start,
+        args.end,
+        args.processed_assignment_table_name if args.incremental else None,
+        partition_vehicle_ids)
+
+      if args.shard is not None:
+        vehicle_assignment_df = select_shard(
+          vehicle_assignment_df, *args.shard)
+
+      if vehicle_assignment_df.shape[0] == 0:
+        stats.add_phase('load', perf_counter() - load_start_time)
+        continue
+
+      stop_time_df, warning_df = read_assignment_span(
+        db, args.stop_event_table_name, args.warning_table_name,
+        vehicle_assignment_df,
+        streamed_warning_columns if args.streaming else None)
+    else:
+      vehicle_assignment_df = pd.read_sql_table(
+        args.driver_schedule_table_name, db)
+      stop_time_df = pd.read_sql_table(args.stop_event_table_name, db)
+      warning_df = pd.read_sql_table(args.warning_table_name, db)
+
+    vehicle_assignment_df, stop_time_df, warning_df = [
+      compact_table(data, name_categories) for data in [
+        vehicle_assignment_df, stop_time_df, warning_df]]
+
+    stats.add_phase('load', perf_counter() - load_start_time, rows_out=(
+        vehicle_assignment_df.shape[0] + stop_time_df.shape[0]
+        + warning_df.shape[0]))
+
+    assignment_count += vehicle_assignment_df.shape[0]
+
+    if args.streaming:
+      print('processing partition of routes {} and vehicles {}'.format(
+        partition_route_ids, partition_vehicle_ids))
+
+    print('vehicle_assignment_df:\n{}'.format(vehicle_assignment_df.describe()))
+    print('stop_time_df:\n{}'.format(stop_time_df.describe()))
+    print('warning_df:\n{}'.format(warning_df.describe()))
+
+    # extend warning df to include columns that uniquely identify trips so
+    # that warnings assigned to multiple runs can be discovered.
+    # warning_ext = pd.DataFrame(
+    #   data=np.zeros((warning_df.shape[0], 3), dtype=np.uint32),
+    #   columns=['vehicle_id', 'driver_id', 'route_id'], index=warning_df.index)
+    #
+    # warning_df = pd.concat([warning_df, warning_ext], axis=1)
+
+    print('warning_df head:\n{}'.format(warning_df.head(2)))
+
+    trip_table = assign_warnings_to_trips(
+      route_stop_df, stop_time_df, vehicle_assignment_df, warning_df,
+      batch_size=args.batch_size, stats=stats,
+      shared_array_dir=shared_array_dir.name, pool=pool)
+    print('found {} total trips'.format(len(trip_table)))
+
+    with stats.phase('aggregate', rows_in=len(trip_table)) as phase:
+      longitudinal_data = construct_longitudinal_data_product(
+        trip_table, warning_df, name_categories)
+
+      hotspot_data = construct_hotspot_data_product(
+        trip_table, warning_df, name_categories)
+
+      phase.rows_out += longitudinal_data.shape[0] + hotspot_data.shape[0]
+
+    print(longitudinal_data.describe())
+    print(hotspot_data.describe())
+
+    if args.incremental:
+      # only the warnings of processed buses within the span of processed
+      # assignments are read, so unassigned warnings are not identified
+      vehicle_assignment_ids = vehicle_assignment_df['vehicle_assignment_id']
+
+      with stats.phase('write', rows_in=longitudinal_data.shape[0]
+                       + hotspot_data.shape[0]), \
+          bulk_load_transaction(args.db_path) as connection:
+        replace_assignment_records(
+          connection, args.longitudinal_record_table_name, longitudinal_data,
+          table_schemas['longitudinal_data_product'], vehicle_assignment_ids)
+        replace_assignment_records(
+          connection, args.hotspot_record_table_name, hotspot_data,
+          table_schemas['hotspot_data_product'], vehicle_assignment_ids)
+
+        write_table(
+          connection, args.processed_assignment_table_name, pd.DataFrame({
+            'vehicle_assignment_id': vehicle_assignment_ids.values,
+            'processed_at': pd.Timestamp.now()}),
+          table_schemas['processed_vehicle_assignment'], if_exists='append')
+
+      print('recorded {} processed driver assignments'.format(
+        vehicle_assignment_ids.shape[0]))
+    elif is_partial or args.streaming:
+      # warnings of a bus may be assigned to trips in other partitions, so
+      # unassigned warnings are not identified per partition
+      if args.streaming:
+        assigned_warning_rowids.append(
+          warning_df['warning_rowid'].values[trip_table.warning_indices])
+        streamed_assignment_spans.append(
+          vehicle_assignment_df[['start_time', 'end_time', 'bus_number']])
+
+      with stats.phase('write', rows_in=longitudinal_data.shape[0]
+                       + hotspot_data.shape[0]), \
+          bulk_load_transaction(output_db_path) as connection:
+        write_table(
+          connection, args.longitudinal_record_table_name, longitudinal_data,
+          table_schemas['longitudinal_data_product'], if_exists=if_exists)
+
+        write_table(
+          connection, args.hotspot_record_table_name, hotspot_data,
+          table_schemas['hotspot_data_product'], if_exists=if_exists)
+
+      if is_partial:
+        print('wrote partial data products to {}'.format(
+          args.partial_db_path))
+    else:
+      with stats.phase('aggregate', rows_in=warning_df.shape[0]) as phase:
+        unassigned_warning_data, multiply_assigned_warning_data = \
+          identify_unassigned_warnings(trip_table, warning_df)
+
+        phase.rows_out += unassigned_warning_data.shape[0]
+
+      stats.count('unassigned_warnings', unassigned_warning_data.shape[0])
+      stats.count('multiply_assigned_warnings',
+                  multiply_assigned_warning_data.shape[0])
+
+      print(unassigned_warning_data.describe())
+
+      with stats.phase('write', rows_in=unassigned_warning_data.shape[0]
+                       + longitudinal_data.shape[0] + hotspot_data.shape[0]), \
+          bulk_load_transaction(args.db_path) as connection:
+        write_table(
+          connection, args.unassigned_warning_table_name,
+          unassigned_warning_data, table_schemas['unassigned_warning'],
+          if_exists=args.if_exists)
+
+        write_table(
+          connection, args.longitudinal_record_table_name, longitudinal_data,
+          table_schemas['longitudinal_data_product'], if_exists=if_exists)
+
+        write_table(
+          connection, args.hotspot_record_table_name, hotspot_data,
+          table_schemas['hotspot_data_product'], if_exists=if_exists)
+
+    if_exists = 'append'
+
+    # release the data of this partition before reading the next one
+    del vehicle_assignment_df, stop_time_df, warning_df, trip_table, \
+      longitudinal_data, hotspot_data
+
+  pool.close()
+  pool.join()
+  shared_array_dir.cleanup()
+
+  if assignment_count == 0:
+    print('no driver assignments to process start between {} and {}'.format(
+      args.start, args.end))
+
+    # leave empty partial data products to be merged with those of other
+    # partitions
+    if is_partial:
+      with stats.phase('write'), \
+          bulk_load_transaction(args.partial_db_path) as connection:
+        for table_name, schema_name in [
+            (args.longitudinal_record_table_name, 'longitudinal_data_product'),
+            (args.hotspot_record_table_name, 'hotspot_data_product')]:
+          write_table(connection, table_name, pd.DataFrame(columns=[
+            column_name for column_name, _ in
+            table_schemas[schema_name]['columns']]),
+                      table_schemas[schema_name], if_exists='replace')
+  elif args.streaming and not (args.incremental or is_partial):
+    # unassigned warnings are those that were not assigned to a trip of any
+    # partition among the warnings that would have been read had all
+    # partitions been processed together: those of the whole warning table,
+    # or, given a date range, those of the buses of all driver assignments
+    # within the span of those assignments
+    assigned_warning_rowids, assignment_counts = np.unique(
+      np.concatenate(assigned_warning_rowids), return_counts=True)
+
+    if args.start is not None or args.end is not None:
+      warning_conditions, warning_params = assignment_span_warning_conditions(
+        pd.concat(streamed_assignment_spans, ignore_index=True))
+    else:
+      warning_conditions, warning_params = [], []
+
+    stats.count('multiply_assigned_warnings',
+                np.count_nonzero(assignment_counts > 1))
+
+    with stats.phase('write') as phase, \
+        bulk_load_transaction(args.db_path) as connection:
+      phase.rows_in += write_unassigned_warnings(
+        connection, args.warning_table_name,
+        args.unassigned_warning_table_name, assigned_warning_rowids,
+        warning_conditions, warning_params, if_exists=args.if_exists)
+
+    stats.count('unassigned_warnings', phase.rows_in)
+
+  write_run_report(stats, started_at, vars(args), args.run_report_path,
+                   output_db_path, args.run_table_name)
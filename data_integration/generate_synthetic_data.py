@@ -0,0 +1,283 @@
+import argparse
+import numpy as np
+import pandas as pd
+from compact_dtypes import compact_table
+from sqlite_bulk_load import bulk_load_transaction, table_schemas, write_table
+
+# This script creates or replaces the route_stop, stop_time,
+# vehicle_assignment and warning tables in the database at the supplied path
+# with synthetic DASH data, so that the data product generator can be run and
+# measured without the LADOT and Ituran exports. Tables have the columns and
+# data types produced by the add_*_to_db.py scripts.
+#
+# Each route has a northbound and a southbound sequence of stops, with the
+# first northbound stop as its terminal. Each bus runs a single route and, on
+# each day, a shift of round trips from the terminal that is split evenly
+# between a number of drivers. Stop times include the kinds of noise found in
+# the real exports: stops that are missed, stops reported twice, and stops
+# that are not on the route. Warnings are reported uniformly over each shift
+# and the hour around it, so that some fall outside of any trip, and a few
+# have names that are not counted in the longitudinal data product.
+
+warning_names = np.array([
+  'ME - Pedestrian Collision Warning', 'ME - Pedestrian In Range Warning',
+  'PCW-LF', 'PCW-LR', 'PCW-RR', 'PDZ - Left Front', 'PDZ-LR', 'PDZ-R',
+  'Safety - Braking - Aggressive', 'Safety - Braking - Dangerous'],
+  dtype=object)
+
+uncounted_warning_names = np.array([
+  'Safety - Speeding', 'ME - Lane Departure Warning'], dtype=object)
+
+# an id that does not belong to any route, reported for unrecognized stops
+unknown_stop_id = 99999
+
+
+def generate_route_stops(route_count, stops_per_bound):
+  """Generate stops_per_bound northbound and stops_per_bound southbound stops
+  for each of route_count routes"""
+  route_ids = np.repeat(np.arange(1, route_count + 1), 2 * stops_per_bound)
+  headings = np.tile(np.repeat(np.array(['N', 'S'], dtype=object),
+                               stops_per_bound), route_count)
+  sequences = np.tile(np.arange(1, stops_per_bound + 1), 2 * route_count)
+
+  stop_ids = route_ids * 1000 + np.where(headings == 'N', 100, 200) + sequences
+
+  # stops are laid out along a north-south line per route
+  offsets = np.where(headings == 'N', sequences, 2 * stops_per_bound + 1
+                     - sequences) / (2 * stops_per_bound)
+
+  return pd.DataFrame({
+    'route_id': route_ids.astype(np.uint32),
+    'route_name': np.array(['DASH {}'.format(route_id)
+                            for route_id in route_ids], dtype=object),
+    'stop_id': stop_ids.astype(np.uint32),
+    'stop_name': np.array(['Stop {}'.format(stop_id)
+                           for stop_id in stop_ids], dtype=object),
+    'latitude': 34.0 + 0.02 * offsets,
+    'longitude': -118.3 + 0.01 * route_ids,
+    'heading': headings,
+    'sequence': sequences.astype(np.uint8),
+    'is_terminal': (headings == 'N') & (sequences == 1)})
+
+
+def generate_synthetic_tables(
+    route_count=5, bus_count=10, day_count=7, warnings_per_trip=5.0,
+    round_trips_per_day=8, stops_per_bound=20, shifts_per_day=2,
+    noise_rate=0.005, start_date='2018-02-01', seed=0):
+  """Generate synthetic route stops, stop times, driver assignments and
+  warnings for bus_count buses on each of route_count routes over day_count
+  days, and return them as a dictionary of pandas data frames keyed by the
+  default table name. warnings_per_trip is the mean number of warnings per
+  one-way trip and noise_rate is the rate of each kind of stop time noise."""
+  rng = np.random.default_rng(seed)
+
+  route_stop_data = generate_route_stops(route_count, stops_per_bound)
+
+  # stop times are generated as one row of stop events per shift, i.e. per
+  # (route, bus, day), and flattened after noise is applied
+  shift_count = route_count * bus_count * day_count
+
+  shift_route_ids = np.repeat(
+    np.arange(1, route_count + 1), bus_count * day_count)
+  shift_vehicle_ids = np.repeat(
+    np.arange(route_count * bus_count), day_count) + 1
+  shift_days = np.tile(np.arange(day_count), route_count * bus_count)
+
+  # each shift is a sequence of round trips that begins and ends at the
+  # terminal
+  round_trip = np.arange(2 * stops_per_bound)
+  stop_offsets = np.append(np.tile(round_trip, round_trips_per_day), 0)
+  stop_event_count = stop_offsets.shape[0]
+
+  stop_ids = shift_route_ids[:, np.newaxis] * 1000 + np.where(
+    stop_offsets < stops_per_bound, 100 + stop_offsets + 1,
+    200 + stop_offsets - stops_per_bound + 1)[np.newaxis, :]
+
+  is_reported_twice = rng.random((shift_count, stop_event_count)) < noise_rate
+  is_reported_twice[:, 0] = False
+  stop_ids[is_reported_twice] = np.roll(stop_ids, 1, axis=1)[is_reported_twice]
+
+  stop_ids[rng.random((shift_count, stop_event_count)) < noise_rate] = \
+    unknown_stop_id
+
+  is_reported = rng.random((shift_count, stop_event_count)) >= noise_rate
+
+  # buses dwell at each stop for 5 to 60 seconds and travel between stops for
+  # 1 to 4 minutes
+  dwell_seconds = rng.integers(5, 60, (shift_count, stop_event_count))
+  travel_seconds = rng.integers(60, 240, (shift_count, stop_event_count))
+
+  arrival_seconds = np.cumsum(dwell_seconds + travel_seconds, axis=1) \
+                    - dwell_seconds - travel_seconds
+
+  shift_start_times = np.datetime64(start_date, 's') \
+                      + np.timedelta64(6 * 3600, 's') \
+                      + shift_days * np.timedelta64(86400, 's') \
+                      + rng.integers(0, 1800, shift_count).astype(
+    'timedelta64[s]')
+
+  shift_end_times = shift_start_times + (
+      arrival_seconds[:, -1] + dwell_seconds[:, -1]).astype('timedelta64[s]')
+
+  arrived_at = shift_start_times[:, np.newaxis] \
+               + arrival_seconds.astype('timedelta64[s]')
+  departed_at = arrived_at + dwell_seconds.astype('timedelta64[s]')
+
+  stop_latitudes = np.where(
+    stop_offsets < stops_per_bound, stop_offsets + 1,
+    3 * stops_per_bound - stop_offsets) / (2 * stops_per_bound)
+
+  def flatten(values):
+    return values[is_reported]
+
+  def repeat_per_shift(values):
+    return np.broadcast_to(
+      values[:, np.newaxis], (shift_count, stop_event_count))[is_reported]
+
+  stop_time_count = np.count_nonzero(is_reported)
+
+  arrival_latitudes = 34.0 + 0.02 * np.broadcast_to(
+    stop_latitudes, (shift_count, stop_event_count))[is_reported] \
+                      + rng.normal(0, 1e-4, stop_time_count)
+  arrival_longitudes = -118.3 + 0.01 * repeat_per_shift(shift_route_ids) \
+                       + rng.normal(0, 1e-4, stop_time_count)
+
+  stop_time_data = pd.DataFrame({
+    'stop_id': flatten(stop_ids).astype(np.uint32),
+    'route_id': repeat_per_shift(shift_route_ids).astype(np.uint32),
+    'vehicle_id': repeat_per_shift(shift_vehicle_ids).astype(np.uint16),
+    'arrived_at': flatten(arrived_at).astype('datetime64[ns]'),
+    'arrival_latitude': arrival_latitudes,
+    'arrival_longitude': arrival_longitudes,
+    'departed_at': flatten(departed_at).astype('datetime64[ns]'),
+    'departure_latitude': arrival_latitudes + rng.normal(
+      0, 1e-4, stop_time_count),
+    'departure_longitude': arrival_longitudes + rng.normal(
+      0, 1e-4, stop_time_count),
+    'stop_time_id': np.arange(1, stop_time_count + 1, dtype=np.uint64)})
+
+  # each shift is split evenly between shifts_per_day drivers, and each bus
+  # has the same drivers every day
+  shift_durations = shift_end_times - shift_start_times
+  assignment_count = shift_count * shifts_per_day
+
+  shift_indices = np.repeat(np.arange(shift_count), shifts_per_day)
+  shift_parts = np.tile(np.arange(shifts_per_day), shift_count)
+
+  assignment_start_times = shift_start_times[shift_indices] \
+                           + shift_durations[shift_indices] * shift_parts \
+                           // shifts_per_day
+  assignment_end_times = shift_start_times[shift_indices] \
+                         + shift_durations[shift_indices] * (shift_parts + 1) \
+                         // shifts_per_day + np.timedelta64(1, 's')
+
+  driver_ids = (shift_vehicle_ids[shift_indices] * shifts_per_day
+                + shift_parts + 1000).astype(np.uint32)
+
+  vehicle_assignment_data = pd.DataFrame({
+    'vehicle_assignment_id': np.arange(
+      1, assignment_count + 1, dtype=np.uint64),
+    'vehicle_id': shift_vehicle_ids[shift_indices].astype(np.uint32),
+    'route_id': shift_route_ids[shift_indices].astype(np.uint32),
+    'driver_id': driver_ids,
+    'start_time': assignment_start_times.astype('datetime64[ns]'),
+    'end_time': assignment_end_times.astype('datetime64[ns]'),
+    'bus_number': (15000 + shift_vehicle_ids[shift_indices]).astype(np.uint32),
+    'first_name': np.array(['Driver'] * assignment_count, dtype=object),
+    'last_name': np.array([str(driver_id) for driver_id in driver_ids],
+                          dtype=object),
+    'badge_number': driver_ids})
+
+  vehicle_assignment_data.sort_values(
+    ['start_time', 'end_time'], inplace=True)
+  vehicle_assignment_data.set_index(
+    pd.RangeIndex(vehicle_assignment_data.shape[0]), inplace=True)
+
+  # warnings are reported over the shift and the half hour before and after
+  shift_warning_counts = rng.poisson(
+    warnings_per_trip * 2 * round_trips_per_day, shift_count)
+  warning_count = int(shift_warning_counts.sum())
+
+  warning_shift_indices = np.repeat(np.arange(shift_count), shift_warning_counts)
+
+  warning_seconds = (rng.random(warning_count) * (
+      shift_durations[warning_shift_indices].astype(np.int64) + 3600)).astype(
+    np.int64) - 1800
+
+  is_counted = rng.random(warning_count) >= noise_rate
+
+  warning_data = pd.DataFrame({
+    'loc_time': (shift_start_times[warning_shift_indices] + warning_seconds
+                 .astype('timedelta64[s]')).astype('datetime64[ns]'),
+    'bus_number': (15000 + shift_vehicle_ids[warning_shift_indices]).astype(
+      np.uint32),
+    'address': np.array(['Los Angeles, CA'] * warning_count, dtype=object),
+    'warning_name': np.where(
+      is_counted, warning_names[rng.integers(
+        0, warning_names.shape[0], warning_count)],
+      uncounted_warning_names[rng.integers(
+        0, uncounted_warning_names.shape[0], warning_count)]),
+    'latitude': 34.0 + 0.02 * rng.random(warning_count),
+    'longitude': -118.3 + 0.01 * shift_route_ids[warning_shift_indices]
+                 + rng.normal(0, 1e-3, warning_count)})
+
+  warning_data.sort_values(['loc_time', 'bus_number'], inplace=True)
+  warning_data.set_index(pd.RangeIndex(warning_data.shape[0]), inplace=True)
+
+  return {
+    'route_stop': compact_table(route_stop_data),
+    'stop_time': compact_table(stop_time_data),
+    'vehicle_assignment': compact_table(vehicle_assignment_data),
+    'warning': compact_table(warning_data)}
+
+
+def write_synthetic_tables(db_path, tables, table_names=None,
+                           if_exists='replace'):
+  """Write the tables returned by generate_synthetic_tables() to the database
+  at db_path in a single transaction, optionally under the table names given
+  in a dictionary keyed by the default table name"""
+  if table_names is None:
+    table_names = {}
+
+  with bulk_load_transaction(db_path) as connection:
+    for schema_name, data in tables.items():
+      write_table(connection, table_names.get(schema_name, schema_name), data,
+                  table_schemas[schema_name], if_exists=if_exists)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--db_path', default='synthetic_data.sqlite')
+  parser.add_argument('--route_stop_table_name', default='route_stop')
+  parser.add_argument('--stop_event_table_name', default='stop_time')
+  parser.add_argument('--driver_schedule_table_name',
+                      default='vehicle_assignment')
+  parser.add_argument('--warning_table_name', default='warning')
+  parser.add_argument('--if_exists', default='replace')
+  parser.add_argument('--route_count', type=int, default=5)
+  # the number of buses that run each route
+  parser.add_argument('--bus_count', type=int, default=10)
+  parser.add_argument('--day_count', type=int, default=7)
+  parser.add_argument('--warnings_per_trip', type=float, default=5.0)
+  parser.add_argument('--round_trips_per_day', type=int, default=8)
+  parser.add_argument('--stops_per_bound', type=int, default=20)
+  parser.add_argument('--shifts_per_day', type=int, default=2)
+  parser.add_argument('--noise_rate', type=float, default=0.005)
+  parser.add_argument('--start_date', default='2018-02-01')
+  parser.add_argument('--seed', type=int, default=0)
+
+  args = parser.parse_args()
+
+  tables = generate_synthetic_tables(
+    route_count=args.route_count, bus_count=args.bus_count,
+    day_count=args.day_count, warnings_per_trip=args.warnings_per_trip,
+    round_trips_per_day=args.round_trips_per_day,
+    stops_per_bound=args.stops_per_bound, shifts_per_day=args.shifts_per_day,
+    noise_rate=args.noise_rate, start_date=args.start_date, seed=args.seed)
+
+  write_synthetic_tables(args.db_path, tables, {
+    'route_stop': args.route_stop_table_name,
+    'stop_time': args.stop_event_table_name,
+    'vehicle_assignment': args.driver_schedule_table_name,
+    'warning': args.warning_table_name}, if_exists=args.if_exists)
@@ -0,0 +1,303 @@
+from collections import namedtuple
+import hashlib
+from os import path, stat
+import pandas as pd
+from sqlite_bulk_load import bulk_load_transaction, create_indices, \
+  create_table, prepare_table, quote, table_schemas, write_table
+
+# This module lets the add_*_to_db.py loaders skip source files that they have
+# already loaded. Each file loaded into a table is recorded in a manifest table
+# with an id, its size, modification time, a SHA-256 hash of its content and
+# the number of records loaded from it, and the rowid of each record that the
+# file contains is recorded with the id of the file in a record table (named
+# after the manifest table with a _record suffix). A record that several files
+# contain, i.e. that has the same primary key or, in a table without one, the
+# same values as a record already loaded, is stored once and recorded for each
+# of those files. A file is loaded again only if its content changed, in which
+# case the records that only it contained are deleted in the same transaction
+# in which its new records are written, so that a failed or interrupted load
+# leaves neither a partial file nor a stale manifest entry, and records that
+# other files also contain are kept. A file is not hashed again while its size
+# and modification time are unchanged, and a file with the same content as one
+# already loaded into the table under another path is not loaded twice.
+
+SourceFile = namedtuple('SourceFile', [
+  'file_path', 'file_size', 'modified_at_ns', 'content_hash'])
+
+
+def hash_file(file_path, chunk_size=1048576):
+  content_hash = hashlib.sha256()
+
+  with open(file_path, 'rb') as source_file:
+    for chunk in iter(lambda: source_file.read(chunk_size), b''):
+      content_hash.update(chunk)
+
+  return content_hash.hexdigest()
+
+
+def record_table_name_of(manifest_table_name):
+  return '{}_record'.format(manifest_table_name)
+
+
+def read_manifest(connection, manifest_table_name, table_name):
+  """Return the manifest records of the files loaded into the given table,
+  keyed by file path"""
+  cursor = connection.execute(
+    'SELECT file_path, file_size, modified_at_ns, content_hash FROM {} '
+    'WHERE table_name = ?'.format(quote(manifest_table_name)), (table_name,))
+
+  return {record[0]: SourceFile(*record) for record in cursor}
+
+
+def find_file_id(connection, manifest_table_name, table_name, file_path):
+  """Return the id of the given file in the manifest, or a new id if it has
+  not been loaded into the given table"""
+  file_id = connection.execute(
+    'SELECT file_id FROM {} WHERE table_name = ? AND file_path = ?'.format(
+      quote(manifest_table_name)), (table_name, file_path)).fetchone()
+
+  if file_id is not None:
+    return file_id[0]
+
+  return connection.execute(
+    'SELECT coalesce(max(file_id), 0) + 1 FROM {}'.format(
+      quote(manifest_table_name))).fetchone()[0]
+
+
+def find_changed_files(connection, manifest_table_name, table_name,
+                       file_paths):
+  """Return a SourceFile for each of the given files whose content has not
+  been loaded into the given table, and record in the manifest the new path,
+  size or modification time of files whose content has"""
+  manifest = read_manifest(connection, manifest_table_name, table_name)
+  loaded_hashes = {
+    source_file.content_hash: source_file.file_path
+    for source_file in manifest.values()}
+
+  changed_files = []
+
+  for file_path in file_paths:
+    file_path = path.abspath(file_path)
+    file_stat = stat(file_path)
+
+    previous_file = manifest.get(file_path)
+
+    if previous_file is not None \
+        and previous_file.file_size == file_stat.st_size \
+        and previous_file.modified_at_ns == file_stat.st_mtime_ns:
+      continue
+
+    source_file = SourceFile(file_path, file_stat.st_size,
+                             file_stat.st_mtime_ns, hash_file(file_path))
+
+    if previous_file is not None \
+        and previous_file.content_hash == source_file.content_hash:
+      # the file was touched but not changed
+      connection.execute(
+        'UPDATE {} SET file_size = ?, modified_at_ns = ? '
+        'WHERE table_name = ? AND file_path = ?'.format(
+          quote(manifest_table_name)),
+        (source_file.file_size, source_file.modified_at_ns, table_name,
+         file_path))
+    elif previous_file is None \
+        and source_file.content_hash in loaded_hashes:
+      print('skipping {}, which has the same content as {}'.format(
+        file_path, loaded_hashes[source_file.content_hash]))
+
+      # record that the copy contains the records of the original, so that
+      # they are kept while either file contains them
+      original_file_id, record_count = connection.execute(
+        'SELECT file_id, record_count FROM {} '
+        'WHERE table_name = ? AND file_path = ?'.format(
+          quote(manifest_table_name)),
+        (table_name, loaded_hashes[source_file.content_hash])).fetchone()
+      file_id = find_file_id(
+        connection, manifest_table_name, table_name, file_path)
+
+      connection.execute(
+        'INSERT OR IGNORE INTO {0} (file_id, record_rowid) '
+        'SELECT ?, record_rowid FROM {0} WHERE file_id = ?'.format(
+          quote(record_table_name_of(manifest_table_name))),
+        (file_id, original_file_id))
+
+      record_file(connection, manifest_table_name, table_name, source_file,
+                  file_id, record_count)
+    else:
+      # copies of a file that is not yet loaded are loaded with it, and the
+      # records that they both contain are stored once
+      changed_files.append(source_file)
+
+  return changed_files
+
+
+def record_file(connection, manifest_table_name, table_name, source_file,
+                file_id, record_count):
+  write_table(connection, manifest_table_name, pd.DataFrame({
+    'table_name': [table_name], 'file_path': [source_file.file_path],
+    'file_id': [file_id], 'file_size': [source_file.file_size],
+    'modified_at_ns': [source_file.modified_at_ns],
+    'content_hash': [source_file.content_hash],
+    'record_count': [record_count], 'ingested_at': [pd.Timestamp.now()]}),
+              table_schemas['ingested_file'], if_exists='append')
+
+
+def delete_file_records(connection, manifest_table_name, table_name, file_id):
+  """Delete the records that the given file contains and that no other file
+  loaded into the given table contains, and forget which records the file
+  contains"""
+  record_table_name = record_table_name_of(manifest_table_name)
+
+  connection.execute(
+    'DELETE FROM {0} WHERE rowid IN ('
+    'SELECT record_rowid FROM {1} WHERE file_id = ?) AND NOT EXISTS ('
+    'SELECT 1 FROM {1} AS other_record WHERE record_rowid = {0}.rowid '
+    'AND file_id != ? AND file_id IN ('
+    'SELECT file_id FROM {2} WHERE table_name = ?))'.format(
+      quote(table_name), quote(record_table_name), quote(manifest_table_name)),
+    (file_id, file_id, table_name))
+
+  connection.execute('DELETE FROM {} WHERE file_id = ?'.format(
+    quote(record_table_name)), (file_id,))
+
+
+def write_file_records(connection, table_name, schema, data,
+                       record_table_name, file_id):
+  """Write the given records of the given file to the given table and record
+  that the file contains them. Each record that has the same key as a record
+  already in the table (its primary key, or all of its values in a table
+  without one) replaces that record under the same rowid, so that the files
+  that contain the replaced record also contain the new one. Return the
+  number of distinct records written."""
+  column_names = [column_name for column_name, _ in schema['columns']]
+  key_column_names = schema['primary_key'] if len(schema['primary_key']) > 0 \
+    else column_names
+  staged_table_name = '{}_staged'.format(table_name)
+
+  data = data.drop_duplicates(key_column_names, keep='last')
+
+  # stage the records in a table of their own so that they can be matched
+  # with those of the table in SQLite. Keys are compared with IS so that
+  # missing values match
+  write_table(connection, staged_table_name, data, {
+    'columns': schema['columns'], 'primary_key': [], 'indices': []},
+              if_exists='replace')
+
+  quoted_column_names = ', '.join(
+    quote(column_name) for column_name in column_names)
+  key_condition = ' AND '.join(
+    'staged_record.{0} IS loaded_record.{0}'.format(quote(column_name))
+    for column_name in key_column_names)
+
+  connection.execute(
+    'CREATE TEMP TABLE matched_record AS '
+    'SELECT staged_record.rowid AS staged_rowid, '
+    'min(loaded_record.rowid) AS record_rowid '
+    'FROM {} AS staged_record JOIN {} AS loaded_record ON {} '
+    'GROUP BY staged_record.rowid'.format(
+      quote(staged_table_name), quote(table_name), key_condition))
+
+  # replace matched records in place, keeping their rowids
+  connection.execute(
+    'DELETE FROM {} WHERE rowid IN (SELECT record_rowid FROM matched_record)'
+      .format(quote(table_name)))
+  connection.execute(
+    'INSERT INTO {0} (rowid, {1}) SELECT matched_record.record_rowid, {2} '
+    'FROM matched_record JOIN {3} AS staged_record '
+    'ON staged_record.rowid = matched_record.staged_rowid'.format(
+      quote(table_name), quoted_column_names, ', '.join(
+        'staged_record.{}'.format(quote(column_name))
+        for column_name in column_names), quote(staged_table_name)))
+
+  # append the others
+  connection.execute(
+    'INSERT INTO {0} ({1}) SELECT {1} FROM {2} '
+    'WHERE rowid NOT IN (SELECT staged_rowid FROM matched_record)'.format(
+      quote(table_name), quoted_column_names, quote(staged_table_name)))
+
+  # find the rowids of all of the records by their keys, since a new record
+  # is not necessarily given a rowid above those of the records already in
+  # the table, e.g. if its INTEGER primary key is an alias of the rowid
+  connection.execute(
+    'INSERT OR IGNORE INTO {} (file_id, record_rowid) '
+    'SELECT ?, min(loaded_record.rowid) '
+    'FROM {} AS staged_record JOIN {} AS loaded_record ON {} '
+    'GROUP BY staged_record.rowid'.format(
+      quote(record_table_name), quote(staged_table_name), quote(table_name),
+      key_condition), (file_id,))
+
+  connection.execute('DROP TABLE temp.matched_record')
+  connection.execute('DROP TABLE {}'.format(quote(staged_table_name)))
+
+  return data.shape[0]
+
+
+def ingest_files(db_path, table_name, schema, file_paths, read_file,
+                 if_exists='append', manifest_table_name='ingested_file',
+                 map_function=map):
+  """Load the records of each of the given source files whose content has
+  not already been loaded into the given table, in one transaction per file.
+  read_file is called with the path of each changed file and returns its
+  records as a data frame, as an iterable of data frames that are written in
+  turn so that the file need not be held in memory at once, or None to skip
+  the file; it is applied with map_function, e.g. the imap method of a pool
+  to parse files in parallel.
+  If if_exists is 'replace', the table and its manifest records are replaced
+  and every file is loaded. Return the number of records loaded."""
+  record_table_name = record_table_name_of(manifest_table_name)
+
+  with bulk_load_transaction(db_path) as connection:
+    prepare_table(connection, table_name, schema, if_exists)
+    create_indices(connection, table_name, schema)
+
+    for manifest_schema_name, manifest_schema_table_name in [
+        ('ingested_file', manifest_table_name),
+        ('ingested_record', record_table_name)]:
+      create_table(connection, manifest_schema_table_name,
+                   table_schemas[manifest_schema_name])
+      create_indices(connection, manifest_schema_table_name,
+                     table_schemas[manifest_schema_name])
+
+    if if_exists == 'replace':
+      connection.execute(
+        'DELETE FROM {} WHERE file_id IN ('
+        'SELECT file_id FROM {} WHERE table_name = ?)'.format(
+          quote(record_table_name), quote(manifest_table_name)),
+        (table_name,))
+      connection.execute('DELETE FROM {} WHERE table_name = ?'.format(
+        quote(manifest_table_name)), (table_name,))
+
+    changed_files = find_changed_files(
+      connection, manifest_table_name, table_name, file_paths)
+
+  print('loading {} new or changed files of {} into {}'.format(
+    len(changed_files), len(file_paths), table_name))
+
+  record_count = 0
+
+  for source_file, data in zip(changed_files, map_function(
+      read_file, [source_file.file_path for source_file in changed_files])):
+    if data is None:
+      continue
+
+    with bulk_load_transaction(db_path) as connection:
+      file_id = find_file_id(
+        connection, manifest_table_name, table_name, source_file.file_path)
+
+      delete_file_records(
+        connection, manifest_table_name, table_name, file_id)
+
+      file_record_count = 0
+
+      for chunk in [data] if isinstance(data, pd.DataFrame) else data:
+        file_record_count += write_file_records(
+          connection, table_name, schema, chunk, record_table_name, file_id)
+
+      record_file(connection, manifest_table_name, table_name, source_file,
+                  file_id, file_record_count)
+
+    print('loaded {} records from {}'.format(
+      file_record_count, source_file.file_path))
+
+    record_count += file_record_count
+
+  return record_count
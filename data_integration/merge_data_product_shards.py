@@ -0,0 +1,58 @@
+import argparse
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlite_bulk_load import bulk_load_transaction, table_schemas, write_table
+
+# This script combines the partial data products written by runs of
+# generate_data_product_from_db.py restricted with --routes or --shard into the
+# hotspot_data_product and longitudinal_data_product tables of the database at
+# the supplied path. Since every (route_id, vehicle_id) pair belongs to exactly
+# one shard, the records of distinct shards never overlap and are simply
+# appended to one another.
+
+
+def merge_data_product_shards(
+    db_path, shard_db_paths, table_names, if_exists='replace',
+    chunk_size=1000000):
+  """Copy each of the given tables from every shard database into the
+  database at db_path, reading at most chunk_size records at a time. The
+  tables are given as pairs of a table name and the default table name under
+  which its schema is defined. if_exists applies to the first shard only;
+  records of the remaining shards are appended."""
+  with bulk_load_transaction(db_path) as connection:
+    for table_name, schema_name in table_names:
+      table_if_exists = if_exists
+
+      for shard_db_path in shard_db_paths:
+        shard_db = create_engine('sqlite:///' + shard_db_path)
+
+        for chunk in pd.read_sql_table(
+            table_name, shard_db, chunksize=chunk_size):
+          write_table(connection, table_name, chunk, table_schemas[schema_name],
+                      if_exists=table_if_exists)
+
+          table_if_exists = 'append'
+
+        shard_db.dispose()
+
+        print('merged {} from {}'.format(table_name, shard_db_path))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--db_path', default='ituran_synchromatics_data.sqlite')
+  parser.add_argument('--shard_db_paths', nargs='+', required=True)
+  parser.add_argument('--hotspot_record_table_name',
+                      default='hotspot_data_product')
+  parser.add_argument('--longitudinal_record_table_name',
+                      default='longitudinal_data_product')
+  parser.add_argument('--if_exists', default='replace')
+
+  args = parser.parse_args()
+
+  merge_data_product_shards(
+    args.db_path, args.shard_db_paths, [
+      (args.hotspot_record_table_name, 'hotspot_data_product'),
+      (args.longitudinal_record_table_name, 'longitudinal_data_product')],
+    if_exists=args.if_exists)
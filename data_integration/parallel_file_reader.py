@@ -0,0 +1,87 @@
+from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool
+from zipfile import BadZipFile
+import pandas as pd
+
+# This module parses source files such as the Ituran warning spreadsheets and
+# the route stop spreadsheets over a pool of worker processes, since parsing
+# with pd.read_excel is single-threaded and CPU-bound. Each file is read in a
+# worker by the given read_file function and its result is returned with the
+# error, if any, that made the file unreadable, so that one bad file does not
+# abort a load.
+# Files that cannot be read are instead added to a quarantine list, a
+# tab-separated file of the time, path and error of each failed read, to be
+# inspected and fixed before the files are loaded again.
+
+FileResult = namedtuple('FileResult', ['file_path', 'data', 'error'])
+
+
+# the errors raised by a source file that is missing, truncated (an .xlsx
+# spreadsheet is a zip archive) or cannot be parsed, which is quarantined. Any
+# other error, e.g. a value that does not fit its column, fails the load
+# rather than dropping the file
+unreadable_file_errors = (
+  OSError, UnicodeDecodeError, BadZipFile, pd.errors.EmptyDataError,
+  pd.errors.ParserError)
+
+
+def read_file_result(file_path, read_file):
+  """Return a FileResult of the records that read_file returns for the file
+  at file_path, or of the error that it raises if the file is unreadable"""
+  try:
+    return FileResult(file_path, read_file(file_path), None)
+  except unreadable_file_errors as e:
+    return FileResult(file_path, None, '{}: {}'.format(type(e).__name__, e))
+
+
+def quarantine_file(quarantine_path, file_result):
+  print('quarantining {}, which could not be read: {}'.format(
+    file_result.file_path, file_result.error))
+
+  with open(quarantine_path, 'a') as quarantine_file:
+    quarantine_file.write('{}\t{}\t{}\n'.format(
+      pd.Timestamp.now(), file_result.file_path,
+      ' '.join(file_result.error.split())))
+
+
+def read_files(file_paths, read_file, process_count=None):
+  """Read the given files over a pool of process_count workers (one per cpu
+  by default) and return a FileResult for each, in the order of file_paths"""
+  with Pool(processes=process_count) as pool:
+    return pool.map(
+      partial(read_file_result, read_file=read_file), file_paths, chunksize=1)
+
+
+def read_files_or_quarantine(file_paths, read_file, quarantine_path,
+                             process_count=None):
+  """Read the given files as read_files() does and return the records of
+  those that could be read, in the order of file_paths, adding the others to
+  the quarantine list at quarantine_path"""
+  file_data = []
+
+  for file_result in read_files(file_paths, read_file, process_count):
+    if file_result.error is None:
+      file_data.append(file_result.data)
+    else:
+      quarantine_file(quarantine_path, file_result)
+
+  return file_data
+
+
+def quarantining_map(quarantine_path, map_function=map):
+  """Return a function that, like map, applies read_file to each of the given
+  file paths with map_function, e.g. the imap method of a pool, and yields the
+  records of each file, or None for a file that cannot be read, which is
+  added to the quarantine list at quarantine_path. The function can be given
+  to ingestion_manifest.ingest_files() as its map_function."""
+  def map_files(read_file, file_paths):
+    for file_result in map_function(
+        partial(read_file_result, read_file=read_file), file_paths):
+      if file_result.error is None:
+        yield file_result.data
+      else:
+        quarantine_file(quarantine_path, file_result)
+        yield None
+
+  return map_files
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+from os import getpid
+import pandas as pd
+from time import perf_counter
+from sqlite_bulk_load import bulk_load_transaction, table_schemas, write_table
+
+# This module collects the wall time, the numbers of rows in and out and the
+# counts of notable events (e.g. the reasons that stop time windows are not
+# recognized as trips) of each phase of a data product run. Statistics are
+# collected separately by the main process and by each pool worker, which
+# returns them with its results, and are combined by the main process into a
+# single run report.
+#
+# The phases of a run are:
+#   load: reading source tables from the database
+#   index: queueing driver assignments and indexing stop times and warnings
+#   segment: finding the stop times of each driver assignment and splitting
+#     them into trips (in workers)
+#   assign: assigning warnings to trips (in workers)
+#   aggregate: building the data products and identifying unassigned warnings
+#   write: writing the data products to the database
+#
+# Worker phase times are summed over all workers, so they measure the compute
+# time spent in a phase rather than its contribution to the duration of a run.
+
+phase_names = ['load', 'index', 'segment', 'assign', 'aggregate', 'write']
+
+
+class PhaseStats:
+  def __init__(self):
+    self.seconds = 0.0
+    self.rows_in = 0
+    self.rows_out = 0
+    self.calls = 0
+
+  def merge(self, other):
+    self.seconds += other.seconds
+    self.rows_in += other.rows_in
+    self.rows_out += other.rows_out
+    self.calls += other.calls
+
+  def to_dict(self):
+    return {'seconds': self.seconds, 'rows_in': self.rows_in,
+            'rows_out': self.rows_out, 'calls': self.calls}
+
+
+class PipelineStats:
+  """Phase statistics and event counters of a process. Statistics returned by
+  workers are combined with those of the main process with add_worker(),
+  which also keeps them separately per worker process id."""
+  def __init__(self):
+    self.process_id = getpid()
+    self.phases = {}
+    self.counters = {}
+    self.workers = {}
+
+  @contextmanager
+  def phase(self, phase_name, rows_in=0):
+    """Time the enclosed block as a call to the given phase, yielding its
+    PhaseStats so that rows_in and rows_out can be added within the block"""
+    phase = self.phases.setdefault(phase_name, PhaseStats())
+    phase.rows_in += int(rows_in)
+    phase.calls += 1
+
+    start_time = perf_counter()
+
+    try:
+      yield phase
+    finally:
+      phase.seconds += perf_counter() - start_time
+
+  def add_phase(self, phase_name, seconds, rows_in=0, rows_out=0):
+    """Record a call to the given phase that was timed by the caller"""
+    phase = self.phases.setdefault(phase_name, PhaseStats())
+    phase.seconds += seconds
+    phase.rows_in += int(rows_in)
+    phase.rows_out += int(rows_out)
+    phase.calls += 1
+
+  def count(self, counter_name, count=1):
+    self.counters[counter_name] = \
+      self.counters.get(counter_name, 0) + int(count)
+
+  def merge(self, other):
+    for phase_name, phase in other.phases.items():
+      self.phases.setdefault(phase_name, PhaseStats()).merge(phase)
+
+    for counter_name, count in other.counters.items():
+      self.count(counter_name, count)
+
+  def add_worker(self, worker_stats):
+    self.merge(worker_stats)
+
+    if worker_stats.process_id not in self.workers:
+      self.workers[worker_stats.process_id] = PipelineStats()
+      self.workers[worker_stats.process_id].process_id = \
+        worker_stats.process_id
+
+    self.workers[worker_stats.process_id].merge(worker_stats)
+
+  def to_dict(self):
+    # list phases in the order in which they run
+    ordered_phase_names = [
+      phase_name for phase_name in phase_names
+      if phase_name in self.phases] + sorted(
+      set(self.phases).difference(phase_names))
+
+    stats = {
+      'phases': {phase_name: self.phases[phase_name].to_dict()
+                 for phase_name in ordered_phase_names},
+      'counters': dict(sorted(self.counters.items()))}
+
+    if len(self.workers) > 0:
+      stats['workers'] = [
+        dict(process_id=process_id, **worker_stats.to_dict())
+        for process_id, worker_stats in sorted(self.workers.items())]
+
+    return stats
+
+
+def write_run_report(stats, started_at, arguments, report_path, db_path,
+                     table_name='pipeline_run'):
+  """Write the statistics of a run that started at started_at with the given
+  command line arguments to a JSON file at report_path and append a summary
+  of them to the given table of the database at db_path"""
+  finished_at = datetime.now()
+
+  report = {
+    'started_at': started_at.isoformat(),
+    'finished_at': finished_at.isoformat(),
+    'seconds': (finished_at - started_at).total_seconds(),
+    'arguments': arguments}
+  report.update(stats.to_dict())
+
+  with open(report_path, 'w') as report_file:
+    json.dump(report, report_file, indent=2)
+
+  print('wrote run report to {}'.format(report_path))
+
+  run_record = {
+    'run_id': [None], 'started_at': [started_at], 'finished_at': [finished_at],
+    'seconds': [report['seconds']]}
+
+  for phase_name in phase_names:
+    run_record['{}_seconds'.format(phase_name)] = [
+      report['phases'][phase_name]['seconds']
+      if phase_name in report['phases'] else None]
+
+  run_record['report'] = [json.dumps(report)]
+
+  with bulk_load_transaction(db_path) as connection:
+    write_table(connection, table_name, pd.DataFrame(run_record),
+                table_schemas['pipeline_run'], if_exists='append')
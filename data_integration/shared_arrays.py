@@ -0,0 +1,53 @@
+import numpy as np
+from os import path
+
+# This module lets read-only indices be sent to pool workers without copying
+# their arrays into every worker. An index that derives from SharedArrays saves
+# its large arrays once as .npy files and replaces them with read-only
+# memory-mapped views of those files. When the index is pickled, e.g. as an
+# initializer argument of a pool that uses the spawn start method, only the
+# file paths of its shared arrays are sent, and the receiving process maps the
+# same files. When workers are forked instead, they inherit the mappings. In
+# both cases every process reads the same pages of the operating system's
+# file cache, so memory use does not grow with the number of workers, and
+# since the arrays are not python objects, reference counting in workers does
+# not cause their pages to be copied.
+#
+# The files are best placed in a directory on a memory-backed file system
+# such as /dev/shm or a tmpfs /tmp, which the caller is responsible for
+# removing once no process uses the index.
+
+
+class SharedArrays:
+  # the names of the array attributes to share, defined by each subclass
+  shared_array_names = []
+
+  def share_arrays(self, dir_path):
+    """Save each shared array attribute to a .npy file in dir_path and replace
+    it with a read-only memory-mapped view of that file"""
+    self.shared_array_paths = {}
+
+    for array_name in self.shared_array_names:
+      array_path = path.join(dir_path, '{}_{}_{}.npy'.format(
+        type(self).__name__, id(self), array_name))
+
+      np.save(array_path, getattr(self, array_name), allow_pickle=False)
+
+      self.shared_array_paths[array_name] = array_path
+
+      setattr(self, array_name, np.load(array_path, mmap_mode='r'))
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+
+    for array_name in getattr(self, 'shared_array_paths', {}):
+      del state[array_name]
+
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+
+    for array_name, array_path in getattr(
+        self, 'shared_array_paths', {}).items():
+      setattr(self, array_name, np.load(array_path, mmap_mode='r'))
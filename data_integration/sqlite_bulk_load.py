@@ -0,0 +1,258 @@
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import sqlite3
+
+# This module writes pandas data frames to tables in the SQLite database used by
+# the ingestion scripts and the data product generator. Rather than relying on
+# DataFrame.to_sql, which infers column types from each data frame and inserts
+# rows through SQLAlchemy, tables are created from the explicit schemas below
+# and filled with prepared inserts in a single transaction, with indices built
+# once the rows are in place.
+#
+# Timestamps are stored as text in the format that pandas uses so that tables
+# written here can be read with pd.read_sql_table and compared with timestamps
+# formatted by generate_data_product_from_db.format_datetime().
+
+# define the columns, primary key and indices of each table, keyed by the
+# default table name. Rows that repeat the primary key of an existing row
+# replace that row, so tables with a primary key are not duplicated when the
+# same source data is loaded twice
+table_schemas = {
+  'route_stop': {
+    'columns': [
+      ('route_id', 'INTEGER'), ('route_name', 'TEXT'), ('stop_id', 'INTEGER'),
+      ('stop_name', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL'),
+      ('heading', 'TEXT'), ('sequence', 'INTEGER'), ('is_terminal', 'BOOLEAN')],
+    'primary_key': ['route_id', 'heading', 'sequence'],
+    'indices': []},
+  # stop_time_ids are unique within a route but not across routes
+  'stop_time': {
+    'columns': [
+      ('stop_id', 'INTEGER'), ('route_id', 'INTEGER'), ('vehicle_id', 'INTEGER'),
+      ('arrived_at', 'TIMESTAMP'), ('arrival_latitude', 'REAL'),
+      ('arrival_longitude', 'REAL'), ('departed_at', 'TIMESTAMP'),
+      ('departure_latitude', 'REAL'), ('departure_longitude', 'REAL'),
+      ('stop_time_id', 'INTEGER')],
+    'primary_key': ['route_id', 'stop_time_id'],
+    'indices': [['route_id', 'vehicle_id', 'arrived_at']]},
+  'vehicle_assignment': {
+    'columns': [
+      ('vehicle_assignment_id', 'INTEGER'), ('vehicle_id', 'INTEGER'),
+      ('route_id', 'INTEGER'), ('driver_id', 'INTEGER'),
+      ('start_time', 'TIMESTAMP'), ('end_time', 'TIMESTAMP'),
+      ('bus_number', 'INTEGER'), ('first_name', 'TEXT'), ('last_name', 'TEXT'),
+      ('badge_number', 'INTEGER')],
+    'primary_key': ['vehicle_assignment_id'],
+    'indices': [['route_id', 'start_time']]},
+  # warnings have no natural key, since distinct warnings of the same type may
+  # be reported for the same bus at the same time, so a warning is identified
+  # by all of its values when the same warning is loaded from several files
+  'warning': {
+    'columns': [
+      ('loc_time', 'TIMESTAMP'), ('bus_number', 'INTEGER'), ('address', 'TEXT'),
+      ('warning_name', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL')],
+    'primary_key': [],
+    'indices': [['bus_number', 'loc_time']]},
+  'unassigned_warning': {
+    'columns': [
+      ('loc_time', 'TIMESTAMP'), ('bus_number', 'INTEGER'), ('address', 'TEXT'),
+      ('warning_name', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL')],
+    'primary_key': [],
+    'indices': []},
+  'hotspot_data_product': {
+    'columns': [
+      ('route_name', 'TEXT'), ('route_id', 'INTEGER'), ('heading', 'TEXT'),
+      ('driver_id', 'INTEGER'), ('vehicle_id', 'INTEGER'),
+      ('bus_number', 'INTEGER'), ('loc_time', 'TIMESTAMP'),
+      ('warning_name', 'TEXT'), ('latitude', 'REAL'), ('longitude', 'REAL'),
+      ('vehicle_assignment_id', 'INTEGER')],
+    'primary_key': [],
+    'indices': [['vehicle_assignment_id']]},
+  'longitudinal_data_product': {
+    'columns': [
+      ('route_name', 'TEXT'), ('route_id', 'INTEGER'), ('heading', 'TEXT'),
+      ('driver_id', 'INTEGER'), ('vehicle_id', 'INTEGER'),
+      ('bus_number', 'INTEGER'), ('start_time', 'TIMESTAMP'),
+      ('end_time', 'TIMESTAMP'), ('ME - Pedestrian Collision Warning', 'INTEGER'),
+      ('ME - Pedestrian In Range Warning', 'INTEGER'), ('PCW-LF', 'INTEGER'),
+      ('PCW-LR', 'INTEGER'), ('PCW-RR', 'INTEGER'),
+      ('PDZ - Left Front', 'INTEGER'), ('PDZ-LR', 'INTEGER'),
+      ('PDZ-R', 'INTEGER'), ('Safety - Braking - Aggressive', 'INTEGER'),
+      ('Safety - Braking - Dangerous', 'INTEGER'),
+      ('vehicle_assignment_id', 'INTEGER')],
+    'primary_key': [],
+    'indices': [['vehicle_assignment_id']]},
+  'processed_vehicle_assignment': {
+    'columns': [
+      ('vehicle_assignment_id', 'INTEGER'), ('processed_at', 'TIMESTAMP')],
+    'primary_key': ['vehicle_assignment_id'],
+    'indices': []},
+  # the source files loaded into each table, and the records that each file
+  # contains (see ingestion_manifest.py)
+  'ingested_file': {
+    'columns': [
+      ('table_name', 'TEXT'), ('file_path', 'TEXT'), ('file_id', 'INTEGER'),
+      ('file_size', 'INTEGER'), ('modified_at_ns', 'INTEGER'),
+      ('content_hash', 'TEXT'), ('record_count', 'INTEGER'),
+      ('ingested_at', 'TIMESTAMP')],
+    'primary_key': ['table_name', 'file_path'],
+    'indices': [['table_name', 'content_hash'], ['file_id']]},
+  'ingested_record': {
+    'columns': [('file_id', 'INTEGER'), ('record_rowid', 'INTEGER')],
+    'primary_key': ['file_id', 'record_rowid'],
+    'indices': [['record_rowid']]},
+  # one record per data product run, with the complete run report as JSON.
+  # run_id is an alias of the rowid, so a run written without one is given the
+  # next id rather than replacing a run that started at the same time
+  'pipeline_run': {
+    'columns': [
+      ('run_id', 'INTEGER'), ('started_at', 'TIMESTAMP'),
+      ('finished_at', 'TIMESTAMP'),
+      ('seconds', 'REAL'), ('load_seconds', 'REAL'), ('index_seconds', 'REAL'),
+      ('segment_seconds', 'REAL'), ('assign_seconds', 'REAL'),
+      ('aggregate_seconds', 'REAL'), ('write_seconds', 'REAL'),
+      ('report', 'TEXT')],
+    'primary_key': ['run_id'],
+    'indices': [['started_at']]}}
+
+
+def quote(identifier):
+  return '"{}"'.format(identifier.replace('"', '""'))
+
+
+@contextmanager
+def bulk_load_transaction(db_path, cache_size_kib=262144):
+  """Open a connection to the SQLite database at db_path that is tuned for
+  bulk loading and yield it inside a single transaction, which is committed
+  when the block exits normally and rolled back otherwise.
+
+  Syncing to disk is disabled for the duration of the load since an
+  interrupted load is rolled back from the write-ahead log and can simply be
+  repeated. The previous synchronous setting is restored afterwards."""
+  connection = sqlite3.connect(db_path, isolation_level=None)
+
+  synchronous = connection.execute('PRAGMA synchronous').fetchone()[0]
+
+  connection.execute('PRAGMA journal_mode = WAL')
+  connection.execute('PRAGMA synchronous = OFF')
+  connection.execute('PRAGMA cache_size = -{}'.format(cache_size_kib))
+  connection.execute('PRAGMA temp_store = MEMORY')
+
+  try:
+    connection.execute('BEGIN')
+
+    try:
+      yield connection
+    except BaseException:
+      connection.execute('ROLLBACK')
+      raise
+
+    connection.execute('COMMIT')
+  finally:
+    connection.execute('PRAGMA synchronous = {}'.format(synchronous))
+    connection.close()
+
+
+def table_exists(connection, table_name):
+  return connection.execute(
+    'SELECT count(*) FROM sqlite_master WHERE type = \'table\' AND name = ?',
+    (table_name,)).fetchone()[0] > 0
+
+
+def create_table(connection, table_name, schema):
+  """Create the given table from the given schema if it does not exist"""
+  column_definitions = [
+    '{} {}'.format(quote(column_name), column_type)
+    for column_name, column_type in schema['columns']]
+
+  if len(schema['primary_key']) > 0:
+    column_definitions.append('PRIMARY KEY ({})'.format(
+      ', '.join(quote(column_name) for column_name in schema['primary_key'])))
+
+  connection.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+    quote(table_name), ', '.join(column_definitions)))
+
+
+def create_indices(connection, table_name, schema):
+  for column_names in schema['indices']:
+    connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+      quote('{}_{}_idx'.format(table_name, '_'.join(column_names))),
+      quote(table_name),
+      ', '.join(quote(column_name) for column_name in column_names)))
+
+
+def to_sqlite_values(values, column_type):
+  """Convert an array of column values to a list of python values that sqlite3
+  can bind, with missing values as None"""
+  values = np.asarray(values)
+
+  if column_type == 'TIMESTAMP':
+    values = pd.to_datetime(values).values
+    is_null = np.isnat(values)
+    # pandas stores timestamps as e.g. '2018-02-01 06:00:00.000000', so the
+    # ISO 'T' separator is overwritten in place in the fixed-width strings
+    values = np.datetime_as_string(values.astype('datetime64[us]'), unit='us')
+    characters = values.view(np.uint32).reshape(
+      (values.shape[0], values.dtype.itemsize // 4))
+    characters[:, 10] = ord(' ')
+    values = values.astype(object)
+    values[is_null] = None
+    return values.tolist()
+
+  if values.dtype == np.bool_ or np.issubdtype(values.dtype, np.integer):
+    return values.astype(np.int64).tolist()
+
+  values = values.astype(object)
+  is_null = pd.isnull(values)
+  values[is_null] = None
+
+  if column_type in ('INTEGER', 'BOOLEAN'):
+    values[~is_null] = [int(value) for value in values[~is_null]]
+
+  return values.tolist()
+
+
+def prepare_table(connection, table_name, schema, if_exists='append'):
+  """Create the given table from the given schema, first dropping it if it
+  exists and if_exists is 'replace'. if_exists has the same meaning as in
+  DataFrame.to_sql."""
+  if table_exists(connection, table_name):
+    if if_exists == 'fail':
+      raise ValueError('Table \'{}\' already exists.'.format(table_name))
+    elif if_exists == 'replace':
+      connection.execute('DROP TABLE {}'.format(quote(table_name)))
+    elif if_exists != 'append':
+      raise ValueError('\'{}\' is not valid for if_exists'.format(if_exists))
+
+  create_table(connection, table_name, schema)
+
+
+def write_table(connection, table_name, data, schema, if_exists='append',
+                chunk_size=100000):
+  """Write the rows of a pandas data frame to the given table using prepared
+  inserts, converting chunk_size rows at a time so that memory use beyond the
+  data frame itself is bounded. The table is created from the given schema if
+  needed and its indices are created after the rows are inserted. if_exists
+  has the same meaning as in DataFrame.to_sql."""
+  prepare_table(connection, table_name, schema, if_exists)
+
+  column_names = [column_name for column_name, _ in schema['columns']]
+  column_types = [column_type for _, column_type in schema['columns']]
+
+  insert_statement = '{} INTO {} ({}) VALUES ({})'.format(
+    'INSERT OR REPLACE' if len(schema['primary_key']) > 0 else 'INSERT',
+    quote(table_name),
+    ', '.join(quote(column_name) for column_name in column_names),
+    ', '.join('?' for _ in column_names))
+
+  for chunk_start in range(0, data.shape[0], chunk_size):
+    chunk = data.iloc[chunk_start:chunk_start + chunk_size]
+
+    connection.executemany(insert_statement, zip(*[
+      to_sqlite_values(chunk[column_name], column_type)
+      for column_name, column_type in zip(column_names, column_types)]))
+
+  create_indices(connection, table_name, schema)
+
+  print('wrote {} records to {}'.format(data.shape[0], table_name))
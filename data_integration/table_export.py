@@ -0,0 +1,117 @@
+from importlib.util import find_spec
+from os import path
+import pandas as pd
+
+# This module exports tables for inspection in Excel without holding more
+# than a chunk of rows in memory at a time. Rows are streamed into a
+# write-only openpyxl workbook, which writes each sheet to a temporary file as
+# rows are appended rather than building the workbook in memory, and a new
+# sheet is started whenever a sheet reaches Excel's limit of 1,048,576 rows.
+# Tables of several million rows are better exported to CSV, which is also
+# written a chunk at a time and is used whenever openpyxl is not installed.
+#
+# The table to export may be a data frame or an iterable of data frames, e.g.
+# the chunks returned by pd.read_sql with a chunksize, so that a table need
+# not be read into memory at once.
+
+# the number of rows in an Excel sheet, including its header row
+excel_row_limit = 1048576
+
+
+def table_chunks(data, chunk_size):
+  if isinstance(data, pd.DataFrame):
+    for chunk_start in range(0, data.shape[0], chunk_size):
+      yield data.iloc[chunk_start:chunk_start + chunk_size]
+  else:
+    for chunk in data:
+      for chunk_start in range(0, chunk.shape[0], chunk_size):
+        yield chunk.iloc[chunk_start:chunk_start + chunk_size]
+
+
+def excel_rows(chunk):
+  """Return the rows of the given data frame as tuples of values that
+  openpyxl can write, with missing values as None"""
+  chunk = chunk.astype(object)
+
+  return chunk.where(chunk.notnull(), None).itertuples(index=False, name=None)
+
+
+def write_excel(data, file_path, sheet_name, chunk_size=100000,
+                sheet_row_limit=excel_row_limit):
+  """Stream the rows of the given table into a new workbook at file_path,
+  starting sheet sheet_name_<i> after every sheet_row_limit - 1 rows. Return
+  the number of rows written."""
+  from openpyxl import Workbook
+
+  workbook = Workbook(write_only=True)
+  sheet = None
+  sheet_count = 0
+  sheet_row_count = 0
+  row_count = 0
+
+  for chunk in table_chunks(data, chunk_size):
+    for row in excel_rows(chunk):
+      if sheet is None or sheet_row_count == sheet_row_limit:
+        sheet = workbook.create_sheet('{}_{}'.format(sheet_name, sheet_count))
+        sheet.append([str(column_name) for column_name in chunk.columns])
+        sheet_count += 1
+        sheet_row_count = 1
+
+      sheet.append(row)
+      sheet_row_count += 1
+      row_count += 1
+
+  # a workbook must have at least one sheet
+  if sheet is None:
+    workbook.create_sheet('{}_0'.format(sheet_name))
+
+  workbook.save(file_path)
+
+  print('wrote {} rows to {} sheets of {}'.format(
+    row_count, sheet_count, file_path))
+
+  return row_count
+
+
+def write_csv(data, file_path, chunk_size=100000):
+  """Append the rows of the given table to a new CSV file at file_path a chunk
+  at a time. Return the number of rows written."""
+  row_count = 0
+
+  for chunk in table_chunks(data, chunk_size):
+    chunk.to_csv(file_path, mode='w' if row_count == 0 else 'a',
+                 header=row_count == 0, index=False)
+
+    row_count += chunk.shape[0]
+
+  # write the header of an empty data frame, or an empty file
+  if row_count == 0:
+    if isinstance(data, pd.DataFrame):
+      data.to_csv(file_path, index=False)
+    else:
+      open(file_path, 'w').close()
+
+  print('wrote {} rows to {}'.format(row_count, file_path))
+
+  return row_count
+
+
+def export_table(data, file_path, sheet_name='Sheet', chunk_size=100000):
+  """Export the given table to file_path as CSV if its extension is .csv, and
+  otherwise as an Excel workbook with sheets named after sheet_name, or as
+  CSV at the same path with a .csv extension if openpyxl is not installed.
+  Return the path written."""
+  if path.splitext(file_path)[1].lower() != '.csv':
+    if find_spec('openpyxl') is not None:
+      write_excel(data, file_path, sheet_name, chunk_size)
+
+      return file_path
+
+    file_path = path.splitext(file_path)[0] + '.csv'
+
+    print('openpyxl is not installed, exporting to {} instead'.format(
+      file_path))
+
+  write_csv(data, file_path, chunk_size)
+
+  return file_path
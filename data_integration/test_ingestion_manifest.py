@@ -0,0 +1,69 @@
+import sqlite3
+import pandas as pd
+from add_vehicle_assignments_to_db import read_vehicle_assignment_file
+from ingestion_manifest import ingest_files
+from sqlite_bulk_load import table_schemas
+
+
+def write_vehicle_assignment_file(file_path, vehicle_assignment_ids):
+  """Write a VehiclesThatRanRoute export with one run per given id"""
+  start_times = pd.Timestamp('2018-02-01 06:00') + pd.to_timedelta(
+    [60 * int(vehicle_assignment_id)
+     for vehicle_assignment_id in vehicle_assignment_ids], unit='m')
+
+  pd.DataFrame({
+    'vehicle_assignment_id': vehicle_assignment_ids, 'vehicle_id': 7,
+    'route_id': 1, 'driver_id': 1001, 'unused_4': '',
+    'start_time': start_times,
+    'end_time': start_times + pd.Timedelta(minutes=50), 'unused_7': '',
+    'unused_8': '', 'unused_9': '', 'unused_10': '', 'bus_number': 15007,
+    'first_name': 'Driver', 'last_name': 'One', 'badge_number': 1001}).to_csv(
+    file_path, sep='\t', index=False)
+
+
+def ingest_vehicle_assignment_files(db_path, file_paths):
+  ingest_files(db_path, 'vehicle_assignment',
+               table_schemas['vehicle_assignment'], file_paths,
+               read_vehicle_assignment_file)
+
+  with sqlite3.connect(db_path) as connection:
+    vehicle_assignment_ids = [record[0] for record in connection.execute(
+      'SELECT vehicle_assignment_id FROM vehicle_assignment '
+      'ORDER BY vehicle_assignment_id')]
+    file_record_counts = connection.execute(
+      'SELECT ingested_file.record_count, count(record_rowid) '
+      'FROM ingested_file LEFT JOIN ingested_file_record '
+      'ON ingested_file_record.file_id = ingested_file.file_id '
+      'GROUP BY ingested_file.file_id').fetchall()
+
+  connection.close()
+
+  return vehicle_assignment_ids, file_record_counts
+
+
+def test_ids_below_those_already_loaded(tmp_path):
+  # the vehicle_assignment_id of a record is its rowid, so the records of
+  # later files are given rowids below those already loaded
+  db_path = str(tmp_path / 'test.sqlite')
+  file_paths = [str(tmp_path / 'DASH_VehiclesThatRanRoute_{}.txt'.format(day))
+                for day in range(3)]
+
+  write_vehicle_assignment_file(file_paths[0], list(range(11, 19)))
+  write_vehicle_assignment_file(file_paths[1], list(range(1, 6)))
+  write_vehicle_assignment_file(
+    file_paths[2], list(range(6, 11)) + list(range(19, 22)))
+
+  vehicle_assignment_ids, file_record_counts = \
+    ingest_vehicle_assignment_files(db_path, file_paths)
+
+  assert vehicle_assignment_ids == list(range(1, 22))
+  assert file_record_counts == [(8, 8), (5, 5), (8, 8)]
+
+  # records no longer in a changed file are deleted
+  write_vehicle_assignment_file(file_paths[2], [9, 10, 19, 20, 21])
+
+  vehicle_assignment_ids, file_record_counts = \
+    ingest_vehicle_assignment_files(db_path, file_paths)
+
+  assert vehicle_assignment_ids == list(range(1, 6)) + list(range(9, 22))
+  assert file_record_counts == [(8, 8), (5, 5), (5, 5)]
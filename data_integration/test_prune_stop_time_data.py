@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from add_stop_times_to_db import prune_stop_time_data
+from compact_dtypes import compact_table
+
+# route 1 runs from terminal stop 10 through stops 11 and 12 to terminal
+# stop 13
+route_stop_data = compact_table(pd.DataFrame({
+  'route_id': [1, 1, 1, 1], 'stop_id': [10, 11, 12, 13],
+  'heading': ['N', 'N', 'N', 'N'], 'sequence': [1, 2, 3, 1]}))
+
+
+def stop_times(stop_ids):
+  arrived_at = pd.Timestamp('2018-02-01 06:00') + pd.to_timedelta(
+    np.arange(len(stop_ids)) * 60, unit='s')
+
+  return compact_table(pd.DataFrame({
+    'stop_id': stop_ids, 'route_id': 1, 'vehicle_id': 7,
+    'arrived_at': arrived_at, 'arrival_latitude': 34.0,
+    'arrival_longitude': -118.0,
+    'departed_at': arrived_at + pd.Timedelta(seconds=30),
+    'departure_latitude': np.arange(len(stop_ids), dtype=np.float64),
+    'departure_longitude': -118.0,
+    'stop_time_id': np.arange(len(stop_ids))}))
+
+
+def test_without_terminal_records():
+  stop_time_data = stop_times([11, 12, 11, 12])
+
+  pruned_data = prune_stop_time_data(stop_time_data.copy(), route_stop_data)
+
+  pd.testing.assert_frame_equal(pruned_data, stop_time_data)
+
+
+def test_with_only_terminal_records():
+  stop_time_data = stop_times([10, 10, 10, 13, 13])
+
+  pruned_data = prune_stop_time_data(stop_time_data.copy(), route_stop_data)
+
+  # each run arrives with its first record and departs with its last
+  assert pruned_data['stop_id'].tolist() == [10, 13]
+  assert pruned_data['arrived_at'].tolist() == \
+    stop_time_data['arrived_at'].iloc[[0, 3]].tolist()
+  assert pruned_data['departed_at'].tolist() == \
+    stop_time_data['departed_at'].iloc[[2, 4]].tolist()
+  assert pruned_data['departure_latitude'].tolist() == [2.0, 4.0]